@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Онлайн-бэкап SQLite-базы без остановки сервера.
+
+Копирование идёт через SQLite online-backup API небольшими порциями страниц
+с паузами между ними, поэтому запись в рабочую базу не блокируется надолго.
+Готовая копия проверяется PRAGMA integrity_check, сжимается (gzip или zstd)
+и старые бэкапы удаляются по политике хранения.
+
+Используйте:
+    python backup.py --db data/clinic.db --out data/backups
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Префикс имени файлов бэкапа: clinic_YYYY-MM-DD_HHMMSS_ffffff.db.gz (микросекунды — чтобы бэкапы подряд не совпадали)
+BACKUP_PREFIX = "clinic_"
+
+# Расширения сжатых файлов по алгоритму
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+
+
+class BackupError(Exception):
+    """Ошибка создания или проверки бэкапа."""
+
+
+class _BackupRestarted(Exception):
+    """Пошаговое копирование слишком часто начиналось заново — переходим к копированию за один шаг."""
+
+
+def copy_online(db_path: str, target_path: str, pages_per_step: int = 256, step_sleep: float = 0.05,
+                max_restarts: int = 3):
+    """
+    Скопировать живую базу в target_path через online-backup API.
+    За один шаг копируется pages_per_step страниц, между шагами — пауза step_sleep секунд:
+    в паузах блокировка с исходной базы снята, и сервер спокойно пишет.
+    Но любая запись в исходную базу между шагами заставляет SQLite начать копирование заново,
+    и при постоянной записи пошаговый бэкап не закончился бы никогда. Поэтому после
+    max_restarts перезапусков база копируется одним шагом (pages=-1): под одной блокировкой
+    чтения, то есть из одного согласованного снимка — запись ждёт только это время.
+    """
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    target = sqlite3.connect(target_path)
+    progress = {"remaining": None, "restarts": 0}
+
+    def throttle(status, remaining, total):
+        # Остаток вырос — SQLite начал копирование заново из-за записи в исходную базу
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+            if progress["restarts"] > max_restarts:
+                raise _BackupRestarted()
+        progress["remaining"] = remaining
+        if remaining and step_sleep > 0:
+            time.sleep(step_sleep)
+
+    try:
+        try:
+            source.backup(target, pages=pages_per_step, progress=throttle)
+        except _BackupRestarted:
+            source.backup(target, pages=-1)
+    finally:
+        target.close()
+        source.close()
+
+
+def verify_backup(path: str):
+    """Проверить копию через PRAGMA integrity_check; при проблемах бросает BackupError."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    finally:
+        conn.close()
+    if result != ["ok"]:
+        raise BackupError(f"integrity_check failed: {'; '.join(result[:5])}")
+
+
+def compress_file(path: str, compression: str) -> str:
+    """Сжать файл (gzip или zstd) потоково и удалить исходник. Возвращает путь к архиву."""
+    if compression == "none":
+        return path
+    target = path + COMPRESSION_SUFFIXES[compression]
+    if compression == "gzip":
+        with open(path, "rb") as src, gzip.open(target, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise BackupError("zstd compression requires the 'zstandard' package")
+        with open(path, "rb") as src, open(target, "wb") as dst:
+            zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+    else:
+        raise BackupError(f"Unknown compression: {compression}")
+    os.remove(path)
+    return target
+
+
+def apply_retention(backup_dir: str, keep_last: int = 14, max_age_days: Optional[int] = None) -> list:
+    """
+    Удалить старые бэкапы.
+    Всегда остаются keep_last самых свежих; из остальных удаляются те, что старше max_age_days
+    (если max_age_days не задан — удаляются все сверх keep_last).
+    """
+    backups = sorted(
+        (
+            os.path.join(backup_dir, name)
+            for name in os.listdir(backup_dir)
+            if name.startswith(BACKUP_PREFIX) and not name.endswith(".partial")
+        ),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+    removed = []
+    for path in backups[keep_last:]:
+        if cutoff is None or os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed.append(os.path.basename(path))
+    return removed
+
+
+def backup_database(
+    db_path: str,
+    backup_dir: str,
+    pages_per_step: int = 256,
+    step_sleep: float = 0.05,
+    compression: str = "gzip",
+    keep_last: int = 14,
+    max_age_days: Optional[int] = None,
+) -> dict:
+    """
+    Полный цикл бэкапа: онлайн-копия → integrity_check → сжатие → политика хранения.
+    Пока копия не проверена, она лежит с суффиксом .partial и в ротации не участвует.
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise BackupError(f"Unknown compression: {compression}")
+    if not os.path.exists(db_path):
+        raise BackupError(f"Database file not found: {db_path}")
+    os.makedirs(backup_dir, exist_ok=True)
+
+    started = time.monotonic()
+    stamp = datetime.now().strftime('%Y-%m-%d_%H%M%S_%f')
+    attempt = 0
+    while True:
+        # Имя занимается созданием .partial-файла (O_EXCL): параллельный бэкап получит другой суффикс
+        name = f"{BACKUP_PREFIX}{stamp}{f'_{attempt}' if attempt else ''}.db"
+        partial_path = os.path.join(backup_dir, name + ".partial")
+        final_path = os.path.join(backup_dir, name)
+        try:
+            os.close(os.open(partial_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            attempt += 1
+            continue
+        if any(os.path.exists(final_path + suffix) for suffix in COMPRESSION_SUFFIXES.values()):
+            os.remove(partial_path)
+            attempt += 1
+            continue
+        break
+    try:
+        copy_online(db_path, partial_path, pages_per_step, step_sleep)
+        verify_backup(partial_path)
+        os.replace(partial_path, final_path)
+        final_path = compress_file(final_path, compression)
+    except Exception:
+        for path in (partial_path, final_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    removed = apply_retention(backup_dir, keep_last, max_age_days)
+    return {
+        "file": os.path.basename(final_path),
+        "path": final_path,
+        "size_bytes": os.path.getsize(final_path),
+        "duration_seconds": round(time.monotonic() - started, 3),
+        "removed": removed,
+    }
+
+
+def list_backups(backup_dir: str) -> list:
+    """Список готовых бэкапов (новые сверху)."""
+    if not os.path.isdir(backup_dir):
+        return []
+    result = []
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if name.startswith(BACKUP_PREFIX) and not name.endswith(".partial"):
+            result.append({
+                "file": name,
+                "size_bytes": os.path.getsize(path),
+                "created_at": datetime.fromtimestamp(os.path.getmtime(path)).isoformat(),
+            })
+    return sorted(result, key=lambda item: item["created_at"], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Онлайн-бэкап базы clinic.db")
+    parser.add_argument("--db", default="data/clinic.db", help="Путь к файлу базы")
+    parser.add_argument("--out", default=None, help="Папка для бэкапов (по умолчанию <папка базы>/backups)")
+    parser.add_argument("--pages", type=int, default=256, help="Страниц за один шаг копирования")
+    parser.add_argument("--sleep", type=float, default=0.05, help="Пауза между шагами, секунд")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_SUFFIXES), default="gzip")
+    parser.add_argument("--keep-last", type=int, default=14, help="Сколько последних бэкапов хранить всегда")
+    parser.add_argument("--max-age-days", type=int, default=None, help="Удалять бэкапы старше N дней")
+    args = parser.parse_args()
+
+    backup_dir = args.out or os.path.join(os.path.dirname(os.path.abspath(args.db)), "backups")
+    try:
+        info = backup_database(
+            args.db, backup_dir, args.pages, args.sleep, args.compression, args.keep_last, args.max_age_days
+        )
+    except (BackupError, sqlite3.Error) as e:
+        print(f"❌ Ошибка бэкапа: {e}")
+        raise SystemExit(1)
+    print(f"✅ Бэкап создан: {info['path']} ({info['size_bytes']} байт, {info['duration_seconds']} с)")
+    for name in info["removed"]:
+        print(f"🗑  Удалён старый бэкап: {name}")
+
+
+if __name__ == "__main__":
+    main()
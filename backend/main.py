@@ -1,15 +1,66 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.security import HTTPBearer, OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, func, or_
+from starlette.datastructures import Headers, MutableHeaders
+from sqlalchemy import create_engine, and_, bindparam, case, cast, event, insert, inspect, literal_column, Column, ForeignKey, Integer, Float, String, DateTime, Text, Boolean, Index, Table, func, or_, text, tuple_, select, union_all
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from pydantic import BaseModel
-from datetime import datetime, timedelta
-from typing import List, Optional
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker, Session, with_loader_criteria
+from sqlalchemy.orm.exc import StaleDataError
+from pydantic import BaseModel, Field, ValidationError, create_model
+from datetime import date as date_type, datetime, timedelta
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, List, NamedTuple, Optional, Union
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from backup import BackupError, backup_database, list_backups
+import asyncio
+import atexit
+import base64
+import codecs
+import csv
+import functools
+import hashlib
+import http.client
+import ipaddress
+import json
 import os
+import re
+import secrets
+import smtplib
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict, defaultdict, deque
+from contextvars import ContextVar
+from email.message import EmailMessage
+from zoneinfo import ZoneInfo
+
+# =====================
+#   ЧАСОВОЙ ПОЯС КЛИНИКИ
+# =====================
+
+# Даты и время смен хранятся строками "как в расписании" (местное время клиники).
+# В контейнере часовой пояс системы обычно UTC, поэтому "сейчас" для сравнения со сменами
+# берётся в CLINIC_TZ (например, Europe/Moscow); пусто — часовой пояс сервера
+CLINIC_TZ = os.getenv("CLINIC_TZ", "")
+clinic_timezone = ZoneInfo(CLINIC_TZ) if CLINIC_TZ else None
+
+
+def clinic_now() -> datetime:
+    """Текущее местное время клиники (без tzinfo) — в той же шкале, что даты и время смен."""
+    if clinic_timezone is None:
+        return datetime.now()
+    return datetime.now(clinic_timezone).replace(tzinfo=None)
+
 
 # ==========================
 #   НАСТРОЙКИ АУТЕНТИФИКАЦИИ
@@ -25,6 +76,47 @@ ALGORITHM = "HS256"
 # Время жизни access-токена (в минутах)
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Время жизни refresh-токена (в днях). Он обновляется при каждом использовании (ротация)
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+
+# Сколько секунд после ротации старый refresh-токен ещё не считается украденным:
+# параллельные запросы клиента могут прислать его одновременно — второй получит 401,
+# но остальные токены пользователя не отзываются
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "30"))
+
+# Ограничение попыток входа (token bucket): сколько попыток подряд и за сколько секунд
+# восстанавливается одна попытка — отдельно для логина и для IP-адреса клиента
+LOGIN_THROTTLE_USER_BURST = int(os.getenv("LOGIN_THROTTLE_USER_BURST", "5"))
+LOGIN_THROTTLE_USER_REFILL_SECONDS = float(os.getenv("LOGIN_THROTTLE_USER_REFILL_SECONDS", "60"))
+LOGIN_THROTTLE_IP_BURST = int(os.getenv("LOGIN_THROTTLE_IP_BURST", "20"))
+LOGIN_THROTTLE_IP_REFILL_SECONDS = float(os.getenv("LOGIN_THROTTLE_IP_REFILL_SECONDS", "3"))
+
+# Прогрессивная задержка: после LOGIN_THROTTLE_FREE_FAILURES неудач подряд
+# каждая следующая удваивает паузу (1, 2, 4 ... секунд, но не больше максимума)
+LOGIN_THROTTLE_FREE_FAILURES = int(os.getenv("LOGIN_THROTTLE_FREE_FAILURES", "3"))
+LOGIN_THROTTLE_MAX_DELAY_SECONDS = float(os.getenv("LOGIN_THROTTLE_MAX_DELAY_SECONDS", "300"))
+
+# Через сколько секунд без попыток входа счётчик неудач обнуляется
+# (иначе у IP, с которого никто не входит успешно, задержка копится бесконечно)
+LOGIN_THROTTLE_FAILURE_RESET_SECONDS = float(os.getenv("LOGIN_THROTTLE_FAILURE_RESET_SECONDS", "900"))
+
+# Сколько ключей (логинов/IP) хранить в памяти; самые давние вытесняются (LRU)
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "10000"))
+
+# true — состояние ограничителя общее для всех воркеров (хранится в БД)
+LOGIN_THROTTLE_SHARED = os.getenv("LOGIN_THROTTLE_SHARED", "false").lower() == "true"
+
+# Брать IP клиента из заголовка X-Real-IP (включать только за доверенным nginx)
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() == "true"
+
+# С каких адресов заголовку X-Real-IP можно верить (сети через запятую): по умолчанию —
+# локальные и частные сети, где живёт nginx из docker-compose; прямые запросы из интернета его не подменят
+TRUSTED_PROXY_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in os.getenv("TRUSTED_PROXY_NETWORKS", "127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128").split(",")
+    if network.strip()
+]
+
 # Контекст для хэширования и проверки паролей (используется bcrypt)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -41,24 +133,229 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # Можно переопределить через переменную окружения DATABASE_URL.
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./clinic.db")
 
-# Создаём движок SQLAlchemy.
-# Для SQLite нужно явно отключить проверку "check_same_thread".
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
 
-# Фабрика сессий для работы с БД
+def make_engine(url: str):
+    """
+    Создать движок SQLAlchemy.
+    Для SQLite нужно явно отключить проверку "check_same_thread" и включить внешние ключи.
+    """
+    bind = create_engine(url, connect_args={"check_same_thread": False} if "sqlite" in url else {})
+    if bind.url.get_backend_name() == "sqlite":
+        @event.listens_for(bind, "connect")
+        def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+            """SQLite проверяет внешние ключи (и выполняет ON DELETE) только если включить их на соединении."""
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA foreign_keys = ON")
+            cursor.close()
+    return bind
+
+
+engine = make_engine(DATABASE_URL)
+
+# Фабрика сессий для работы с БД.
+# Сессии филиалов создаются ею же с другим bind (SessionLocal(bind=...)), поэтому
+# события, навешанные на SessionLocal (мягкое удаление, аудит), работают для всех баз
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Базовый класс для декларативных моделей
 Base = declarative_base()
 
 
+# ===============================
+#   ФИЛИАЛЫ (ОТДЕЛЬНАЯ БАЗА НА ФИЛИАЛ)
+# ===============================
+
+# Шаблон URL базы филиала, например sqlite:///./data/clinic_{tenant}.db
+# (для PostgreSQL — схема на филиал: ...?options=-csearch_path%3D{tenant}).
+# Пусто — один филиал, все запросы идут в DATABASE_URL
+TENANT_DATABASE_URL_TEMPLATE = os.getenv("TENANT_DATABASE_URL_TEMPLATE", "")
+
+# Известные филиалы (через запятую). Другие идентификаторы отклоняются: база не создаётся по произвольному Host
+TENANTS = [tenant.strip() for tenant in os.getenv("TENANTS", "").split(",") if tenant.strip()]
+
+# Филиал из имени хоста: branch1<TENANT_HOST_SUFFIX> → branch1 (например, ".clinic.example.com")
+TENANT_HOST_SUFFIX = os.getenv("TENANT_HOST_SUFFIX", "")
+
+# Сколько баз филиалов держать открытыми; давно не использованные закрываются (LRU)
+TENANT_MAX_ENGINES = int(os.getenv("TENANT_MAX_ENGINES", "32"))
+
+# Через сколько секунд без запросов база филиала закрывается
+TENANT_IDLE_SECONDS = int(os.getenv("TENANT_IDLE_SECONDS", "900"))
+
+MULTI_TENANT = bool(TENANT_DATABASE_URL_TEMPLATE)
+
+# Филиал текущего запроса или фоновой задачи (None — режим одного филиала)
+current_tenant: ContextVar[Optional[str]] = ContextVar("current_tenant", default=None)
+
+
+class TenantEngineRegistry:
+    """
+    Открытые движки баз филиалов.
+    База открывается при первом обращении к филиалу; схема догоняется один раз на филиал
+    за время жизни процесса (повторное открытие после вытеснения её не трогает).
+    При превышении max_engines закрывается давно не использованная, а evict_idle закрывает простаивающие.
+    Закрытие движка не мешает уже идущим запросам: их соединения закроются при возврате в пул.
+    """
+
+    def __init__(self, max_engines: int, idle_seconds: int):
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self._engines = OrderedDict()  # tenant -> [engine, время последнего обращения]
+        self._lock = threading.Lock()
+        # Открытие базы (и догон схемы) идёт под замком своего филиала, а не общим:
+        # холодный филиал не задерживает запросы к уже открытым
+        self._open_locks: Dict[str, threading.Lock] = {}
+        self._initialized = set()  # филиалы, схема которых уже подготовлена этим процессом
+
+    def _lookup(self, tenant: str, touch: bool):
+        """Открытый движок филиала или None; touch — считать обращение использованием."""
+        with self._lock:
+            item = self._engines.get(tenant)
+            if item is not None and touch:
+                self._engines.move_to_end(tenant)
+                item[1] = time.monotonic()
+            return item[0] if item is not None else None
+
+    def _open_lock(self, tenant: str) -> threading.Lock:
+        with self._lock:
+            return self._open_locks.setdefault(tenant, threading.Lock())
+
+    def _make_engine(self, tenant: str):
+        """Новый движок базы филиала; схема готовится только при первом открытии в процессе."""
+        bind = make_engine(TENANT_DATABASE_URL_TEMPLATE.format(tenant=tenant))
+        if tenant in self._initialized:
+            return bind
+        if bind.url.get_backend_name() == "sqlite" and bind.url.database:
+            os.makedirs(os.path.dirname(os.path.abspath(bind.url.database)), exist_ok=True)
+        token = current_tenant.set(tenant)
+        try:
+            init_database(bind)
+        except Exception:
+            bind.dispose()
+            raise
+        finally:
+            current_tenant.reset(token)
+        self._initialized.add(tenant)
+        return bind
+
+    def get(self, tenant: str):
+        bind = self._lookup(tenant, touch=True)
+        if bind is not None:
+            return bind
+        with self._open_lock(tenant):
+            # Пока ждали замок, базу мог открыть параллельный запрос
+            bind = self._lookup(tenant, touch=True)
+            if bind is not None:
+                return bind
+            bind = self._make_engine(tenant)
+            with self._lock:
+                self._engines[tenant] = [bind, time.monotonic()]
+                evicted = []
+                while len(self._engines) > self.max_engines:
+                    name, (old, _) = self._engines.popitem(last=False)
+                    evicted.append((name, old))
+            for name, old in evicted:
+                old.dispose()
+                print(f"Tenant engine closed (LRU): {name}")
+            return bind
+
+    @contextmanager
+    def borrow(self, tenant: str):
+        """
+        Движок для фоновой задачи: обращение задачи не считается использованием.
+        Открытая база не сдвигается в LRU и не продлевает простой; закрытая открывается
+        только на время задачи и в реестр не попадает, поэтому задачи по всем филиалам
+        не вытесняют базы активных и не мешают evict_idle.
+        """
+        bind = self._lookup(tenant, touch=False)
+        if bind is not None:
+            yield bind
+            return
+        with self._open_lock(tenant):
+            bind = self._make_engine(tenant)
+        try:
+            yield bind
+        finally:
+            bind.dispose()
+
+    def evict_idle(self) -> List[str]:
+        """Закрыть базы филиалов без обращений дольше idle_seconds."""
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [tenant for tenant, (_, last_used) in self._engines.items() if last_used < cutoff]
+            closed = [self._engines.pop(tenant)[0] for tenant in idle]
+        for bind in closed:
+            bind.dispose()
+        return idle
+
+    def open_tenants(self) -> List[str]:
+        with self._lock:
+            return list(self._engines)
+
+
+tenant_engines = TenantEngineRegistry(TENANT_MAX_ENGINES, TENANT_IDLE_SECONDS)
+
+# Движок, выданный фоновой задаче филиала (tenant_engines.borrow); None — обычный поиск в реестре
+job_engine: ContextVar[Optional[Engine]] = ContextVar("job_engine", default=None)
+
+
+def engine_for(tenant: Optional[str]):
+    """Движок базы филиала (None — основная база)."""
+    return engine if tenant is None else tenant_engines.get(tenant)
+
+
+def current_engine():
+    """Движок базы текущего филиала."""
+    return job_engine.get() or engine_for(current_tenant.get())
+
+
+def open_session() -> Session:
+    """Новая сессия к базе текущего филиала (для кода вне Depends(get_db))."""
+    return SessionLocal(bind=current_engine())
+
+
+def tenant_subdir(path: str) -> str:
+    """Отдельная подпапка филиала (бэкапы, файлы импорта), чтобы файлы филиалов не смешивались."""
+    tenant = current_tenant.get()
+    return os.path.join(path, tenant) if tenant else path
+
+
+def known_tenant(tenant: Optional[str]) -> Optional[str]:
+    """Идентификатор филиала, если он в списке TENANTS, иначе None."""
+    return tenant if tenant in TENANTS else None
+
+
+def job_tenants() -> List[Optional[str]]:
+    """Для каких филиалов выполнять фоновые задачи: все известные или основная база."""
+    return list(TENANTS) if MULTI_TENANT else [None]
+
+
 # ===================
 #   МОДЕЛИ БАЗЫ ДАННЫХ
 # ===================
 
+# Пользователи, пациенты и активы удаляются "мягко": строка получает deleted_at
+# и пропадает из всех ORM-запросов, а физически удаляется фоновой очисткой после срока ожидания.
+LIVE_ROWS = text("deleted_at IS NULL")
+DELETED_ROWS = text("deleted_at IS NOT NULL")
+
+
+# Время "никогда" для пустых дат в ключах сортировки (в формате, в котором SQLAlchemy хранит DateTime в SQLite)
+EPOCH_SQL = "1970-01-01 00:00:00.000000"
+
+
+def live_index(name, *columns):
+    """Частичный индекс только по живым строкам: мягко удалённые его не раздувают."""
+    return Index(name, *columns, sqlite_where=LIVE_ROWS, postgresql_where=LIVE_ROWS)
+
+
+def deleted_index(table_name):
+    """Частичный индекс по deleted_at только удалённых строк — по нему очистка находит, что удалять."""
+    return Index(
+        f"ix_{table_name}_deleted_at", "deleted_at", sqlite_where=DELETED_ROWS, postgresql_where=DELETED_ROWS
+    )
+
+
 class User(Base):
     """Модель пользователя системы (сотрудник клиники)."""
     __tablename__ = "users"
@@ -74,6 +371,65 @@ class User(Base):
     is_active = Column(Boolean, default=True)                   # Активен ли пользователь
     is_admin = Column(Boolean, default=False)                   # Администратор или нет
     created_at = Column(DateTime, default=datetime.utcnow)      # Дата создания записи
+    deleted_at = Column(DateTime, nullable=True)                # Когда удалён (мягкое удаление), None — живой
+    version = Column(Integer, nullable=False, server_default="1")  # Версия строки (If-Match / ETag)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    __table_args__ = (
+        deleted_index("users"),
+    )
+
+
+class RefreshToken(Base):
+    """
+    Refresh-токен пользователя.
+    В базе хранится только SHA-256 от токена: он случайный и длинный,
+    поэтому медленный bcrypt не нужен, а поиск идёт по уникальному индексу.
+    """
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)  # Владелец токена
+    token_hash = Column(String, nullable=False, unique=True)       # SHA-256 (hex) от токена
+    expires_at = Column(DateTime, nullable=False)                  # Когда истекает
+    revoked_at = Column(DateTime, nullable=True)                   # Когда отозван/заменён (None — действует)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LoginThrottleState(Base):
+    """Общее для воркеров состояние ограничителя попыток входа (ключ — логин или IP)."""
+    __tablename__ = "login_throttle_state"
+
+    key = Column(String, primary_key=True)             # "user:<логин>" или "ip:<адрес>"
+    tokens = Column(Float, nullable=False)             # Остаток попыток в "ведре"
+    updated = Column(Float, nullable=False)            # Когда пересчитан остаток (unix time)
+    failures = Column(Integer, nullable=False)         # Неудачных попыток подряд
+    blocked_until = Column(Float, nullable=False)      # До какого момента попытки отклоняются (unix time)
+
+
+class IdempotencyRecord(Base):
+    """
+    Сохранённый ответ на запрос с заголовком Idempotency-Key.
+    Пока запрос выполняется, status_code пустой — это "захват" ключа.
+    Ключ действует только для того же вызывающего (филиал и пользователь).
+    """
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    principal = Column(String, nullable=False)         # Чей ключ: "<филиал>:<id пользователя>" или "<филиал>:anonymous"
+    key = Column(String, nullable=False)               # Значение заголовка Idempotency-Key
+    method = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    request_hash = Column(String, nullable=False)      # sha256 тела запроса
+    status_code = Column(Integer, nullable=True)       # NULL — первый запрос ещё выполняется
+    response_body = Column(Text, nullable=True)
+    content_type = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # По нему работает TTL
+
+    __table_args__ = (
+        Index("ux_idempotency_keys_principal_scope", "principal", "key", "method", "path", unique=True),
+    )
 
 
 class Shift(Base):
@@ -85,15 +441,31 @@ class Shift(Base):
     start_time = Column(String, nullable=False)    # Время начала (HH:MM)
     end_time = Column(String, nullable=False)      # Время окончания (HH:MM)
     shift_type = Column(String, nullable=False)    # Тип смены/приёма (консультация, осмотр и т.п.)
-    user_id = Column(Integer, nullable=False)      # ID сотрудника
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)  # ID сотрудника (NULL — учётная запись удалена окончательно)
     user_name = Column(String, nullable=False)     # Имя сотрудника (денормализация для удобства)
     position = Column(String, nullable=False)      # Должность сотрудника
-    patient_id = Column(Integer, nullable=True)    # ID пациента (если привязан)
+    patient_id = Column(Integer, ForeignKey("patients.id", ondelete="SET NULL"), nullable=True)  # ID пациента (если привязан)
     patient_name = Column(String, nullable=True)   # Имя пациента (денормализация)
     status = Column(String, default="scheduled")   # Статус: scheduled, completed, cancelled
     notes = Column(Text)                           # Заметки к смене/приёму
     created_at = Column(DateTime, default=datetime.utcnow)                       # Когда создано
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Когда обновлено
+    version = Column(Integer, nullable=False, server_default="1")  # Версия строки (If-Match / ETag)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    __table_args__ = (
+        # Календарь и выборки по диапазону дат: строки месяца идут подряд по индексу
+        Index("ix_shifts_date_start", "date", "start_time"),
+        # Расписание одного сотрудника по порядку (поиск свободных окон, фильтр user_id)
+        Index("ix_shifts_user_date_start", "user_id", "date", "start_time"),
+        # Фильтры списка смен: пациент, статус, тип — каждый с тем же порядком (date, start_time)
+        Index("ix_shifts_patient_date_start", "patient_id", "date", "start_time"),
+        Index("ix_shifts_status_date_start", "status", "date", "start_time"),
+        Index("ix_shifts_type_date_start", "shift_type", "date", "start_time"),
+        # id не выдаются повторно: старые смены уходят в архив с теми же id
+        {"sqlite_autoincrement": True},
+    )
 
 
 class Patient(Base):
@@ -113,10 +485,27 @@ class Patient(Base):
     chronic_conditions = Column(Text, nullable=True)   # Хронические заболевания
     medications = Column(Text, nullable=True)          # Принимаемые препараты
     attending_physician = Column(String, nullable=True) # Лечащий врач
-    last_visit = Column(DateTime, nullable=True)       # Дата последнего визита (как datetime)
+    last_visit = Column(DateTime, nullable=True)       # Последний визит; ведётся триггером по завершённым приёмам
     notes = Column(Text, nullable=True)                # Дополнительные примечания
     created_at = Column(DateTime, default=datetime.utcnow)                       # Когда создано
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Когда обновлено
+    deleted_at = Column(DateTime, nullable=True)       # Когда удалён (мягкое удаление), None — живой
+
+    # Нормализованные ключи для поиска дубликатов (заполняются автоматически при сохранении)
+    dedup_name_key = Column(String, nullable=True, index=True)     # фамилия латиницей + дата рождения
+    dedup_phone_key = Column(String, nullable=True, index=True)    # последние 10 цифр телефона
+    dedup_policy_key = Column(String, nullable=True, index=True)   # номер полиса без пробелов и дефисов
+
+    version = Column(Integer, nullable=False, server_default="1")  # Версия строки (If-Match / ETag)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    __table_args__ = (
+        # Список пациентов: новые карточки сверху и сортировка по последнему визиту
+        live_index("ix_patients_live_created_at", "created_at"),
+        live_index("ix_patients_live_last_visit", "last_visit"),
+        deleted_index("patients"),
+    )
 
 
 class Asset(Base):
@@ -129,7 +518,22 @@ class Asset(Base):
     asset_type = Column(String, nullable=False)        # CASE, CHANGE_MANAGEMENT, ORANGE_CASE, CLIENT_REQUESTS
     status = Column(String, nullable=False)            # Статус: Active, Completed, On Hold
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    deleted_at = Column(DateTime, nullable=True)       # Когда удалён (мягкое удаление), None — живой
+
+    __table_args__ = (
+        deleted_index("assets"),
+    )
+
+
+# Ключ сортировки страниц активов: в старых строках updated_at может быть пустым
+ASSET_SORT_TIME = func.coalesce(Asset.updated_at, Asset.created_at, literal_column(f"'{EPOCH_SQL}'"))
+
+# Фильтр по типу (+ статусу) и сортировка по времени изменения — одним проходом по индексу,
+# им же считаются фасеты по типам
+live_index("ix_assets_live_type_status_sort", Asset.asset_type, Asset.status, ASSET_SORT_TIME)
+# Фильтр только по статусу и фасеты по статусам
+live_index("ix_assets_live_status_sort", Asset.status, ASSET_SORT_TIME)
 
 
 class ShiftHandover(Base):
@@ -137,10 +541,14 @@ class ShiftHandover(Base):
     __tablename__ = "shift_handovers"
     
     id = Column(Integer, primary_key=True, index=True)
-    from_shift_id = Column(Integer, nullable=True)     # ID смены, которая передаёт
-    to_shift_id = Column(Integer, nullable=True)       # ID смены, которая принимает
+    # Ссылки на смены без внешнего ключа: смена может уехать в архив, а передача остаётся
+    from_shift_id = Column(Integer, nullable=True, index=True)  # ID смены, которая передаёт
+    to_shift_id = Column(Integer, nullable=True, index=True)    # ID смены, которая принимает
     handover_notes = Column(Text, nullable=False)      # Описание передачи (что передано, текущий статус дел)
     created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, server_default="1")  # Версия строки (If-Match / ETag)
+
+    __mapper_args__ = {"version_id_col": version}
 
 
 class HandoverAsset(Base):
@@ -148,8 +556,10 @@ class HandoverAsset(Base):
     __tablename__ = "handover_assets"
     
     id = Column(Integer, primary_key=True, index=True)
-    handover_id = Column(Integer, nullable=False)      # ID записи передачи смены
-    asset_id = Column(Integer, nullable=False)         # ID актива
+    # ID записи передачи смены
+    handover_id = Column(Integer, ForeignKey("shift_handovers.id", ondelete="CASCADE"), nullable=False, index=True)
+    # ID актива
+    asset_id = Column(Integer, ForeignKey("assets.id", ondelete="CASCADE"), nullable=False, index=True)
     notes = Column(Text, nullable=True)                # Дополнительные примечания по активу
     status = Column(String, nullable=True)             # Статус актива в рамках передачи (опционально)
 
@@ -172,6 +582,147 @@ class HandoverLog(Base):
     assets_info = Column(Text, nullable=False)         # Информация об активах (в виде строки/JSON)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Курсор инкрементального экспорта: (created_at, id) читается по индексу без сортировки
+        Index("ix_handover_logs_created_at_id", "created_at", "id"),
+        # id не выдаются повторно: старые логи уходят в архив с теми же id
+        {"sqlite_autoincrement": True},
+    )
+
+
+class HandoverLogTombstone(Base):
+    """
+    "Надгробие" удалённого лога передачи.
+    Нужно инкрементальному экспорту, чтобы внешние копии (Google Sheets) узнавали об удалениях.
+    """
+    __tablename__ = "handover_log_tombstones"
+
+    id = Column(Integer, primary_key=True, index=True)    # Монотонный номер удаления (часть курсора)
+    log_id = Column(Integer, nullable=False)              # ID удалённой записи handover_logs
+    deleted_at = Column(DateTime, default=datetime.utcnow, index=True)  # По нему чистятся старые надгробия
+
+    # Номера не выдаются повторно и после очистки старых надгробий — иначе курсоры пропустили бы удаления
+    __table_args__ = ({"sqlite_autoincrement": True},)
+
+
+# ---------- Архив ("холодное" хранилище) ----------
+
+def archive_table_for(model, *indexes):
+    """
+    Создать архивную таблицу <таблица>_archive с теми же колонками, что и у модели.
+    Значения (включая id) копируются из горячей таблицы как есть, поэтому без default'ов.
+    """
+    columns = [
+        Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+        for column in model.__table__.columns
+    ]
+    return Table(f"{model.__tablename__}_archive", Base.metadata, *columns, *indexes)
+
+
+# Архив смен: старые смены переносятся сюда по полю date
+shifts_archive = archive_table_for(
+    Shift, Index("ix_shifts_archive_date_start", "date", "start_time")
+)
+
+# Архив логов передач: по created_at, с тем же индексом, что и у горячей таблицы
+handover_logs_archive = archive_table_for(
+    HandoverLog, Index("ix_handover_logs_archive_created_at_id", "created_at", "id")
+)
+
+
+class ArchiveWatermark(Base):
+    """
+    Граница архивации по таблице: всё, что старше archived_before, может лежать в архиве.
+    Запросы истории смотрят в архив только если запрошенный диапазон заходит за эту границу.
+    """
+    __tablename__ = "archive_watermarks"
+
+    table_name = Column(String, primary_key=True)      # Имя горячей таблицы (shifts, handover_logs, handover_log_tombstones)
+    archived_before = Column(String, nullable=False)   # Граница строкой (для отображения; сравнения — по archived_before_at)
+    archived_before_at = Column(DateTime, nullable=True)  # Граница как момент времени (для смен — полночь даты)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class AuditLog(Base):
+    """
+    Журнал аудита: кто и что изменил в пациентах, сменах, пользователях и активах.
+    Только дописывается (UPDATE и DELETE запрещены триггерами), пишется пачками в фоне.
+    Не попадают в журнал: перенос смен в архив (данные не меняются, только таблица)
+    и patients.last_visit, который ведут триггеры SQLite по завершённым приёмам.
+    """
+    __tablename__ = "audit_log"
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)            # Таблица: patients, shifts, users, assets
+    entity_id = Column(Integer, nullable=True)         # ID записи
+    action = Column(String, nullable=False)            # insert, update, delete, restore, purge
+    changes = Column(Text, nullable=True)              # JSON: {"поле": [старое, новое]}
+    user_id = Column(Integer, nullable=True)           # Кто изменил (None — система/фоновая задача)
+    username = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)      # Момент изменения (не записи в журнал)
+
+    __table_args__ = (
+        # История одной записи по порядку — одним проходом по индексу
+        Index("ix_audit_log_entity_time", "entity", "entity_id", "created_at", "id"),
+        Index("ix_audit_log_created_at", "created_at", "id"),
+    )
+
+
+class ShiftReminder(Base):
+    """
+    Напоминание о приёме: одна строка на смену, канал, адрес и время отправки.
+    Это же очередь отправки: диспетчер берёт наступившие строки по индексу (status, next_attempt_at).
+    """
+    __tablename__ = "shift_reminders"
+
+    id = Column(Integer, primary_key=True)
+    shift_id = Column(Integer, ForeignKey("shifts.id", ondelete="CASCADE"), nullable=False)
+    channel = Column(String, nullable=False)           # email, telegram
+    address = Column(String, nullable=False)           # Email или chat_id Telegram
+    recipient = Column(String, nullable=False)         # user — сотрудник, patient — пациент
+    send_at = Column(DateTime, nullable=False)         # Когда отправить (местное время, как у расписания)
+    status = Column(String, nullable=False, default="pending")  # pending, sending, sent, failed, skipped
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)  # Следующая попытка; у sending — конец захвата
+    last_error = Column(Text, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Повторный просмотр того же окна не ставит напоминание второй раз;
+        # у перенесённой смены другое send_at — для неё создаётся новое
+        Index("ux_shift_reminders_key", "shift_id", "channel", "address", "send_at", unique=True),
+        Index("ix_shift_reminders_due", "status", "next_attempt_at"),
+    )
+
+
+# ---------- Мягкое удаление ----------
+
+# Модели с колонкой deleted_at
+SOFT_DELETE_MODELS = (User, Patient, Asset)
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def hide_soft_deleted_rows(execute_state):
+    """
+    Добавляет "deleted_at IS NULL" ко всем ORM-выборкам мягко удаляемых моделей
+    (включая db.query(...), db.get(...) и выборки отдельных колонок).
+    Условие совпадает с WHERE частичных индексов, поэтому планировщик использует их.
+    Увидеть удалённые строки: .execution_options(include_deleted=True).
+    Дозагрузка колонок уже загруженного объекта (refresh после commit) не фильтруется.
+    """
+    if (
+        not execute_state.is_select
+        or execute_state.is_column_load
+        or execute_state.is_relationship_load
+        or execute_state.execution_options.get("include_deleted", False)
+    ):
+        return
+    execute_state.statement = execute_state.statement.options(*(
+        with_loader_criteria(model, model.deleted_at.is_(None), include_aliases=True)
+        for model in SOFT_DELETE_MODELS
+    ))
+
 
 # =======================
 #   ФУНКЦИИ АУТЕНТИФИКАЦИИ
@@ -187,9 +738,18 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-async def get_user_by_username(db: Session, username: str):
-    """Получить пользователя по username."""
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: Session, username: str, include_deleted: bool = False):
+    """
+    Получить пользователя по username.
+    include_deleted=True — для проверки уникальности: логин мягко удалённого
+    пользователя занят, пока запись не очищена окончательно.
+    """
+    return (
+        db.query(User)
+        .execution_options(include_deleted=include_deleted)
+        .filter(User.username == username)
+        .first()
+    )
 
 
 async def authenticate_user(db: Session, username: str, password: str):
@@ -223,6 +783,46 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def hash_refresh_token(token: str) -> str:
+    """Хэш refresh-токена для хранения и поиска в базе."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_refresh_token(db: Session, user_id: int) -> str:
+    """
+    Выпустить новый refresh-токен (запись добавляется в сессию, коммит — за вызывающим).
+    Сам токен возвращается клиенту и больше нигде не сохраняется.
+    """
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user_id,
+        token_hash=hash_refresh_token(token),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return token
+
+
+def revoke_refresh_tokens(db: Session, user_id: int):
+    """Отозвать все действующие refresh-токены пользователя одним UPDATE (коммит — за вызывающим)."""
+    db.query(RefreshToken).filter(
+        RefreshToken.user_id == user_id,
+        RefreshToken.revoked_at.is_(None)
+    ).update({RefreshToken.revoked_at: datetime.utcnow()}, synchronize_session=False)
+
+
+def issue_token_pair(db: Session, user) -> dict:
+    """Выдать access-токен и новый refresh-токен (с коммитом)."""
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    claims = {"sub": user.username}
+    if current_tenant.get():
+        # Токен действует только в своём филиале
+        claims["tenant"] = current_tenant.get()
+    access_token = create_access_token(data=claims, expires_delta=access_token_expires)
+    refresh_token = issue_refresh_token(db, user.id)
+    db.commit()
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+
 def parse_optional_datetime(value: Optional[str]) -> Optional[datetime]:
     """
     Универсальный парсер даты/даты-времени.
@@ -242,6 +842,269 @@ def parse_optional_datetime(value: Optional[str]) -> Optional[datetime]:
         return None
 
 
+def encode_export_cursor(
+    created_at: Optional[datetime], log_id: int, tombstone_id: int, tombstones_seen_at: Optional[datetime]
+) -> str:
+    """
+    Упаковать позицию инкрементального экспорта в непрозрачную строку.
+    Курсор состоит из (created_at, id) последнего выгруженного лога,
+    id последнего выгруженного "надгробия" (удаления) и момента,
+    до которого клиент получил все удаления (по нему видно, не очищены ли уже нужные ему надгробия).
+    """
+    raw = "|".join([
+        created_at.isoformat() if created_at else "",
+        str(log_id),
+        str(tombstone_id),
+        tombstones_seen_at.isoformat() if tombstones_seen_at else "",
+    ])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_export_cursor(cursor: str):
+    """
+    Распаковать курсор экспорта.
+    Пустая строка означает "с самого начала" (клиенту без данных никакие удаления не нужны).
+    Возвращает (created_at, log_id, tombstone_id, tombstones_seen_at) или бросает ValueError;
+    у курсоров старого формата (без последнего поля) tombstones_seen_at = None.
+    """
+    if not cursor:
+        return None, 0, 0, datetime.utcnow()
+    padded = cursor + "=" * (-len(cursor) % 4)
+    parts = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+    if len(parts) == 3:
+        parts.append("")
+    created_raw, log_id, tombstone_id, seen_raw = parts
+    created_at = datetime.fromisoformat(created_raw) if created_raw else None
+    seen_at = datetime.fromisoformat(seen_raw) if seen_raw else None
+    return created_at, int(log_id), int(tombstone_id), seen_at
+
+
+# ==============================
+#   ЗАЩИТА ОТ ПЕРЕБОРА ПАРОЛЕЙ
+# ==============================
+
+class LoginThrottle:
+    """
+    Ограничитель попыток входа: token bucket + прогрессивная задержка после неудач
+    (progressive=False — только token bucket, без задержки).
+    Состояние хранится в памяти процесса в LRU-словаре ограниченного размера.
+    Проверка не обращается к БД и не вызывает bcrypt, поэтому перебор паролей
+    отсекается до любой дорогой работы.
+    """
+
+    def __init__(self, capacity: int, refill_seconds: float, max_keys: int = LOGIN_THROTTLE_MAX_KEYS,
+                 progressive: bool = True):
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.max_keys = max_keys
+        self.progressive = progressive
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key: str, entry: dict):
+        """Подтянуть состояние из общего хранилища (в памяти — ничего не делаем)."""
+
+    def _save(self, key: str, entry: dict):
+        """Сохранить состояние в общее хранилище (в памяти — ничего не делаем)."""
+
+    def _new_entry(self) -> dict:
+        # updated=0: свежая локальная запись всегда уступает сохранённой в общем хранилище
+        return {"tokens": float(self.capacity), "updated": 0.0, "failures": 0, "blocked_until": 0.0}
+
+    def _refill(self, entry: dict, now: float):
+        """Пополнить "ведро" за прошедшее время и забыть неудачи после периода тишины."""
+        elapsed = max(now - entry["updated"], 0.0)
+        entry["tokens"] = min(float(self.capacity), entry["tokens"] + elapsed / self.refill_seconds)
+        if elapsed > LOGIN_THROTTLE_FAILURE_RESET_SECONDS and entry["blocked_until"] <= now:
+            entry["failures"] = 0
+            entry["blocked_until"] = 0.0
+        entry["updated"] = now
+
+    def _entry(self, key: str, now: float) -> dict:
+        entry = self._state.get(key)
+        if entry is None:
+            entry = self._new_entry()
+            self._state[key] = entry
+            if len(self._state) > self.max_keys:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(key)
+        self._load(key, entry)
+        self._refill(entry, now)
+        return entry
+
+    def _update(self, key: str, change):
+        """Пересчитать состояние ключа, применить change(entry, now) и сохранить."""
+        now = time.time()
+        with self._lock:
+            entry = self._entry(key, now)
+            change(entry, now)
+            self._save(key, entry)
+
+    def retry_after(self, key: str) -> float:
+        """Через сколько секунд можно пробовать снова (0 — можно сейчас)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entry(key, now)
+            wait = max(entry["blocked_until"] - now, 0.0)
+            if entry["tokens"] < 1:
+                wait = max(wait, (1 - entry["tokens"]) * self.refill_seconds)
+            return wait
+
+    def consume(self, key: str):
+        """Списать одну попытку."""
+        def change(entry: dict, now: float):
+            entry["tokens"] = max(entry["tokens"] - 1, 0.0)
+        self._update(key, change)
+
+    def record_failure(self, key: str):
+        """Неудачный вход: после нескольких неудач подряд пауза удваивается."""
+        if not self.progressive:
+            return
+
+        def change(entry: dict, now: float):
+            entry["failures"] += 1
+            extra = entry["failures"] - LOGIN_THROTTLE_FREE_FAILURES
+            if extra > 0:
+                delay = min(2 ** (extra - 1), LOGIN_THROTTLE_MAX_DELAY_SECONDS)
+                entry["blocked_until"] = now + delay
+        self._update(key, change)
+
+    def record_success(self, key: str):
+        """Успешный вход сбрасывает счётчик неудач."""
+        def change(entry: dict, now: float):
+            entry["failures"] = 0
+            entry["blocked_until"] = 0.0
+        self._update(key, change)
+
+
+class DatabaseLoginThrottle(LoginThrottle):
+    """
+    Тот же ограничитель, но состояние общее для всех воркеров через таблицу login_throttle_state.
+    Локальная копия остаётся кэшем для проверок; при расхождении побеждает более свежая запись.
+    Изменения пишутся условным UPDATE (compare-and-set по прочитанной строке): если другой
+    воркер успел изменить ключ, пересчёт повторяется, поэтому параллельные неудачи не теряются.
+    bcrypt по-прежнему не вызывается.
+    """
+
+    # Сколько раз повторять пересчёт, если строку ключа одновременно меняют другие воркеры
+    max_retries = 10
+
+    def _load(self, key: str, entry: dict):
+        db = open_session()
+        try:
+            row = db.get(LoginThrottleState, key)
+            if row is not None and row.updated > entry["updated"]:
+                entry.update(tokens=row.tokens, updated=row.updated,
+                             failures=row.failures, blocked_until=row.blocked_until)
+        finally:
+            db.close()
+
+    def _update(self, key: str, change):
+        now = time.time()
+        with self._lock:
+            for _ in range(self.max_retries):
+                db = open_session()
+                try:
+                    row = db.get(LoginThrottleState, key)
+                    if row is None:
+                        entry = self._new_entry()
+                    else:
+                        entry = {"tokens": row.tokens, "updated": row.updated,
+                                 "failures": row.failures, "blocked_until": row.blocked_until}
+                    seen = dict(entry)
+                    self._refill(entry, now)
+                    change(entry, now)
+                    if row is None:
+                        db.add(LoginThrottleState(key=key, **entry))
+                        db.commit()
+                    else:
+                        # Строка не менялась с момента чтения — иначе пересчитываем заново
+                        updated = db.query(LoginThrottleState).filter(
+                            LoginThrottleState.key == key,
+                            LoginThrottleState.updated == seen["updated"],
+                            LoginThrottleState.tokens == seen["tokens"],
+                            LoginThrottleState.failures == seen["failures"],
+                            LoginThrottleState.blocked_until == seen["blocked_until"],
+                        ).update(entry, synchronize_session=False)
+                        db.commit()
+                        if not updated:
+                            continue
+                except IntegrityError:
+                    # Ключ одновременно создал другой воркер
+                    db.rollback()
+                    continue
+                finally:
+                    db.close()
+                self._state[key] = entry
+                self._state.move_to_end(key)
+                if len(self._state) > self.max_keys:
+                    self._state.popitem(last=False)
+                return
+            print(f"Login throttle: gave up updating {key} after {self.max_retries} conflicts")
+
+
+_throttle_class = DatabaseLoginThrottle if LOGIN_THROTTLE_SHARED else LoginThrottle
+user_login_throttle = _throttle_class(LOGIN_THROTTLE_USER_BURST, LOGIN_THROTTLE_USER_REFILL_SECONDS)
+# Для IP — только ровный лимит частоты: за одним адресом (NAT клиники, прокси) сидят многие
+# сотрудники, и прогрессивная задержка от чужих опечаток не должна блокировать всех
+ip_login_throttle = _throttle_class(LOGIN_THROTTLE_IP_BURST, LOGIN_THROTTLE_IP_REFILL_SECONDS, progressive=False)
+
+
+def is_trusted_proxy(host: Optional[str]) -> bool:
+    """Пришёл ли запрос с адреса из TRUSTED_PROXY_NETWORKS."""
+    try:
+        address = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in TRUSTED_PROXY_NETWORKS)
+
+
+def client_ip(request: Request) -> str:
+    """IP клиента (за доверенным прокси — из X-Real-IP)."""
+    peer = request.client.host if request.client else None
+    if TRUST_PROXY_HEADERS and request.headers.get("x-real-ip") and is_trusted_proxy(peer):
+        return request.headers["x-real-ip"]
+    return peer or "unknown"
+
+
+def login_throttle_keys(request: Request, username: str):
+    return (
+        (user_login_throttle, f"{current_tenant.get() or ''}:user:{username.strip().lower()}"),
+        (ip_login_throttle, f"ip:{client_ip(request)}"),
+    )
+
+
+def check_login_throttle(request: Request, username: str):
+    """
+    Пропустить попытку входа или сразу ответить 429 — до поиска пользователя и bcrypt.
+    Попытка списывается и с логина, и с IP.
+    """
+    keys = login_throttle_keys(request, username)
+    wait = max(throttle.retry_after(key) for throttle, key in keys)
+    if wait > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts. Try again later.",
+            headers={"Retry-After": str(int(wait) + 1)},
+        )
+    for throttle, key in keys:
+        throttle.consume(key)
+
+
+def record_login_result(request: Request, username: str, success: bool):
+    """
+    Учесть результат входа. Неудачи копятся только у логина (у IP — ровный лимит без задержки),
+    и успех сбрасывает их тоже только для логина: иначе один рабочий аккаунт
+    позволял бы "обнулять" лимит своего IP.
+    """
+    for throttle, key in login_throttle_keys(request, username):
+        if not success:
+            throttle.record_failure(key)
+        elif throttle is user_login_throttle:
+            throttle.record_success(key)
+
+
 # =====================
 #   Pydantic-схемы (API)
 # =====================
@@ -267,9 +1130,15 @@ class UserLogin(BaseModel):
 
 
 class Token(BaseModel):
-    """Ответ при успешной аутентификации (JWT-токен)."""
+    """Ответ при успешной аутентификации (JWT-токен и refresh-токен для его продления)."""
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    """Данные для /api/token/refresh и /api/logout."""
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -289,12 +1158,26 @@ class UserResponse(BaseModel):
     is_active: bool
     is_admin: bool
     created_at: datetime
+    version: int
     
     class Config:
         # Позволяет создавать модель напрямую из ORM-объекта SQLAlchemy
         from_attributes = True
 
 
+class UserPatch(BaseModel):
+    """Частичное обновление пользователя (PATCH): передаются только изменённые поля."""
+    username: Optional[str] = None
+    password: Optional[str] = None
+    name: Optional[str] = None
+    position: Optional[str] = None
+    phone: Optional[str] = None
+    telegram_id: Optional[str] = None
+    email: Optional[str] = None
+    is_active: Optional[bool] = None
+    is_admin: Optional[bool] = None
+
+
 class ProfileUpdate(BaseModel):
     """Схема для обновления своего профиля."""
     name: str
@@ -324,7 +1207,7 @@ class ShiftResponse(BaseModel):
     start_time: str
     end_time: str
     shift_type: str
-    user_id: int
+    user_id: Optional[int]
     user_name: str
     position: str
     patient_id: Optional[int]
@@ -333,15 +1216,91 @@ class ShiftResponse(BaseModel):
     notes: Optional[str]
     created_at: datetime
     updated_at: datetime
+    version: int
 
     class Config:
         from_attributes = True
 
 
+class ShiftPatch(BaseModel):
+    """Частичное обновление смены (PATCH): передаются только изменённые поля."""
+    date: Optional[str] = None
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    shift_type: Optional[str] = None
+    user_id: Optional[int] = None
+    patient_id: Optional[int] = None
+    status: Optional[str] = Field(None, pattern="^(scheduled|completed|cancelled)$")
+    notes: Optional[str] = None
+
+
+class ShiftStatusTransition(BaseModel):
+    """Массовая смена статуса: по списку id или по дате (и сотруднику)."""
+    status: str
+    ids: Optional[List[int]] = None
+    date: Optional[str] = Field(None, pattern=r"^\d{4}-\d{2}-\d{2}$")
+    user_id: Optional[int] = None
+
+
+class ShiftStatusRejection(BaseModel):
+    """
+    Смена, статус которой не изменён (status — текущий, None — смены нет).
+    reason: not_found (404), invalid_transition (409) или not_ended (409 — завершить можно только прошедшую смену).
+    """
+    id: int
+    status: Optional[str]
+    reason: str
+    status_code: int
+
+
+class ShiftStatusTransitionResponse(BaseModel):
+    """Результат массовой смены статуса."""
+    status: str
+    updated: List[int]
+    rejected: List[ShiftStatusRejection]
+
+
+class ShiftCalendarBucket(BaseModel):
+    """Группа календаря: день, сотрудник или тип приёма."""
+    key: str
+    label: Optional[str] = None
+    count: int          # приёмов в группе (включая отменённые)
+    cancelled: int      # из них отменённых
+    hours: float        # запланированные часы без отменённых
+
+
+class ShiftCalendarResponse(BaseModel):
+    """Агрегаты расписания за период."""
+    group_by: str
+    buckets: List[ShiftCalendarBucket]
+    total_count: int
+    total_hours: float
+
+
+class AvailabilitySlot(BaseModel):
+    """Свободное окно в расписании сотрудника."""
+    date: str
+    start_time: str
+    end_time: str
+
+
+class AvailabilityResponse(BaseModel):
+    """Первые свободные окна нужной длительности."""
+    user_id: int
+    duration: int
+    slots: List[AvailabilitySlot]
+
+
 # ----- Пациенты -----
 
-class PatientCreate(BaseModel):
-    """Данные для создания пациента."""
+class PatientTimelineResponse(BaseModel):
+    """Страница истории приёмов пациента (новые сверху)."""
+    items: List[ShiftResponse]
+    next_cursor: Optional[str] = None
+
+
+class PatientFields(BaseModel):
+    """Поля карточки пациента, которые редактируются вручную."""
     full_name: str
     birth_date: Optional[str] = None
     gender: Optional[str] = None
@@ -354,13 +1313,27 @@ class PatientCreate(BaseModel):
     chronic_conditions: Optional[str] = None
     medications: Optional[str] = None
     attending_physician: Optional[str] = None
-    last_visit: Optional[str] = None
     notes: Optional[str] = None
 
 
-class PatientUpdate(PatientCreate):
-    """Для обновления пациента используем те же поля, что и для создания."""
-    pass
+class PatientCreate(PatientFields):
+    """Данные для создания пациента (last_visit — при переносе карточки из другой системы)."""
+    last_visit: Optional[str] = None
+
+
+class PatientUpdate(PatientFields):
+    """
+    Полное обновление пациента (PUT): те же поля, что и при создании, кроме last_visit —
+    его ведут триггеры по завершённым приёмам, и ручное значение они бы уже не исправили.
+    """
+
+
+class PatientPatch(PatientFields):
+    """
+    Частичное обновление пациента (PATCH): передаются только изменённые поля.
+    last_visit сюда не входит — его ведут триггеры по завершённым приёмам.
+    """
+    full_name: Optional[str] = None
 
 
 class PatientResponse(BaseModel):
@@ -382,6 +1355,7 @@ class PatientResponse(BaseModel):
     notes: Optional[str]
     created_at: datetime
     updated_at: datetime
+    version: int
 
     class Config:
         from_attributes = True
@@ -404,6 +1378,39 @@ class DashboardSummary(BaseModel):
     recent_patients: List[PatientResponse]
 
 
+# ----- Пакетные запросы -----
+
+class BatchItem(BaseModel):
+    """Один подзапрос пакета: метод, путь с query-строкой и (для записи) JSON-тело."""
+    id: Optional[str] = None
+    method: str = Field("GET", pattern="^(GET|POST|PUT|PATCH|DELETE)$")
+    path: str
+    body: Optional[Union[dict, list]] = None
+    headers: Dict[str, str] = {}
+
+
+class BatchRequest(BaseModel):
+    """Пакет подзапросов; выполняются по порядку в одной сессии БД."""
+    requests: List[BatchItem]
+
+
+class BatchResult(BaseModel):
+    """Результат подзапроса: HTTP-статус, заголовки и тело ответа."""
+    id: Optional[str] = None
+    status: int
+    headers: Dict[str, str] = {}
+    body: Optional[Union[dict, list, str, int, float, bool]] = None
+
+
+class BatchResponse(BaseModel):
+    """
+    Результаты подзапросов в том же порядке, что и в запросе.
+    consistent — пакет только из чтений и все они видели один снимок данных.
+    """
+    results: List[BatchResult]
+    consistent: bool = False
+
+
 # ----- Активы -----
 
 class AssetCreate(BaseModel):
@@ -422,7 +1429,7 @@ class AssetResponse(BaseModel):
     asset_type: str
     status: str
     created_at: datetime
-    updated_at: datetime
+    updated_at: Optional[datetime]
     
     class Config:
         from_attributes = True
@@ -436,6 +1443,14 @@ class AssetUpdate(BaseModel):
     status: Optional[str] = None
 
 
+class AssetPageResponse(BaseModel):
+    """Страница активов и счётчики по фасетам (типам и статусам)."""
+    items: List[AssetResponse]
+    total: int
+    facets: Dict[str, Dict[str, int]]
+    next_cursor: Optional[str] = None
+
+
 # ----- Передачи смен -----
 
 class HandoverCreate(BaseModel):
@@ -454,6 +1469,15 @@ class HandoverResponse(BaseModel):
     handover_notes: str
     assets: List[AssetResponse]
     created_at: datetime
+    version: int
+
+
+class HandoverPatch(BaseModel):
+    """Частичное обновление передачи смены (PATCH); asset_ids, если передан, заменяет список активов."""
+    from_shift_id: Optional[int] = None
+    to_shift_id: Optional[int] = None
+    handover_notes: Optional[str] = None
+    asset_ids: Optional[List[int]] = None
 
 
 # ----- Экспорт логов передач -----
@@ -515,11 +1539,436 @@ class HandoverLogResponse(BaseModel):
         from_attributes = True
 
 
-# =======================
-#   СОЗДАНИЕ ТАБЛИЦ В БД
-# =======================
+# ----- Журнал аудита -----
 
-Base.metadata.create_all(bind=engine)
+class AuditEntryResponse(BaseModel):
+    """Одна запись журнала аудита."""
+    id: int
+    entity: str
+    entity_id: Optional[int] = None
+    action: str
+    changes: Optional[dict] = None
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    created_at: datetime
+
+
+class AuditPageResponse(BaseModel):
+    """Страница журнала аудита (новые сверху) и курсор следующей страницы."""
+    items: List[AuditEntryResponse]
+    next_cursor: Optional[str] = None
+
+
+# ----- Выборочные поля (?fields=...) -----
+
+def partial_schema(schema):
+    """
+    Облегчённая схема ответа для списков с выбранными полями (?fields=id,full_name):
+    те же поля, что у полной схемы, но все необязательны.
+    """
+    fields = {name: (Optional[field.annotation], None) for name, field in schema.model_fields.items()}
+    return create_model(f"{schema.__name__}Fields", **fields)
+
+
+UserFieldsResponse = partial_schema(UserResponse)
+ShiftFieldsResponse = partial_schema(ShiftResponse)
+PatientFieldsResponse = partial_schema(PatientResponse)
+AssetFieldsResponse = partial_schema(AssetResponse)
+
+
+def parse_fields(fields: Optional[str], schema) -> Optional[List[str]]:
+    """
+    Разобрать параметр fields ("id,full_name") по полям схемы ответа.
+    id добавляется всегда; неизвестные поля — ошибка 400. None — полный ответ.
+    """
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in schema.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(["id"] + names))
+
+
+def fetch_fields(query, model, names: Optional[List[str]]):
+    """
+    Выполнить запрос списка.
+    С выбранными полями SELECT содержит только эти колонки (большие Text-поля не читаются
+    и ORM-объекты не создаются), результат — список словарей.
+    """
+    if names is None:
+        return query.all()
+    return [row._asdict() for row in query.with_entities(*[getattr(model, name) for name in names]).all()]
+
+
+# ==================
+#   КЭШ ЗАПРОСОВ
+# ==================
+
+# Где хранить результаты кэшируемых запросов: memory — в памяти процесса (LRU),
+# redis — во внешнем процессе по протоколу Redis (общий для всех воркеров), off — без кэша
+QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory").lower()
+# Адрес для QUERY_CACHE_BACKEND=redis: redis://[:пароль@]хост:порт/номер_базы
+QUERY_CACHE_URL = os.getenv("QUERY_CACHE_URL", "redis://localhost:6379/0")
+
+# Сколько результатов держать в памяти (самые давние вытесняются) и сколько секунд они живут.
+# TTL ограничивает устаревание, если инвалидация не дошла (например, запись в базу мимо ORM)
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1000"))
+QUERY_CACHE_TTL_SECONDS = int(os.getenv("QUERY_CACHE_TTL_SECONDS", "60"))
+
+# Сколько секунд запрос ждёт, пока такой же запрос в другом потоке заполнит кэш
+QUERY_CACHE_WAIT_SECONDS = float(os.getenv("QUERY_CACHE_WAIT_SECONDS", "5"))
+
+# Таймаут соединения и ответа внешнего кэша, секунд: недоступный кэш не должен тормозить API
+QUERY_CACHE_SOCKET_TIMEOUT = float(os.getenv("QUERY_CACHE_SOCKET_TIMEOUT", "0.5"))
+
+
+class LRUCacheBackend:
+    """
+    Кэш в памяти процесса: не больше max_entries записей, давно не читанные вытесняются.
+    Версии тегов хранятся отдельно и не вытесняются: иначе после вытеснения версия
+    "обнулилась" бы и старая запись снова стала бы верной.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()  # ключ -> (истекает в, значение)
+        self._versions = {}            # ключ тега -> версия
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> list:
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            for key in keys:
+                if key in self._versions:
+                    result.append(self._versions[key])
+                    continue
+                item = self._entries.get(key)
+                if item is not None and item[0] < now:
+                    del self._entries[key]
+                    item = None
+                if item is not None:
+                    self._entries.move_to_end(key)
+                result.append(item[1] if item is not None else None)
+        return result
+
+    def set(self, key: str, value, ttl: int):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "tags": len(self._versions), "evictions": self.evictions}
+
+
+class RespCacheBackend:
+    """
+    Кэш во внешнем процессе по протоколу Redis (RESP2).
+    Нужны только MGET, SET ... PX и INCR, поэтому подойдёт Redis, Valkey, KeyDB
+    или небольшая заглушка в тестах. Значения хранятся в JSON.
+    У каждого потока своё соединение; после ошибки оно закрывается и открывается заново при следующем запросе.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, timeout: float):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+            try:
+                if self.password:
+                    self._call("AUTH", self.password)
+                if self.db:
+                    self._call("SELECT", str(self.db))
+            except Exception:
+                # -ERR на AUTH/SELECT: соединение без входа или не в той базе повторно не используем
+                self._reset()
+                raise
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def _call(self, *args: str):
+        sock, reader = self._connection()
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg.encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        try:
+            sock.sendall(b"".join(parts))
+            return self._read(reader)
+        except (OSError, ValueError):
+            self._reset()
+            raise
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Cache server closed the connection")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(f"Cache server error: {payload.decode('utf-8', 'replace')}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            return None if size < 0 else reader.read(size + 2)[:-2]
+        if kind == b"*":
+            size = int(payload)
+            return None if size < 0 else [self._read(reader) for _ in range(size)]
+        raise ValueError(f"Unexpected cache server reply: {line[:20]!r}")
+
+    def get_many(self, keys: List[str]) -> list:
+        return [json.loads(value) if value is not None else None for value in self._call("MGET", *keys)]
+
+    def set(self, key: str, value, ttl: int):
+        self._call("SET", key, json.dumps(value, ensure_ascii=False), "PX", str(int(ttl * 1000)))
+
+    def incr(self, key: str) -> int:
+        return self._call("INCR", key)
+
+    def stats(self) -> dict:
+        return {"url": f"redis://{self.host}:{self.port}/{self.db}"}
+
+
+def make_query_cache_backend():
+    """Бэкенд кэша по QUERY_CACHE_BACKEND (None — кэш выключен)."""
+    if QUERY_CACHE_BACKEND == "off":
+        return None
+    if QUERY_CACHE_BACKEND == "redis":
+        return RespCacheBackend(QUERY_CACHE_URL, QUERY_CACHE_SOCKET_TIMEOUT)
+    if QUERY_CACHE_BACKEND == "memory":
+        return LRUCacheBackend(QUERY_CACHE_MAX_ENTRIES)
+    raise RuntimeError(f"Unknown QUERY_CACHE_BACKEND: {QUERY_CACHE_BACKEND}")
+
+
+query_cache_backend = make_query_cache_backend()
+
+# Кэши по имени (для статистики) и счётчики инвалидации по филиалам
+QUERY_CACHES = {}
+query_cache_invalidation = defaultdict(lambda: {"invalidations": 0, "errors": 0})
+
+
+def cache_tag_key(tenant: Optional[str], tag: str) -> str:
+    """Ключ версии тега. Теги — имена таблиц; у каждого филиала свои версии."""
+    return f"qc:{tenant or '-'}:tag:{tag}"
+
+
+class QueryCache:
+    """
+    Кэш одной функции запроса.
+    Запись хранит результат и версии своих тегов на момент чтения из базы;
+    коммит, изменивший таблицу, увеличивает версию её тега, и все записи с этим тегом
+    перестают совпадать — удалять их по одной не нужно.
+    Одновременные промахи по одному ключу в пределах процесса выполняют запрос
+    один раз: остальные ждут результат первого (защита от лавины запросов).
+    Счётчики ведутся отдельно по филиалам.
+    """
+
+    COUNTERS = ("hits", "misses", "waits", "stores", "errors", "bypasses")
+
+    def __init__(self, name: str, tags: tuple, ttl: int):
+        self.name = name
+        self.tags = tags
+        self.ttl = ttl
+        self.counters = {}  # филиал -> {счётчик: значение}
+        self._inflight = {}  # ключ -> threading.Event
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str):
+        tenant = current_tenant.get()
+        with self._lock:
+            counters = self.counters.setdefault(tenant, dict.fromkeys(self.COUNTERS, 0))
+            counters[counter] += 1
+
+    def _lookup(self, key: str, tag_keys: List[str]):
+        """(результат или None, текущие версии тегов)."""
+        values = query_cache_backend.get_many([key] + tag_keys)
+        versions = [value or 0 for value in values[1:]]
+        entry = values[0]
+        if entry is not None and entry["tags"] == versions:
+            return entry, versions
+        return None, versions
+
+    def get_or_compute(self, args: tuple, compute):
+        if query_cache_backend is None:
+            return compute()
+        tenant = current_tenant.get()
+        digest = hashlib.sha1(json.dumps(args, default=str).encode("utf-8")).hexdigest()
+        key = f"qc:{tenant or '-'}:{self.name}:{digest}"
+        tag_keys = [cache_tag_key(tenant, tag) for tag in self.tags]
+        try:
+            entry, versions = self._lookup(key, tag_keys)
+        except Exception as e:
+            print(f"Query cache {self.name} unavailable: {e}")
+            self._count("errors")
+            return compute()
+        if entry is not None:
+            self._count("hits")
+            return entry["value"]
+
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            self._count("waits")
+            event.wait(QUERY_CACHE_WAIT_SECONDS)
+            try:
+                entry, versions = self._lookup(key, tag_keys)
+            except Exception:
+                entry = None
+            if entry is not None:
+                self._count("hits")
+                return entry["value"]
+            self._count("misses")
+            return compute()
+
+        self._count("misses")
+        try:
+            value = compute()
+            try:
+                query_cache_backend.set(key, {"value": value, "tags": versions}, self.ttl)
+                self._count("stores")
+            except Exception as e:
+                print(f"Query cache {self.name} store failed: {e}")
+                self._count("errors")
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def stats(self, tenant: Optional[str]) -> dict:
+        with self._lock:
+            counters = dict(self.counters.get(tenant) or dict.fromkeys(self.COUNTERS, 0))
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "tags": list(self.tags),
+            "ttl_seconds": self.ttl,
+            "hit_ratio": round(counters["hits"] / lookups, 3) if lookups else None,
+        }
+
+
+def query_cache(name: str, tags: tuple, ttl: Optional[int] = None):
+    """
+    Декоратор функции запроса f(db, *args).
+    Ключ кэша — имя и позиционные аргументы кроме db (они должны сериализоваться в JSON),
+    результат тоже должен быть JSON-совместимым (см. cacheable_rows), чтобы одинаково
+    храниться в памяти и во внешнем кэше. tags — таблицы, от которых зависит результат.
+    Исходная функция без кэша доступна как f.uncached.
+    """
+    def decorator(func):
+        cache = QUERY_CACHES[name] = QueryCache(name, tuple(tags), ttl or QUERY_CACHE_TTL_SECONDS)
+
+        @functools.wraps(func)
+        def wrapper(db: Session, *args):
+            if db.info.get("query_cache_bypass"):
+                # Сессия читает в своей транзакции (снимок пакета): её строки могут быть старше
+                # текущих версий тегов, поэтому ни отдавать из кэша, ни класть в него нельзя
+                cache._count("bypasses")
+                return func(db, *args)
+            return cache.get_or_compute(args, lambda: func(db, *args))
+
+        wrapper.uncached = func
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def cacheable_rows(rows, schema, names: Optional[List[str]] = None) -> List[dict]:
+    """Строки ответа (ORM-объекты, Row или словари fetch_fields) в виде JSON-совместимых словарей."""
+    if names is not None:
+        return jsonable_encoder([row if isinstance(row, dict) else row._asdict() for row in rows])
+    return [schema.model_validate(row, from_attributes=True).model_dump(mode="json") for row in rows]
+
+
+def invalidate_cache_tags(tenant: Optional[str], tags):
+    """Увеличить версии тегов: записи кэша, прочитанные до этого, больше не отдаются."""
+    if query_cache_backend is None:
+        return
+    counters = query_cache_invalidation[tenant]
+    for tag in tags:
+        try:
+            query_cache_backend.incr(cache_tag_key(tenant, tag))
+            counters["invalidations"] += 1
+        except Exception as e:
+            # Запись с тегом доживёт до TTL — это предел устаревания при недоступном кэше
+            print(f"Query cache invalidation failed for {tag}: {e}")
+            counters["errors"] += 1
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def collect_cache_tags_from_flush(session, flush_context):
+    """Таблицы объектов, которые сессия вставила, изменила или удалила."""
+    tags = session.info.setdefault("cache_tags", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        tags.add(obj.__tablename__)
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def collect_cache_tags_from_statement(execute_state):
+    """Таблицы массовых insert/update/delete (query.update(), db.execute(update(...)) и т.п.)."""
+    if execute_state.is_insert or execute_state.is_update or execute_state.is_delete:
+        table = getattr(execute_state.statement, "table", None)
+        if table is not None:
+            execute_state.session.info.setdefault("cache_tags", set()).add(table.name)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def invalidate_committed_cache_tags(session):
+    """
+    После коммита изменённые таблицы инвалидируются в кэше текущего филиала.
+    Таблицы, от которых не зависит ни один кэш, пропускаются (лишний INCR во внешний кэш).
+    """
+    tags = session.info.pop("cache_tags", None)
+    if tags:
+        used = {tag for cache in QUERY_CACHES.values() for tag in cache.tags}
+        invalidate_cache_tags(current_tenant.get(), sorted(tags & used))
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_cache_tags(session):
+    """Откаченные изменения ничего не инвалидируют."""
+    session.info.pop("cache_tags", None)
+
+
+# =======================
+#   СОЗДАНИЕ ТАБЛИЦ В БД
+# =======================
+
+Base.metadata.create_all(bind=engine)
 
 
 # ====================
@@ -529,6 +1978,494 @@ Base.metadata.create_all(bind=engine)
 # Основное приложение FastAPI
 app = FastAPI(title="Clinic Registry API", version="2.0.0")
 
+# ============================
+#   ИДЕМПОТЕНТНОСТЬ ЗАПРОСОВ
+# ============================
+
+# POST-эндпоинты, повтор которых создаёт дубликаты: для них учитывается заголовок Idempotency-Key
+IDEMPOTENT_PATHS = {"/api/shifts/", "/api/shifts/bulk", "/api/handovers/"}
+
+# Сколько часов хранится ответ по ключу
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+
+# Сколько секунд повторный запрос ждёт, пока выполнится первый с тем же ключом
+IDEMPOTENCY_WAIT_SECONDS = int(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+
+# Через сколько секунд незавершённый захват считается брошенным (воркер упал посреди запроса)
+IDEMPOTENCY_LOCK_SECONDS = 300
+
+# Ошибки, которые повтор с тем же телом гарантированно получит снова, — их ответ сохраняется.
+# Остальные 4xx (401, 403, 409, 412, 429) зависят от токена, версии или нагрузки:
+# ключ освобождается, и повтор (например, после обновления токена) выполнится заново
+IDEMPOTENCY_STORED_ERRORS = {400, 404, 422}
+
+
+def idempotency_response_is_final(status_code: int) -> bool:
+    """Сохранять ли ответ по ключу: успешные и детерминированные ошибки — да, остальные — нет."""
+    return status_code < 300 or status_code in IDEMPOTENCY_STORED_ERRORS
+
+
+def idempotency_principal(request: Request) -> str:
+    """
+    Область действия ключа: филиал и id пользователя из действующего токена.
+    Без токена или с недействительным токеном — "<филиал>:anonymous"
+    (такой запрос либо получит 401, который не сохраняется, либо не требует входа).
+    """
+    tenant = current_tenant.get() or ""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return f"{tenant}:anonymous"
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return f"{tenant}:anonymous"
+    username = payload.get("sub")
+    if not username or payload.get("tenant") != current_tenant.get():
+        return f"{tenant}:anonymous"
+    db = open_session()
+    try:
+        user_id = db.execute(select(User.id).where(User.username == username)).scalar()
+    finally:
+        db.close()
+    return f"{tenant}:{user_id}" if user_id is not None else f"{tenant}:anonymous"
+
+
+def idempotency_scope(db: Session, principal: str, key: str, method: str, path: str):
+    """Запись ключа этого вызывающего для данного метода и пути."""
+    return db.query(IdempotencyRecord).filter(
+        IdempotencyRecord.principal == principal,
+        IdempotencyRecord.key == key,
+        IdempotencyRecord.method == method,
+        IdempotencyRecord.path == path,
+    )
+
+
+def claim_idempotency_key(principal: str, key: str, method: str, path: str, request_hash: str):
+    """
+    Попытаться захватить ключ.
+    Возвращает ("claimed", None) — выполняем запрос сами; ("replay", запись) — ответ уже сохранён;
+    ("pending", None) — первый запрос ещё выполняется; ("mismatch", None) — ключ использован с другим телом.
+    Захват — это INSERT в уникальный индекс, поэтому из двух одновременных запросов выигрывает ровно один.
+    """
+    db = open_session()
+    try:
+        db.add(IdempotencyRecord(principal=principal, key=key, method=method, path=path, request_hash=request_hash))
+        try:
+            db.commit()
+            return "claimed", None
+        except IntegrityError:
+            db.rollback()
+        record = idempotency_scope(db, principal, key, method, path).first()
+        if record is None:
+            # Ключ успели освободить между INSERT и SELECT — пробуем снова
+            return "pending", None
+        if record.request_hash != request_hash:
+            return "mismatch", None
+        if record.status_code is not None:
+            return "replay", record
+        stale_before = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        if record.created_at < stale_before:
+            # Брошенный захват перехватываем условным UPDATE — снова выигрывает только один
+            taken = db.query(IdempotencyRecord).filter(
+                IdempotencyRecord.id == record.id,
+                IdempotencyRecord.status_code.is_(None),
+                IdempotencyRecord.created_at == record.created_at,
+            ).update({IdempotencyRecord.created_at: datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+            if taken:
+                return "claimed", None
+        return "pending", None
+    finally:
+        db.close()
+
+
+def finish_idempotency_key(
+    principal: str, key: str, method: str, path: str, status_code: int, body: bytes, content_type: Optional[str]
+):
+    """
+    Сохранить ответ по захваченному ключу.
+    Ответы 5xx и недетерминированные 4xx (см. IDEMPOTENCY_STORED_ERRORS) не сохраняются:
+    ключ освобождается, и повтор выполнит запрос заново.
+    """
+    db = open_session()
+    try:
+        scope = idempotency_scope(db, principal, key, method, path)
+        if not idempotency_response_is_final(status_code):
+            scope.delete(synchronize_session=False)
+        else:
+            scope.update({
+                IdempotencyRecord.status_code: status_code,
+                IdempotencyRecord.response_body: body.decode("utf-8"),
+                IdempotencyRecord.content_type: content_type,
+            }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    """
+    Повтор POST с тем же Idempotency-Key получает сохранённый ответ первого запроса
+    (с заголовком Idempotent-Replayed: true), а запись в базу не выполняется второй раз.
+    Одновременный дубликат ждёт завершения первого запроса, а не выполняется параллельно.
+    Ключ действует в пределах вызывающего: другой пользователь с тем же ключом выполнит свой запрос.
+    """
+    key = request.headers.get("Idempotency-Key")
+    if request.method != "POST" or not key or request.url.path not in IDEMPOTENT_PATHS:
+        return await call_next(request)
+    if len(key) > 255:
+        return JSONResponse(status_code=400, content={"detail": "Idempotency-Key is too long"})
+
+    method, path = request.method, request.url.path
+    principal = await run_in_threadpool(idempotency_principal, request)
+    request_hash = hashlib.sha256(await request.body()).hexdigest()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        state, record = await run_in_threadpool(claim_idempotency_key, principal, key, method, path, request_hash)
+        if state == "claimed":
+            break
+        if state == "replay":
+            return Response(
+                content=record.response_body,
+                status_code=record.status_code,
+                media_type=record.content_type,
+                headers={"Idempotent-Replayed": "true"},
+            )
+        if state == "mismatch":
+            return JSONResponse(
+                status_code=422,
+                content={"detail": "Idempotency-Key was already used with a different request body"},
+            )
+        if time.monotonic() >= deadline:
+            return JSONResponse(
+                status_code=409,
+                content={"detail": "A request with this Idempotency-Key is still in progress"},
+            )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+    try:
+        response = await call_next(request)
+        body = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await run_in_threadpool(finish_idempotency_key, principal, key, method, path, 500, b"", None)
+        raise
+    await run_in_threadpool(
+        finish_idempotency_key, principal, key, method, path,
+        response.status_code, body, response.headers.get("content-type"),
+    )
+    return Response(content=body, status_code=response.status_code, headers=dict(response.headers))
+
+
+def purge_idempotency_keys(db: Session) -> int:
+    """Удалить ключи идемпотентности старше IDEMPOTENCY_TTL_HOURS."""
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    deleted = db.query(IdempotencyRecord).filter(
+        IdempotencyRecord.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+# ===========================
+#   ПРОФИЛИРОВАНИЕ ЗАПРОСОВ
+# ===========================
+
+# Заголовок, включающий профилирование одного запроса (учитывается только для администраторов)
+PROFILE_HEADER = "X-Profile"
+
+# Интервал выборки стека, миллисекунд
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "2"))
+
+# Сколько последних профилей хранить в памяти (старые вытесняются)
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+
+# Ограничения одного профиля: длительность выборки и число различных стеков и SQL-запросов
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "5000"))
+PROFILE_MAX_STATEMENTS = int(os.getenv("PROFILE_MAX_STATEMENTS", "200"))
+
+# Функции, время в которых считается сериализацией ответа (файл, функция)
+PROFILE_SERIALIZATION_FRAMES = {
+    ("routing.py", "serialize_response"),
+    ("encoders.py", "jsonable_encoder"),
+    ("responses.py", "render"),
+}
+
+# Профиль текущего запроса (None — запрос не профилируется)
+current_profile = ContextVar("current_profile", default=None)
+
+# Последние профили
+profile_buffer = deque(maxlen=PROFILE_BUFFER_SIZE)
+
+
+class RequestProfile:
+    """
+    Профиль одного запроса.
+    Отдельный поток раз в PROFILE_SAMPLE_INTERVAL_MS снимает стек потока event loop
+    (в нём выполняются async-эндпоинты) и считает одинаковые стеки — это формат folded
+    для flamegraph.pl и speedscope. Время SQL измеряется точно, по событиям движка
+    (они подключаются только на время профилируемых запросов).
+    В выборку попадает всё, что выполняется в потоке event loop до конца запроса,
+    в том числе код параллельных запросов; код в пуле потоков виден как ожидание.
+    """
+
+    def __init__(self, method: str, path: str, thread_id: int):
+        self.id = secrets.token_hex(8)
+        self.method = method
+        self.path = path
+        self.tenant = current_tenant.get()
+        self.thread_id = thread_id
+        self.started_at = datetime.utcnow()
+        self.duration_ms = 0.0
+        self.status_code = None
+        self.samples = 0
+        self.serialization_samples = 0
+        self.stacks = {}      # "кадр;кадр;кадр" -> число выборок
+        self.sql_ms = 0.0
+        self.sql_count = 0
+        self.statements = {}  # текст запроса -> [число, мс]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = 0.0
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample_loop, name=f"profile-{self.id}", daemon=True)
+        self._thread.start()
+
+    def stop(self, status_code: int):
+        """Остановить выборку (повторный вызов ничего не меняет)."""
+        if self._stop.is_set():
+            return
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+        self.status_code = status_code
+        self._stop.set()
+        self._thread.join()
+
+    def _sample_loop(self):
+        interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record_stack(frame)
+
+    def _record_stack(self, frame):
+        names = []
+        serialization = False
+        while frame is not None and len(names) < 128:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            serialization = serialization or (filename, code.co_name) in PROFILE_SERIALIZATION_FRAMES
+            names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ","))
+            frame = frame.f_back
+        stack = ";".join(reversed(names))
+        self.samples += 1
+        self.serialization_samples += serialization
+        if stack in self.stacks or len(self.stacks) < PROFILE_MAX_STACKS:
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        else:
+            self.stacks["(other stacks)"] = self.stacks.get("(other stacks)", 0) + 1
+
+    def add_sql(self, statement: str, seconds: float):
+        with self._lock:
+            self.sql_ms += seconds * 1000
+            self.sql_count += 1
+            key = " ".join(statement.split())[:500]
+            if key in self.statements or len(self.statements) < PROFILE_MAX_STATEMENTS:
+                entry = self.statements.setdefault(key, [0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds * 1000
+
+    @property
+    def serialization_ms(self) -> float:
+        """Оценка по выборке: доля стеков внутри сериализации ответа от длительности запроса."""
+        return self.duration_ms * self.serialization_samples / self.samples if self.samples else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms, 2),
+            "sql_ms": round(self.sql_ms, 2),
+            "sql_count": self.sql_count,
+            "serialization_ms": round(self.serialization_ms, 2),
+            "samples": self.samples,
+        }
+
+    def details(self, top: int = 20) -> dict:
+        statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {
+            **self.summary(),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_MS,
+            "top_sql": [{"statement": sql, "count": count, "ms": round(ms, 2)} for sql, (count, ms) in statements],
+        }
+
+    def folded(self) -> str:
+        """Стеки в формате folded: "корень;...;лист число_выборок" — по строке на стек."""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def profile_sql_start(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None and context is not None:
+        # Время начала — в контексте выполнения: он живёт ровно один запрос SQL,
+        # поэтому после ошибки на соединении не остаётся "висящих" отметок
+        context.profile_started = time.perf_counter()
+
+
+def profile_sql_end(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    started = getattr(context, "profile_started", None)
+    if profile is not None and started is not None:
+        profile.add_sql(statement, time.perf_counter() - started)
+
+
+# Сколько запросов профилируется сейчас: обработчики событий SQL висят на движках
+# только пока он больше нуля, остальные запросы их не вызывают вовсе
+_profiled_requests = 0
+_profiled_requests_lock = threading.Lock()
+
+
+def attach_sql_profiling():
+    global _profiled_requests
+    with _profiled_requests_lock:
+        _profiled_requests += 1
+        if _profiled_requests == 1:
+            event.listen(Engine, "before_cursor_execute", profile_sql_start)
+            event.listen(Engine, "after_cursor_execute", profile_sql_end)
+
+
+def detach_sql_profiling():
+    global _profiled_requests
+    with _profiled_requests_lock:
+        _profiled_requests -= 1
+        if _profiled_requests == 0:
+            event.remove(Engine, "before_cursor_execute", profile_sql_start)
+            event.remove(Engine, "after_cursor_execute", profile_sql_end)
+
+
+async def profiling_admin(authorization: Optional[str]) -> bool:
+    """Токен принадлежит активному администратору текущего филиала."""
+    if not authorization or not authorization.lower().startswith("bearer "):
+        return False
+    try:
+        payload = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    if payload.get("sub") is None or payload.get("tenant") != current_tenant.get():
+        return False
+    db = open_session()
+    try:
+        user = await get_user_by_username(db, payload["sub"])
+        return bool(user and user.is_active and user.is_admin)
+    finally:
+        db.close()
+
+
+class ProfilingMiddleware:
+    """
+    Запрос администратора с заголовком X-Profile профилируется: в ответ добавляются
+    X-Profile-Id и Server-Timing (sql, serialize, total), профиль сохраняется в буфере
+    (GET /api/admin/profiles). Заголовок от не-администратора просто игнорируется.
+    Обычное ASGI-middleware, а не @app.middleware: остальные запросы проходят без лишней задачи
+    и копирования ответа — только проверка наличия заголовка.
+    Подключено до tenant_middleware, поэтому выполняется уже с выбранным филиалом.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not any(name == b"x-profile" for name, _ in scope["headers"]):
+            await self.app(scope, receive, send)
+            return
+        if not await profiling_admin(Headers(scope=scope).get("authorization")):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], threading.get_ident())
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                # Ответ уже сформирован и сериализован — профиль закончен
+                profile.stop(message["status"])
+                headers = MutableHeaders(scope=message)
+                headers["X-Profile-Id"] = profile.id
+                headers["Server-Timing"] = (
+                    f"sql;dur={profile.sql_ms:.1f}, serialize;dur={profile.serialization_ms:.1f}, "
+                    f"total;dur={profile.duration_ms:.1f}"
+                )
+            await send(message)
+
+        token = current_profile.set(profile)
+        attach_sql_profiling()
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            profile.stop(500)
+            detach_sql_profiling()
+            current_profile.reset(token)
+            profile_buffer.append(profile)
+
+
+app.add_middleware(ProfilingMiddleware)
+
+
+# ==================
+#   ОПРЕДЕЛЕНИЕ ФИЛИАЛА
+# ==================
+
+def tenant_from_token(authorization: Optional[str]) -> Optional[str]:
+    """Филиал из claim "tenant" access-токена (битый или просроченный токен — None, его отклонит get_current_user)."""
+    if not authorization or not authorization.lower().startswith("bearer "):
+        return None
+    try:
+        payload = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("tenant")
+
+
+def tenant_from_host(request: Request) -> Optional[str]:
+    """Филиал из имени хоста (branch1<TENANT_HOST_SUFFIX>), иначе из заголовка X-Tenant."""
+    host = request.headers.get("host", "").split(":")[0].lower()
+    if TENANT_HOST_SUFFIX and host.endswith(TENANT_HOST_SUFFIX):
+        return host[:-len(TENANT_HOST_SUFFIX)]
+    return request.headers.get("x-tenant")
+
+
+@app.middleware("http")
+async def tenant_middleware(request: Request, call_next):
+    """
+    Выбрать базу филиала для запроса (только если задан TENANT_DATABASE_URL_TEMPLATE).
+    Филиал берётся из токена, а до входа — из хоста или X-Tenant; токен одного филиала
+    в другом не принимается. Объявлен после idempotency_middleware, поэтому выполняется раньше него.
+    """
+    if not MULTI_TENANT or getattr(request.state, "batch_db", None) is not None:
+        return await call_next(request)
+    from_token = tenant_from_token(request.headers.get("authorization"))
+    requested = tenant_from_host(request)
+    if from_token and requested and from_token != requested:
+        return JSONResponse(status_code=403, content={"detail": "Token belongs to another tenant"})
+    tenant = known_tenant(from_token or requested)
+    if tenant is None:
+        if request.url.path.startswith("/api/") or request.url.path == "/token":
+            return JSONResponse(status_code=400, content={"detail": "Unknown or missing tenant"})
+        return await call_next(request)
+    token = current_tenant.set(tenant)
+    try:
+        return await call_next(request)
+    finally:
+        current_tenant.reset(token)
+
+
 # ==================
 #   CORS МИДДЛВАРЬ
 # ==================
@@ -548,26 +2485,35 @@ app.add_middleware(
 #   ЗАВИСИМОСТИ (DEPENDENCIES)
 # ==========================
 
-def get_db():
+def get_db(request: Request):
     """
     Зависимость для получения сессии БД.
     Используется в эндпоинтах через Depends.
     По завершении запроса сессия будет закрыта.
+    Подзапросы /api/batch получают общую сессию пакета (request.state.batch_db).
     """
-    db = SessionLocal()
+    shared = getattr(request.state, "batch_db", None)
+    if shared is not None:
+        yield shared
+        return
+    db = open_session()
     try:
         yield db
     finally:
         db.close()
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     """
     Получить текущего пользователя по JWT-токену:
     - декодируем токен
     - достаём username
     - ищем пользователя в БД
+    В подзапросах /api/batch пользователь уже проверен пакетом и берётся из request.state.
     """
+    batch_user = getattr(request.state, "batch_user", None)
+    if batch_user is not None:
+        return batch_user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -577,7 +2523,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         # Декодируем токен и извлекаем subject (username)
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("tenant") != current_tenant.get():
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
@@ -588,6 +2534,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     user = await get_user_by_username(db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    # Автор изменений этой сессии для журнала аудита
+    db.info["audit_actor"] = (user.id, user.username)
     return user
 
 
@@ -615,6 +2563,87 @@ async def get_current_admin_user(current_user: User = Depends(get_current_active
     return current_user
 
 
+def get_if_match_version(if_match: Optional[str] = Header(None)) -> int:
+    """
+    Версия строки из заголовка If-Match (принимаются 3, "3" и W/"3").
+    Без заголовка PATCH не выполняется — иначе можно молча затереть чужие изменения.
+    """
+    if if_match is None:
+        raise HTTPException(status_code=428, detail="If-Match header with the row version is required")
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid If-Match header")
+
+
+def conditional_update(db: Session, model, row_id: int, expected_version: int, values: dict):
+    """
+    Оптимистичное обновление одной командой:
+    UPDATE ... SET ..., version = version + 1 WHERE id = ? AND version = ? RETURNING *.
+    Нет строки (или она мягко удалена) — 404; версия уже другая (кто-то успел изменить) — 412 с текущей версией.
+    Для аудируемых моделей старые значения меняемых полей читаются в той же транзакции
+    и попадают в журнал аудита (UPDATE через Core минует flush).
+    """
+    table = model.__table__
+    for key, value in values.items():
+        if value is None and not table.c[key].nullable:
+            raise HTTPException(status_code=400, detail=f"Field '{key}' cannot be null")
+    live = [table.c.deleted_at.is_(None)] if "deleted_at" in table.c else []
+    before = None
+    if values and model in AUDITED_MODELS:
+        before = db.execute(
+            select(*(table.c[key] for key in values)).where(table.c.id == row_id, *live)
+        ).first()
+    row = db.execute(
+        table.update()
+        .where(table.c.id == row_id, table.c.version == expected_version, *live)
+        .values(**values, version=table.c.version + 1)
+        .returning(*table.c)
+    ).first()
+    if row is None:
+        current_version = db.execute(select(table.c.version).where(table.c.id == row_id, *live)).scalar()
+        if current_version is None:
+            raise HTTPException(status_code=404, detail=f"{model.__name__} not found")
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail={"message": "Row was modified by someone else", "current_version": current_version},
+        )
+    if before is not None:
+        changes = {
+            key: [audit_value(key, old), audit_value(key, getattr(row, key))]
+            for key, old in zip(values, before)
+            if key not in AUDIT_SKIP_COLUMNS and old != getattr(row, key)
+        }
+        if changes:
+            record_audit(db, table.name, row_id, "update", changes)
+    return row
+
+
+def restore_deleted_row(db: Session, model, row_id: int):
+    """Вернуть мягко удалённую строку (пока фоновая очистка её не удалила окончательно)."""
+    row = (
+        db.query(model)
+        .execution_options(include_deleted=True)
+        .filter(model.id == row_id, model.deleted_at.isnot(None))
+        .first()
+    )
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Deleted {model.__name__} not found")
+    row.deleted_at = None
+    db.commit()
+    db.refresh(row)
+    return row
+
+
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request: Request, exc: StaleDataError):
+    """Параллельное изменение той же строки через PUT: отвечаем 409 вместо 500."""
+    return JSONResponse(status_code=409, content={"detail": "Row was modified concurrently, reload and retry"})
+
+
 # ============
 #   API ROUTES
 # ============
@@ -631,6 +2660,7 @@ async def root():
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
+    request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db)
 ):
@@ -639,7 +2669,9 @@ async def login_for_access_token(
     принимает form-data: username, password.
     Используется, например, Swagger UI или внешними клиентами.
     """
+    check_login_throttle(request, form_data.username)
     user = await authenticate_user(db, form_data.username, form_data.password)
+    record_login_result(request, form_data.username, bool(user))
     if not user:
         # Неверный логин или пароль
         raise HTTPException(
@@ -647,31 +2679,82 @@ async def login_for_access_token(
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    # Создаём токен с заданным временем жизни
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    # Создаём access-токен с заданным временем жизни и refresh-токен для его продления
+    return issue_token_pair(db, user)
 
 
 @app.post("/api/login", response_model=Token)
-async def login(user_login: UserLogin, db: Session = Depends(get_db)):
+async def login(request: Request, user_login: UserLogin, db: Session = Depends(get_db)):
     """
     Простой JSON-эндпоинт логина.
     Принимает {"username": "...", "password": "..."} и возвращает токен.
     """
+    check_login_throttle(request, user_login.username)
     user = await authenticate_user(db, user_login.username, user_login.password)
+    record_login_result(request, user_login.username, bool(user))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+    return issue_token_pair(db, user)
+
+
+@app.post("/api/token/refresh", response_model=Token)
+async def refresh_access_token(refresh: RefreshRequest, db: Session = Depends(get_db)):
+    """
+    Продлить сессию по refresh-токену без ввода пароля (и без bcrypt).
+    Токен ищется одним запросом по индексу хэша вместе с пользователем;
+    использованный токен отзывается и взамен выдаётся новый (ротация).
+    Отзыв — условный UPDATE (WHERE revoked_at IS NULL): из двух одновременных ротаций
+    одного токена проходит ровно одна.
+    Повторное использование токена, заменённого больше REFRESH_REUSE_GRACE_SECONDS назад,
+    считается утечкой — тогда отзываются все токены пользователя.
+    """
+    invalid_token = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    found = (
+        db.query(RefreshToken, User)
+        .join(User, User.id == RefreshToken.user_id)
+        .filter(RefreshToken.token_hash == hash_refresh_token(refresh.refresh_token))
+        .first()
+    )
+    if not found:
+        raise invalid_token
+    token, user = found
+
+    now = datetime.utcnow()
+    if token.revoked_at is not None:
+        if token.revoked_at < now - timedelta(seconds=REFRESH_REUSE_GRACE_SECONDS):
+            revoke_refresh_tokens(db, user.id)
+            db.commit()
+        raise invalid_token
+    if token.expires_at < now or not user.is_active:
+        raise invalid_token
+
+    rotated = db.query(RefreshToken).filter(
+        RefreshToken.id == token.id,
+        RefreshToken.revoked_at.is_(None),
+    ).update({RefreshToken.revoked_at: now}, synchronize_session=False)
+    if not rotated:
+        # Этот же токен только что обменял параллельный запрос
+        db.rollback()
+        raise invalid_token
+    return issue_token_pair(db, user)
+
+
+@app.post("/api/logout")
+async def logout(refresh: RefreshRequest, db: Session = Depends(get_db)):
+    """Завершить сессию: отозвать переданный refresh-токен."""
+    db.query(RefreshToken).filter(
+        RefreshToken.token_hash == hash_refresh_token(refresh.refresh_token),
+        RefreshToken.revoked_at.is_(None)
+    ).update({RefreshToken.revoked_at: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return {"message": "Logged out"}
 
 
 @app.post("/api/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
@@ -680,7 +2763,7 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     Регистрация нового пользователя.
     Доступно без авторизации (обычно для первичного создания учётки).
     """
-    existing_user = await get_user_by_username(db, user.username)
+    existing_user = await get_user_by_username(db, user.username, include_deleted=True)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
@@ -734,7 +2817,7 @@ async def create_user(
     Отличается от /api/register тем, что требует админ-права.
     """
     # Проверяем, не существует ли уже пользователь с таким username
-    existing_user = await get_user_by_username(db, user.username)
+    existing_user = await get_user_by_username(db, user.username, include_deleted=True)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
@@ -748,25 +2831,45 @@ async def create_user(
     return db_user
 
 
-@app.get("/api/users/", response_model=List[UserResponse])
+@app.get(
+    "/api/users/",
+    response_model=Union[List[UserResponse], List[UserFieldsResponse]],
+    response_model_exclude_unset=True,
+)
 async def get_users(
+    fields: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_admin_user)
 ):
-    """Получить список всех пользователей (только для администраторов)."""
-    return db.query(User).all()
+    """
+    Получить список всех пользователей (только для администраторов).
+    fields=id,name — вернуть только перечисленные поля.
+    """
+    return fetch_fields(db.query(User), User, parse_fields(fields, UserResponse))
 
 
-@app.get("/api/users/public", response_model=List[UserResponse])
+@app.get(
+    "/api/users/public",
+    response_model=Union[List[UserResponse], List[UserFieldsResponse]],
+    response_model_exclude_unset=True,
+)
 async def get_users_public(
+    fields: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """
     Получить список всех пользователей (доступно всем авторизованным).
-    Используется, например, для выбора врача в UI.
+    Используется, например, для выбора врача в UI (достаточно fields=id,name,position).
+    Ответ кэшируется до следующего изменения таблицы users.
     """
-    return db.query(User).all()
+    return load_users_public(db, parse_fields(fields, UserResponse))
+
+
+@query_cache("users_public", tags=("users",))
+def load_users_public(db: Session, names: Optional[List[str]]) -> List[dict]:
+    """Справочник пользователей (кэшируется)."""
+    return cacheable_rows(fetch_fields(db.query(User), User, names), UserResponse, names)
 
 
 @app.get("/api/users/{user_id}", response_model=UserResponse)
@@ -796,16 +2899,17 @@ async def update_user(
     
     # Проверяем, что username уникален (если он изменился)
     if user_update.username != user.username:
-        existing_user = await get_user_by_username(db, user_update.username)
+        existing_user = await get_user_by_username(db, user_update.username, include_deleted=True)
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already registered")
     
     # Обновляем данные пользователя
     user_data = user_update.dict()
     
-    # Если пароль предоставлен, хэшируем его
+    # Если пароль предоставлен, хэшируем его и завершаем все сессии пользователя
     if user_data.get('password'):
         user_data['hashed_password'] = get_password_hash(user_data.pop('password'))
+        revoke_refresh_tokens(db, user.id)
     else:
         # Если пароль пустой, не трогаем существующий хэш
         user_data.pop('password', None)
@@ -819,13 +2923,49 @@ async def update_user(
     return user
 
 
+@app.patch("/api/users/{user_id}", response_model=UserResponse)
+async def patch_user(
+    user_id: int,
+    user_patch: UserPatch,
+    response: Response,
+    expected_version: int = Depends(get_if_match_version),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Частичное обновление пользователя (админ-доступ) с проверкой версии из If-Match.
+    Смена пароля или деактивация завершают все сессии пользователя (refresh-токены отзываются).
+    """
+    values = user_patch.dict(exclude_unset=True)
+    password = values.pop("password", None)
+    if password:
+        values["hashed_password"] = get_password_hash(password)
+    if "username" in values:
+        existing_user = await get_user_by_username(db, values["username"], include_deleted=True)
+        if existing_user and existing_user.id != user_id:
+            raise HTTPException(status_code=400, detail="Username already registered")
+    if current_user.id == user_id and values.get("is_active") is False:
+        raise HTTPException(status_code=400, detail="Cannot deactivate yourself")
+
+    user = conditional_update(db, User, user_id, expected_version, values)
+    if password or values.get("is_active") is False:
+        revoke_refresh_tokens(db, user_id)
+    db.commit()
+    response.headers["ETag"] = f'"{user.version}"'
+    return user
+
+
 @app.delete("/api/users/{user_id}")
 async def delete_user(
     user_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_admin_user)
 ):
-    """Удалить пользователя (админ-доступ, нельзя удалить самого себя)."""
+    """
+    Удалить пользователя (админ-доступ, нельзя удалить самого себя).
+    Удаление мягкое: войти он больше не сможет, а его смены окончательно удалит
+    фоновая очистка после SOFT_DELETE_GRACE_DAYS (до этого — POST /api/users/{id}/restore).
+    """
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -834,21 +2974,47 @@ async def delete_user(
     if current_user.id == user_id:
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
     
-    db.delete(user)
+    revoke_refresh_tokens(db, user.id)
+    user.deleted_at = datetime.utcnow()
     db.commit()
     return {"message": "User deleted successfully"}
 
 
-# =================
-#   ЭНДПОИНТЫ SHIFT
-# =================
-
-@app.post("/api/shifts/", response_model=ShiftResponse)
+@app.post("/api/users/{user_id}/restore", response_model=UserResponse)
+async def restore_user(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Восстановить мягко удалённого пользователя (админ-доступ)."""
+    return restore_deleted_row(db, User, user_id)
+
+
+# =================
+#   ЭНДПОИНТЫ SHIFT
+# =================
+
+def check_shift_times(start_time: str, end_time: str):
+    """
+    Смена с одинаковым началом и концом отклоняется: иначе её нельзя отличить
+    от суточной (конец раньше или равен началу — переход через полночь) и она считалась бы за 24 часа.
+    """
+    try:
+        same = time_to_minutes(start_time) == time_to_minutes(end_time)
+    except ValueError:
+        same = start_time == end_time
+    if same:
+        raise HTTPException(status_code=400, detail="Shift start and end time must differ")
+
+
+@app.post("/api/shifts/", response_model=ShiftResponse)
 async def create_shift(shift: ShiftCreate, db: Session = Depends(get_db)):
     """
     Создать одну смену/приём.
     Связывает смену с пользователем и, опционально, с пациентом.
     """
+    check_shift_times(shift.start_time, shift.end_time)
+
     # Получаем данные пользователя
     user = db.query(User).filter(User.id == shift.user_id).first()
     if not user:
@@ -888,18 +3054,26 @@ async def create_multiple_shifts(shifts_data: dict, db: Session = Depends(get_db
     Ожидает JSON вида {"shifts": [ {ShiftCreate}, {ShiftCreate}, ... ]}.
     """
     shifts = shifts_data.get("shifts", [])
+
+    # Сотрудники и пациенты всех смен пакета — двумя запросами, а не парой запросов на каждую смену
+    user_ids = {shift_data['user_id'] for shift_data in shifts}
+    patient_ids = {shift_data['patient_id'] for shift_data in shifts if shift_data.get('patient_id')}
+    users = {user.id: user for user in db.query(User).filter(User.id.in_(user_ids))} if user_ids else {}
+    patients = {
+        patient.id: patient for patient in db.query(Patient).filter(Patient.id.in_(patient_ids))
+    } if patient_ids else {}
+
     created_shifts = []
-    
     for shift_data in shifts:
-        # Получаем данные пользователя для каждой смены
-        user = db.query(User).filter(User.id == shift_data['user_id']).first()
+        check_shift_times(shift_data['start_time'], shift_data['end_time'])
+        user = users.get(shift_data['user_id'])
         if not user:
             raise HTTPException(status_code=404, detail=f"User with id {shift_data['user_id']} not found")
 
         patient_name = None
         patient_id = shift_data.get('patient_id')
         if patient_id:
-            patient = db.query(Patient).filter(Patient.id == patient_id).first()
+            patient = patients.get(patient_id)
             if not patient:
                 raise HTTPException(status_code=404, detail=f"Patient with id {patient_id} not found")
             patient_name = patient.full_name
@@ -920,31 +3094,342 @@ async def create_multiple_shifts(shifts_data: dict, db: Session = Depends(get_db
         db.add(db_shift)
         created_shifts.append(db_shift)
     
+    db.flush()
+    created_ids = [shift.id for shift in created_shifts]
     db.commit()
     
-    # Обновляем объекты после коммита
-    for shift in created_shifts:
-        db.refresh(shift)
+    # Обновляем объекты после коммита одним запросом (вместо refresh каждой смены)
+    if created_ids:
+        db.query(Shift).filter(Shift.id.in_(created_ids)).all()
     
     return created_shifts
 
 
-@app.get("/api/shifts/", response_model=List[ShiftResponse])
-async def get_shifts(date: Optional[str] = None, db: Session = Depends(get_db)):
+@app.get(
+    "/api/shifts/",
+    response_model=Union[List[ShiftResponse], List[ShiftFieldsResponse]],
+    response_model_exclude_unset=True,
+)
+async def get_shifts(
+    date: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    date_to: Optional[str] = Query(None, alias="to", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    user_id: Optional[int] = None,
+    patient_id: Optional[int] = None,
+    status: Optional[str] = None,
+    shift_type: Optional[str] = None,
+    order_by: str = Query("created", pattern="^(created|start)$"),
+    include_archived: bool = False,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
     """
     Получить список смен.
-    Можно фильтровать по конкретной дате (YYYY-MM-DD).
+    Фильтры (комбинируются по И):
+    - date — конкретная дата (YYYY-MM-DD), from/to — диапазон дат включительно
+    - user_id, patient_id, status, shift_type
+    Для каждого фильтра есть индекс (<поле>, date, start_time), поэтому с order_by=start
+    (по дате и времени начала) строки читаются из индекса уже отсортированными.
+    order_by=created (по умолчанию) — новые записи сверху.
+    Если начало периода старше границы архивации (или задан только to), смены берутся и из архива.
+    Список без даты/периода читает только горячую таблицу, если не передан include_archived.
+    fields=id,date,start_time — вернуть только перечисленные поля.
+    """
+    names = parse_fields(fields, ShiftResponse)
+    filters = (date, date_from, date_to, user_id, patient_id, status, shift_type, order_by, include_archived)
+    if date or (date_from and date_to):
+        # Расписание дня или периода читается много раз между изменениями — берём из кэша
+        return load_schedule(db, names, *filters)
+    return query_shifts(db, names, *filters)
+
+
+def query_shifts(
+    db: Session,
+    names: Optional[List[str]],
+    date: Optional[str],
+    date_from: Optional[str],
+    date_to: Optional[str],
+    user_id: Optional[int],
+    patient_id: Optional[int],
+    status: Optional[str],
+    shift_type: Optional[str],
+    order_by: str,
+    include_archived: bool,
+):
+    """Смены по фильтрам get_shifts (ORM-объекты, Row или словари выбранных полей)."""
+    def criteria(table):
+        conditions = []
+        if date:
+            conditions.append(table.c.date == date)
+        if date_from:
+            conditions.append(table.c.date >= date_from)
+        if date_to:
+            conditions.append(table.c.date <= date_to)
+        if user_id is not None:
+            conditions.append(table.c.user_id == user_id)
+        if patient_id is not None:
+            conditions.append(table.c.patient_id == patient_id)
+        if status:
+            conditions.append(table.c.status == status)
+        if shift_type:
+            conditions.append(table.c.shift_type == shift_type)
+        return conditions
+
+    def ordering(table):
+        if order_by == "start":
+            return [table.c.date, table.c.start_time]
+        return [table.c.created_at.desc()]
+
+    # Левая граница периода; только "to" — период без начала, он захватывает и архив
+    range_start = max(filter(None, [date, date_from]), default=None)
+    dated = bool(date or date_from or date_to)
+    if include_archived or (dated and range_needs_archive(db, "shifts", range_start)):
+        shifts = select_hot_and_archive(Shift, shifts_archive, criteria)
+        columns = [shifts.c[name] for name in names] if names else [shifts]
+        rows = db.execute(select(*columns).order_by(*ordering(shifts))).all()
+        return [row._asdict() for row in rows] if names else rows
+
+    query = db.query(Shift).filter(*criteria(Shift.__table__)).order_by(*ordering(Shift.__table__))
+    return fetch_fields(query, Shift, names)
+
+
+@query_cache("schedule", tags=("shifts", "shifts_archive", "archive_watermarks"))
+def load_schedule(db: Session, names: Optional[List[str]], *filters) -> List[dict]:
+    """Смены за день или период (кэшируется)."""
+    return cacheable_rows(query_shifts(db, names, *filters), ShiftResponse, names)
+
+
+def sql_time_minutes(column):
+    """Время "HH:MM" в минутах от полуночи — выражение SQL."""
+    separator = func.instr(column, ":")
+    return cast(func.substr(column, 1, separator - 1), Integer) * 60 + cast(func.substr(column, separator + 1), Integer)
+
+
+def sql_shift_minutes(table):
+    """
+    Длительность смены в минутах (SQL); конец раньше начала — смена переходит через полночь.
+    Смены нулевой длины (начало = конец) больше не создаются, старые такие строки считаются за 0.
+    """
+    start = sql_time_minutes(table.c.start_time)
+    end = sql_time_minutes(table.c.end_time)
+    return case((end < start, end - start + 1440), else_=end - start)
+
+
+@app.get("/api/shifts/calendar", response_model=ShiftCalendarResponse)
+async def get_shift_calendar(
+    date_from: str = Query(..., alias="from", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    date_to: str = Query(..., alias="to", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    group_by: str = Query("day", pattern="^(day|user|shift_type)$"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Сводка расписания за период [from, to] (даты YYYY-MM-DD включительно) для месячного/недельного вида.
+    group_by=day|user|shift_type — по каждой группе число приёмов, отменённых и запланированные часы.
+    Считается одним GROUP BY в базе по индексу (date, start_time), сами смены не передаются.
+    """
+    if date_to < date_from:
+        raise HTTPException(status_code=400, detail="'to' must not be earlier than 'from'")
+
+    def in_range(table):
+        return [table.c.date >= date_from, table.c.date <= date_to]
+
+    if range_needs_archive(db, "shifts", date_from):
+        shifts = select_hot_and_archive(Shift, shifts_archive, in_range)
+        criteria = []
+    else:
+        shifts = Shift.__table__
+        criteria = in_range(shifts)
+
+    if group_by == "day":
+        key, label = shifts.c.date, None
+    elif group_by == "user":
+        key, label = shifts.c.user_id, func.max(shifts.c.user_name)
+    else:
+        key, label = shifts.c.shift_type, None
+
+    cancelled = shifts.c.status == "cancelled"
+    rows = db.execute(
+        select(
+            key,
+            label if label is not None else key,
+            func.count(),
+            func.sum(case((cancelled, 1), else_=0)),
+            func.sum(case((cancelled, 0), else_=sql_shift_minutes(shifts))),
+        )
+        .where(*criteria)
+        .group_by(key)
+        .order_by(key)
+    ).all()
+
+    buckets = [
+        ShiftCalendarBucket(
+            key=str(bucket_key),
+            label=bucket_label if label is not None else None,
+            count=count,
+            cancelled=cancelled_count or 0,
+            hours=round((minutes or 0) / 60, 2),
+        )
+        for bucket_key, bucket_label, count, cancelled_count, minutes in rows
+    ]
+    return ShiftCalendarResponse(
+        group_by=group_by,
+        buckets=buckets,
+        total_count=sum(bucket.count for bucket in buckets),
+        total_hours=round(sum(bucket.hours for bucket in buckets), 2),
+    )
+
+
+# ======================
+#   СВОБОДНЫЕ ОКНА ВРАЧЕЙ
+# ======================
+
+# Рабочие часы по умолчанию (можно переопределить в запросе)
+WORKDAY_START = os.getenv("WORKDAY_START", "09:00")
+WORKDAY_END = os.getenv("WORKDAY_END", "18:00")
+# Рабочие дни недели: 0 — понедельник ... 6 — воскресенье
+WORKING_WEEKDAYS = {int(day) for day in os.getenv("WORKING_WEEKDAYS", "0,1,2,3,4").split(",") if day.strip()}
+
+# Максимальная длина периода поиска, дней
+AVAILABILITY_MAX_DAYS = 92
+
+
+def time_to_minutes(value: str) -> int:
+    """Время "HH:MM" в минутах от полуночи."""
+    hours, minutes = value.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def minutes_to_time(value: int) -> str:
+    """Минуты от полуночи в "HH:MM"."""
+    return f"{value // 60:02d}:{value % 60:02d}"
+
+
+def iter_busy_intervals(rows, first_day: date_type):
+    """
+    Занятые интервалы (начало, конец) в минутах от полуночи first_day.
+    rows — (date, start_time, end_time), упорядоченные по (date, start_time);
+    смена с концом раньше начала заканчивается на следующий день (нулевая — ничего не занимает).
+    """
+    for shift_date, start_time, end_time in rows:
+        offset = (date_type.fromisoformat(shift_date) - first_day).days * 1440
+        start, end = time_to_minutes(start_time), time_to_minutes(end_time)
+        if end < start:
+            end += 1440
+        yield offset + start, offset + end
+
+
+def iter_free_slots(busy, first_day: date_type, days: int, day_start: int, day_end: int,
+                    duration: int, step: int, not_before: int):
+    """
+    Один проход (sweep) по занятым интервалам, отсортированным по началу.
+    Для каждого рабочего дня окно [day_start, day_end] режется занятыми интервалами,
+    из свободных промежутков выдаются слоты длиной duration с шагом step.
+    Слоты, отсечённые текущим временем (not_before), идут по сетке от начала рабочего дня
+    (day_start + k * step), а не от текущей минуты.
+    Генератор ленивый: занятые интервалы читаются, только пока нужны новые слоты.
+    """
+    busy = iter(busy)
+    pending = next(busy, None)
+    busy_until = 0
+    for offset in range(days):
+        if (first_day + timedelta(days=offset)).weekday() not in WORKING_WEEKDAYS:
+            continue
+        window_start = offset * 1440 + day_start
+        window_end = offset * 1440 + day_end
+        cursor = window_start
+        if cursor < not_before:
+            cursor += -(-(not_before - window_start) // step) * step
+        cursor = max(cursor, busy_until)
+        while pending is not None and pending[0] < window_end:
+            start, end = pending
+            while cursor + duration <= min(start, window_end):
+                yield cursor
+                cursor += step
+            cursor = max(cursor, end)
+            busy_until = max(busy_until, end)
+            pending = next(busy, None)
+        while cursor + duration <= window_end:
+            yield cursor
+            cursor += step
+
+
+@app.get("/api/availability", response_model=AvailabilityResponse)
+async def get_availability(
+    user_id: int,
+    date_from: str = Query(..., alias="from", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    date_to: str = Query(..., alias="to", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    duration: int = Query(30, ge=5, le=24 * 60),
+    step: Optional[int] = Query(None, ge=5, le=24 * 60),
+    limit: int = Query(10, ge=1, le=200),
+    day_start: str = Query(WORKDAY_START, pattern=r"^\d{1,2}:\d{2}$"),
+    day_end: str = Query(WORKDAY_END, pattern=r"^\d{1,2}:\d{2}$"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Первые limit свободных окон длиной duration минут у сотрудника user_id в датах [from, to].
+    Свободное время — рабочие часы (day_start–day_end по рабочим дням недели) минус его приёмы,
+    кроме отменённых; окна в прошлом не предлагаются. step — шаг между окнами (по умолчанию = duration).
+    Приёмы читаются по индексу (user_id, date, start_time) только за запрошенный период.
+    Неизвестный (или удалённый) сотрудник — 404.
     """
-    query = db.query(Shift)
-    if date:
-        query = query.filter(Shift.date == date)
-    return query.order_by(Shift.created_at.desc()).all()
+    try:
+        first_day = date_type.fromisoformat(date_from)
+        last_day = date_type.fromisoformat(date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date")
+    days = (last_day - first_day).days + 1
+    if days < 1 or days > AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must be 1..{AVAILABILITY_MAX_DAYS} days")
+    start_minutes, end_minutes = time_to_minutes(day_start), time_to_minutes(day_end)
+    if end_minutes <= start_minutes or end_minutes > 1440:
+        raise HTTPException(status_code=400, detail="Invalid working hours")
+    if db.query(User.id).filter(User.id == user_id, User.deleted_at.is_(None)).first() is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    now = clinic_now()
+    not_before = (now.date() - first_day).days * 1440 + now.hour * 60 + now.minute
+
+    # Ночная смена накануне может заходить на первый день периода
+    rows = (
+        db.query(Shift.date, Shift.start_time, Shift.end_time)
+        .filter(
+            Shift.user_id == user_id,
+            Shift.date >= (first_day - timedelta(days=1)).isoformat(),
+            Shift.date <= date_to,
+            Shift.status != "cancelled",
+        )
+        .order_by(Shift.date, Shift.start_time)
+        .yield_per(500)
+    )
+    slots = islice(
+        iter_free_slots(
+            iter_busy_intervals(rows, first_day), first_day, days,
+            start_minutes, end_minutes, duration, step or duration, not_before,
+        ),
+        limit,
+    )
+    return AvailabilityResponse(
+        user_id=user_id,
+        duration=duration,
+        slots=[
+            AvailabilitySlot(
+                date=(first_day + timedelta(days=slot // 1440)).isoformat(),
+                start_time=minutes_to_time(slot % 1440),
+                end_time=minutes_to_time(slot % 1440 + duration),
+            )
+            for slot in slots
+        ],
+    )
 
 
 @app.get("/api/shifts/{shift_id}", response_model=ShiftResponse)
 async def get_shift(shift_id: int, db: Session = Depends(get_db)):
-    """Получить смену по ID."""
+    """Получить смену по ID (если в горячей таблице нет — ищем в архиве)."""
     shift = db.query(Shift).filter(Shift.id == shift_id).first()
+    if not shift:
+        shift = db.execute(select(shifts_archive).where(shifts_archive.c.id == shift_id)).first()
     if not shift:
         raise HTTPException(status_code=404, detail="Shift not found")
     return shift
@@ -957,6 +3442,7 @@ async def update_shift(
     db: Session = Depends(get_db)
 ):
     """Полностью обновить смену по ID."""
+    check_shift_times(shift_update.start_time, shift_update.end_time)
     shift = db.query(Shift).filter(Shift.id == shift_id).first()
     if not shift:
         raise HTTPException(status_code=404, detail="Shift not found")
@@ -985,6 +3471,60 @@ async def update_shift(
     return shift
 
 
+@app.patch("/api/shifts/{shift_id}", response_model=ShiftResponse)
+async def patch_shift(
+    shift_id: int,
+    shift_patch: ShiftPatch,
+    response: Response,
+    expected_version: int = Depends(get_if_match_version),
+    db: Session = Depends(get_db)
+):
+    """
+    Частичное обновление смены с проверкой версии из If-Match.
+    Сотрудник и пациент перечитываются только если их id есть в запросе;
+    patient_id=null отвязывает пациента.
+    """
+    values = shift_patch.dict(exclude_unset=True)
+    times_changed = "start_time" in values or "end_time" in values
+    completing = values.get("status") == "completed"
+    if times_changed or completing:
+        slot = {key: values.get(key) for key in ("date", "start_time", "end_time")}
+        if None in slot.values():
+            # Недостающие дату и границы берём из текущей смены
+            current = db.query(Shift.date, Shift.start_time, Shift.end_time).filter(Shift.id == shift_id).first()
+            if current is None:
+                raise HTTPException(status_code=404, detail="Shift not found")
+            slot = {key: value or getattr(current, key) for key, value in slot.items()}
+        if times_changed:
+            check_shift_times(slot["start_time"], slot["end_time"])
+        # Завершённый приём в будущем сдвинул бы last_visit пациента вперёд (см. transition_shift_status)
+        if completing:
+            try:
+                ended = shift_has_ended(slot["date"], slot["start_time"], slot["end_time"], clinic_now())
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid shift date or time")
+            if not ended:
+                raise HTTPException(status_code=409, detail="Shift has not ended yet")
+    if "user_id" in values:
+        user = db.get(User, values["user_id"])
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        values.update(user_name=user.name, position=user.position)
+    if "patient_id" in values:
+        values["patient_name"] = None
+        if values["patient_id"] is not None:
+            patient = db.get(Patient, values["patient_id"])
+            if not patient:
+                raise HTTPException(status_code=404, detail="Patient not found")
+            values["patient_name"] = patient.full_name
+    values["updated_at"] = datetime.utcnow()
+
+    shift = conditional_update(db, Shift, shift_id, expected_version, values)
+    db.commit()
+    response.headers["ETag"] = f'"{shift.version}"'
+    return shift
+
+
 @app.delete("/api/shifts/{shift_id}")
 async def delete_shift(shift_id: int, db: Session = Depends(get_db)):
     """Удалить смену по ID."""
@@ -992,328 +3532,1544 @@ async def delete_shift(shift_id: int, db: Session = Depends(get_db)):
     if not shift:
         raise HTTPException(status_code=404, detail="Shift not found")
 
+    detach_handovers_from_shifts(db, [shift_id])
     db.delete(shift)
     db.commit()
     return {"message": "Shift deleted successfully"}
 
 
-# ===================
-#   ЭНДПОИНТЫ PATIENT
-# ===================
+# ====================
+#   СТАТУСЫ СМЕН
+# ====================
 
-@app.get("/api/patients/", response_model=List[PatientResponse])
-async def get_patients(
-    search: Optional[str] = None,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
+# Допустимые переходы статуса: завершённую или отменённую смену массово не меняем
+SHIFT_STATUS_TRANSITIONS = {
+    "scheduled": ("completed", "cancelled"),
+}
+
+# Сколько id можно передать в одном запросе массовой смены статуса
+SHIFT_STATUS_MAX_IDS = int(os.getenv("SHIFT_STATUS_MAX_IDS", "1000"))
+
+# Автозавершение: смены, закончившиеся больше SHIFT_AUTO_COMPLETE_GRACE_MINUTES минут назад,
+# переводятся из scheduled в completed пачками по SHIFT_AUTO_COMPLETE_BATCH_SIZE
+SHIFT_AUTO_COMPLETE_INTERVAL_MINUTES = int(os.getenv("SHIFT_AUTO_COMPLETE_INTERVAL_MINUTES", "15"))
+SHIFT_AUTO_COMPLETE_GRACE_MINUTES = int(os.getenv("SHIFT_AUTO_COMPLETE_GRACE_MINUTES", "60"))
+SHIFT_AUTO_COMPLETE_BATCH_SIZE = int(os.getenv("SHIFT_AUTO_COMPLETE_BATCH_SIZE", "500"))
+
+
+def shift_status_sources(target: str) -> List[str]:
+    """Статусы, из которых разрешён переход в target; неизвестная цель — 400."""
+    sources = [source for source, targets in SHIFT_STATUS_TRANSITIONS.items() if target in targets]
+    if not sources:
+        raise HTTPException(status_code=400, detail=f"Cannot transition shifts to status '{target}'")
+    return sources
+
+
+def shift_has_ended(shift_date: str, start_time: str, end_time: str, moment: datetime) -> bool:
     """
-    Получить список пациентов.
-    Если передан search — ищет по ФИО, номеру полиса и телефону (по подстроке, регистр не важен).
+    Закончилась ли смена к moment (локальное время, как у расписания) — то же правило,
+    что и shift_ended_before: конец не позже начала — смена заканчивается на следующий день.
     """
-    query = db.query(Patient)
-    if search:
-        pattern = f"%{search.lower()}%"
-        query = query.filter(
-            or_(
-                func.lower(Patient.full_name).like(pattern),
-                func.lower(func.coalesce(Patient.policy_number, "")).like(pattern),
-                func.lower(func.coalesce(Patient.phone, "")).like(pattern)
-            )
-        )
-    return query.order_by(Patient.created_at.desc()).all()
+    start, end = time_to_minutes(start_time), time_to_minutes(end_time)
+    if end <= start:
+        end += 1440
+    return datetime.combine(date_type.fromisoformat(shift_date), datetime.min.time()) + timedelta(minutes=end) <= moment
 
 
-@app.post("/api/patients/", response_model=PatientResponse, status_code=status.HTTP_201_CREATED)
-async def create_patient(
-    patient: PatientCreate,
+def transition_shift_status(db: Session, conditions: list, target: str) -> List[int]:
+    """
+    Перевести смены, подходящие под conditions, в статус target.
+    На каждый допустимый исходный статус — один UPDATE ... WHERE status = <исходный> RETURNING id,
+    поэтому старое значение для журнала аудита известно без чтения строк;
+    версия строки растёт, как при PATCH. Коммит — за вызывающим.
+    Завершить (completed) можно только уже закончившуюся смену: иначе триггер
+    сдвинул бы last_visit пациента в будущее.
+    """
+    table = Shift.__table__
+    now = datetime.utcnow()
+    if target == "completed":
+        conditions = [*conditions, *shift_ended_before(table, clinic_now())]
+    updated = []
+    for source in shift_status_sources(target):
+        ids = db.execute(
+            table.update()
+            .where(*conditions, table.c.status == source)
+            .values(status=target, updated_at=now, version=table.c.version + 1)
+            .returning(table.c.id)
+        ).scalars().all()
+        for shift_id in ids:
+            record_audit(db, table.name, shift_id, "update", {"status": [source, target]})
+        updated.extend(ids)
+    return sorted(updated)
+
+
+@app.post("/api/shifts/status", response_model=ShiftStatusTransitionResponse)
+async def transition_shifts(
+    transition: ShiftStatusTransition,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """
-    Создать нового пациента.
-    last_visit (если передан строкой) конвертируется в datetime.
+    Массово сменить статус смен одним UPDATE (например, закрыть день):
+    - ids — конкретные смены; те, что не изменились, возвращаются в rejected с причиной и кодом
+      (нет смены — 404, статус не допускает перехода или смена ещё не закончилась — 409)
+    - date (и user_id) — все подходящие смены дня; остальные пропускаются молча
+    Разрешены переходы scheduled → completed (только для прошедших смен) и scheduled → cancelled.
     """
-    patient_data = patient.dict()
-    last_visit_raw = patient_data.pop("last_visit", None)
-    db_patient = Patient(**patient_data)
-    db_patient.last_visit = parse_optional_datetime(last_visit_raw)
-    db.add(db_patient)
+    table = Shift.__table__
+    conditions = []
+    if transition.ids is not None:
+        if not transition.ids:
+            raise HTTPException(status_code=400, detail="ids must not be empty")
+        if len(transition.ids) > SHIFT_STATUS_MAX_IDS:
+            raise HTTPException(status_code=400, detail=f"At most {SHIFT_STATUS_MAX_IDS} ids per request")
+        conditions.append(table.c.id.in_(transition.ids))
+    if transition.date:
+        conditions.append(table.c.date == transition.date)
+    if transition.user_id is not None:
+        conditions.append(table.c.user_id == transition.user_id)
+    if transition.ids is None and not transition.date:
+        raise HTTPException(status_code=400, detail="Either ids or date is required")
+
+    updated = transition_shift_status(db, conditions, transition.status)
     db.commit()
-    db.refresh(db_patient)
-    return db_patient
 
+    rejected = []
+    missed = set(transition.ids or ()) - set(updated)
+    if missed:
+        current = {
+            row.id: row for row in db.execute(
+                select(table.c.id, table.c.status, table.c.date, table.c.start_time, table.c.end_time)
+                .where(table.c.id.in_(missed))
+            )
+        }
+        allowed = shift_status_sources(transition.status)
+        for shift_id in sorted(missed):
+            row = current.get(shift_id)
+            if row is None:
+                rejected.append(ShiftStatusRejection(id=shift_id, status=None, reason="not_found", status_code=404))
+            elif row.status in allowed:
+                # Статус подходит — значит, не прошло условие "смена уже закончилась"
+                rejected.append(ShiftStatusRejection(id=shift_id, status=row.status, reason="not_ended", status_code=409))
+            else:
+                rejected.append(
+                    ShiftStatusRejection(id=shift_id, status=row.status, reason="invalid_transition", status_code=409)
+                )
+    return ShiftStatusTransitionResponse(status=transition.status, updated=updated, rejected=rejected)
+
+
+def shift_ended_before(table, moment: datetime) -> list:
+    """
+    Условия "смена закончилась до moment" (локальное время, как у расписания).
+    Конец не позже начала — смена переходит через полночь и заканчивается на следующий день.
+    Первое условие (date <= день moment) даёт диапазон по индексу (status, date, start_time).
+    """
+    day = moment.strftime("%Y-%m-%d")
+    previous_day = (moment - timedelta(days=1)).strftime("%Y-%m-%d")
+    minutes = moment.hour * 60 + moment.minute
+    start = sql_time_minutes(table.c.start_time)
+    end = sql_time_minutes(table.c.end_time)
+    return [
+        table.c.date <= day,
+        or_(
+            table.c.date < previous_day,
+            and_(table.c.date == previous_day, or_(end > start, end <= minutes)),
+            and_(table.c.date == day, end > start, end <= minutes),
+        ),
+    ]
 
-@app.get("/api/patients/{patient_id}", response_model=PatientResponse)
-async def get_patient(
-    patient_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
-    """Получить пациента по ID."""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    return patient
 
+def auto_complete_shifts(
+    db: Session, grace_minutes: Optional[int] = None, batch_size: Optional[int] = None
+) -> dict:
+    """
+    Перевести прошедшие запланированные смены в completed.
+    Кандидаты читаются по индексу (status, date, start_time) пачками по batch_size,
+    каждая пачка — отдельный UPDATE и короткая транзакция.
+    """
+    grace_minutes = grace_minutes if grace_minutes is not None else SHIFT_AUTO_COMPLETE_GRACE_MINUTES
+    batch_size = batch_size or SHIFT_AUTO_COMPLETE_BATCH_SIZE
+    table = Shift.__table__
+    moment = clinic_now() - timedelta(minutes=grace_minutes)
+    ended = shift_ended_before(table, moment)
+    completed = 0
+    while True:
+        ids = db.execute(
+            select(table.c.id)
+            .where(table.c.status == "scheduled", *ended)
+            .order_by(table.c.date, table.c.start_time)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        completed += len(transition_shift_status(db, [table.c.id.in_(ids)], "completed"))
+        db.commit()
+        if len(ids) < batch_size:
+            break
+    if completed:
+        print(f"Auto-completed {completed} shifts ended before {moment.isoformat(timespec='minutes')}")
+    return {"ended_before": moment.isoformat(timespec="minutes"), "completed": completed}
+
+
+# ===============================
+#   ПОИСК ДУБЛИКАТОВ ПАЦИЕНТОВ
+# ===============================
+
+# Оценка, начиная с которой create_patient отказывает (409), если не передан allow_duplicate
+DUPLICATE_BLOCK_SCORE = float(os.getenv("DUPLICATE_BLOCK_SCORE", "0.6"))
+
+# Блоки (группы с одинаковым ключом) больше этого размера в отчёт не попадают:
+# обычно это мусорные значения вроде телефона "0000000000"
+DUPLICATE_MAX_BLOCK_SIZE = int(os.getenv("DUPLICATE_MAX_BLOCK_SIZE", "50"))
+
+# Вес совпадения каждого признака в итоговой оценке (сумма обрезается до 1.0)
+DUPLICATE_WEIGHTS = {
+    "policy_number": 0.6,
+    "surname_birth_date": 0.5,
+    "given_name": 0.2,
+    "full_name": 0.1,
+    "phone": 0.3,
+    "email": 0.2,
+}
+
+# Транслитерация кириллицы: "Иванов" и "Ivanov" дают один и тот же ключ
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "iu",
+    "я": "ia",
+})
+
+
+def normalize_name(value: Optional[str]) -> str:
+    """ФИО в нижнем регистре латиницей, только буквы/цифры и одиночные пробелы."""
+    if not value:
+        return ""
+    translit = value.lower().translate(TRANSLIT)
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", translit).split())
 
-@app.put("/api/patients/{patient_id}", response_model=PatientResponse)
-async def update_patient(
-    patient_id: int,
-    patient_update: PatientUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
-    """Обновить данные пациента (частично или полностью)."""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
 
-    update_data = patient_update.dict(exclude_unset=True)
-    # Отдельно парсим last_visit, если пришёл
-    if "last_visit" in update_data:
-        patient.last_visit = parse_optional_datetime(update_data.pop("last_visit"))
+def normalize_birth_date(value: Optional[str]) -> Optional[str]:
+    """Дата рождения в виде YYYY-MM-DD (понимает также DD.MM.YYYY)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return datetime.strptime(value, "%d.%m.%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        parsed = parse_optional_datetime(value)
+        return parsed.strftime("%Y-%m-%d") if parsed else None
 
-    for key, value in update_data.items():
-        setattr(patient, key, value)
 
-    patient.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(patient)
-    return patient
+def patient_dedup_keys(full_name, birth_date, phone, policy_number) -> dict:
+    """
+    Ключи блокировки для поиска дубликатов.
+    Кандидаты в дубликаты — только пациенты с совпадающим ключом,
+    поэтому поиск идёт по индексам, а не сравнением "каждый с каждым".
+    """
+    name = normalize_name(full_name)
+    birth = normalize_birth_date(birth_date)
+    digits = re.sub(r"\D", "", phone or "")
+    policy = re.sub(r"[^0-9A-Za-z]", "", policy_number or "").upper()
+    return {
+        "dedup_name_key": f"{name.split()[0]}|{birth}" if name and birth else None,
+        "dedup_phone_key": digits[-10:] if len(digits) >= 6 else None,
+        "dedup_policy_key": policy or None,
+    }
 
 
-@app.delete("/api/patients/{patient_id}")
-async def delete_patient(
-    patient_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
-    """Удалить пациента по ID."""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
+@event.listens_for(Patient, "before_insert")
+@event.listens_for(Patient, "before_update")
+def set_patient_dedup_keys(mapper, connection, patient):
+    """Пересчитываем ключи дубликатов при каждом сохранении пациента через ORM."""
+    keys = patient_dedup_keys(patient.full_name, patient.birth_date, patient.phone, patient.policy_number)
+    for key, value in keys.items():
+        setattr(patient, key, value)
 
-    db.delete(patient)
-    db.commit()
-    return {"message": "Patient deleted successfully"}
 
+def backfill_patient_dedup_keys(db: Session, batch_size: int = 1000) -> int:
+    """Посчитать ключи дубликатов для уже существующих пациентов (пачками по id)."""
+    last_id = 0
+    updated = 0
+    while True:
+        rows = (
+            db.query(Patient.id, Patient.full_name, Patient.birth_date, Patient.phone, Patient.policy_number)
+            .execution_options(include_deleted=True)
+            .filter(Patient.id > last_id)
+            .order_by(Patient.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        db.bulk_update_mappings(Patient, [
+            {"id": row.id, **patient_dedup_keys(row.full_name, row.birth_date, row.phone, row.policy_number)}
+            for row in rows
+        ])
+        db.commit()
+        last_id = rows[-1].id
+        updated += len(rows)
+    print(f"Dedup keys computed for {updated} patients")
+    return updated
+
+
+class PatientMatchKeys(NamedTuple):
+    """Нормализованные признаки пациента для оценки пары — и для карточки из базы, и для новых данных."""
+    name: tuple                 # слова ФИО латиницей
+    email: Optional[str]        # в нижнем регистре
+    name_key: Optional[str]     # dedup_name_key
+    phone_key: Optional[str]    # dedup_phone_key
+    policy_key: Optional[str]   # dedup_policy_key
+
+
+def patient_match_keys(full_name: Optional[str], email: Optional[str], dedup_keys) -> PatientMatchKeys:
+    """Признаки пациента; dedup_keys — словарь из patient_dedup_keys или строка с колонками dedup_*."""
+    dedup_keys = dedup_keys if isinstance(dedup_keys, dict) else dedup_keys._mapping
+    return PatientMatchKeys(
+        name=tuple(normalize_name(full_name).split()),
+        email=email.strip().lower() if email and email.strip() else None,
+        name_key=dedup_keys["dedup_name_key"],
+        phone_key=dedup_keys["dedup_phone_key"],
+        policy_key=dedup_keys["dedup_policy_key"],
+    )
 
-# ======================
-#   DASHBOARD SUMMARY
-# ======================
 
-@app.get("/api/dashboard/summary", response_model=DashboardSummary)
-async def get_dashboard_summary(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
+def score_patient_pair(a: PatientMatchKeys, b: PatientMatchKeys) -> tuple:
     """
-    Сводка для дашборда:
-    - всего пациентов
-    - всего сотрудников
-    - активных кейсов
-    - количество будущих приёмов
-    - список ближайших 5 приёмов
-    - список 5 последних пациентов
+    Оценить, насколько два пациента похожи на одного человека.
+    Возвращает (оценка 0..1, список совпавших признаков).
     """
-    total_patients = db.query(func.count(Patient.id)).scalar() or 0
-    total_staff = db.query(func.count(User.id)).scalar() or 0
-    active_cases = (
-        db.query(func.count(Asset.id))
-        .filter(Asset.status == "Active")
-        .scalar()
-        or 0
-    )
-
-    # Получаем все смены и отбираем только будущие
-    all_shifts = db.query(Shift).all()
-    now = datetime.utcnow()
+    reasons = []
+    if a.policy_key and a.policy_key == b.policy_key:
+        reasons.append("policy_number")
+    if a.name_key and a.name_key == b.name_key:
+        reasons.append("surname_birth_date")
+    if len(a.name) > 1 and len(b.name) > 1 and a.name[1] == b.name[1]:
+        reasons.append("given_name")
+    if a.name and a.name == b.name:
+        reasons.append("full_name")
+    if a.phone_key and a.phone_key == b.phone_key:
+        reasons.append("phone")
+    if a.email and a.email == b.email:
+        reasons.append("email")
+    score = min(sum(DUPLICATE_WEIGHTS[reason] for reason in reasons), 1.0)
+    return round(score, 2), reasons
+
+
+# Ключ блокировки -> признак, чей вес он даёт в оценке
+DUPLICATE_KEY_REASONS = {
+    "dedup_policy_key": "policy_number",
+    "dedup_name_key": "surname_birth_date",
+    "dedup_phone_key": "phone",
+}
+
+# Колонки, нужные для оценки пары (большие текстовые поля не читаем)
+DUPLICATE_COLUMNS = (
+    Patient.id, Patient.full_name, Patient.birth_date, Patient.phone, Patient.policy_number,
+    Patient.email, Patient.dedup_name_key, Patient.dedup_phone_key, Patient.dedup_policy_key,
+)
 
-    def shift_start(shift: Shift) -> Optional[datetime]:
-        """Вспомогательная функция: собирает datetime начала смены из date + start_time."""
-        try:
-            return datetime.strptime(f"{shift.date} {shift.start_time}", "%Y-%m-%d %H:%M")
-        except ValueError:
-            return None
 
-    # Фильтруем только смены, которые ещё не начались
-    upcoming = [
-        (start_dt, shift)
-        for shift in all_shifts
-        if (start_dt := shift_start(shift)) and start_dt >= now
+def find_duplicate_candidates(db: Session, patient: PatientCreate, limit: int = 20) -> List[dict]:
+    """
+    Кандидаты в дубликаты для нового пациента: один запрос по трём индексам ключей.
+    Сначала идут строки с самыми весомыми совпавшими ключами (полис, фамилия+дата, телефон),
+    оцениваются до DUPLICATE_MAX_BLOCK_SIZE из них, и только потом отбираются limit лучших —
+    иначе случайные совпадения по телефону могли вытеснить карточку с тем же полисом.
+    """
+    keys = patient_dedup_keys(patient.full_name, patient.birth_date, patient.phone, patient.policy_number)
+    matches = [
+        (getattr(Patient, key) == value, DUPLICATE_WEIGHTS[reason])
+        for key, reason in DUPLICATE_KEY_REASONS.items()
+        if (value := keys[key])
     ]
-    # Сортируем по времени начала
-    upcoming.sort(key=lambda item: item[0])
-    upcoming_shifts = [item[1] for item in upcoming]
-
-    next_appointments = upcoming_shifts[:5]
-    recent_patients = (
-        db.query(Patient)
-        .order_by(Patient.created_at.desc())
-        .limit(5)
+    if not matches:
+        return []
+    strength = sum(case((condition, weight), else_=0.0) for condition, weight in matches)
+    incoming = patient_match_keys(patient.full_name, patient.email, keys)
+    candidates = []
+    rows = (
+        db.query(*DUPLICATE_COLUMNS)
+        .filter(or_(*(condition for condition, _ in matches)))
+        .order_by(strength.desc(), Patient.id)
+        .limit(DUPLICATE_MAX_BLOCK_SIZE)
         .all()
     )
-
-    return DashboardSummary(
-        total_patients=total_patients,
-        total_staff=total_staff,
-        active_cases=active_cases,
-        upcoming_appointments=len(upcoming_shifts),
-        next_appointments=next_appointments,
-        recent_patients=recent_patients,
+    for row in rows:
+        score, reasons = score_patient_pair(incoming, patient_match_keys(row.full_name, row.email, row))
+        candidates.append({
+            "id": row.id,
+            "full_name": row.full_name,
+            "birth_date": row.birth_date,
+            "phone": row.phone,
+            "policy_number": row.policy_number,
+            "score": score,
+            "reasons": reasons,
+        })
+    return sorted(candidates, key=lambda item: item["score"], reverse=True)[:limit]
+
+
+def iter_duplicate_blocks(db: Session, key_column):
+    """
+    Группы пациентов с одинаковым значением ключа.
+    Строки читаются потоком в порядке индекса (key, id), поэтому группа собирается
+    без сортировки и без загрузки всей таблицы в память.
+    """
+    repeated = (
+        select(key_column)
+        .where(key_column.isnot(None))
+        .group_by(key_column)
+        .having(func.count() > 1)
     )
+    rows = db.execute(
+        select(key_column, Patient.id)
+        .where(key_column.in_(repeated))
+        .order_by(key_column, Patient.id)
+        .execution_options(yield_per=5000)
+    )
+    block_key, block = None, []
+    for key, patient_id in rows:
+        if key != block_key:
+            if len(block) > 1:
+                yield block
+            block_key, block = key, []
+        block.append(patient_id)
+    if len(block) > 1:
+        yield block
+
+
+def duplicate_report(db: Session, min_score: float = DUPLICATE_BLOCK_SCORE, limit: int = 500) -> dict:
+    """
+    Отчёт о вероятных дубликатах по всей базе.
+    1) по каждому ключу собираем группы с одинаковым значением (по индексу);
+    2) пары внутри групп — кандидаты (слишком большие группы пропускаем);
+    3) для кандидатов дочитываем только нужные колонки и считаем оценку.
+    """
+    pairs = set()
+    skipped_blocks = 0
+    for key_column in (Patient.dedup_policy_key, Patient.dedup_name_key, Patient.dedup_phone_key):
+        for block in iter_duplicate_blocks(db, key_column):
+            if len(block) > DUPLICATE_MAX_BLOCK_SIZE:
+                skipped_blocks += 1
+                continue
+            for i, first in enumerate(block):
+                for second in block[i + 1:]:
+                    pairs.add((first, second))
+
+    ids = sorted({patient_id for pair in pairs for patient_id in pair})
+    patients = {}
+    match_keys = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        for row in db.query(*DUPLICATE_COLUMNS).filter(Patient.id.in_(chunk)).all():
+            patients[row.id] = row
+            match_keys[row.id] = patient_match_keys(row.full_name, row.email, row)
+
+    scored = []
+    for first, second in pairs:
+        score, reasons = score_patient_pair(match_keys[first], match_keys[second])
+        if score >= min_score:
+            scored.append({
+                "patient_id": first,
+                "duplicate_id": second,
+                "patient_name": patients[first].full_name,
+                "duplicate_name": patients[second].full_name,
+                "score": score,
+                "reasons": reasons,
+            })
+    scored.sort(key=lambda item: (-item["score"], item["patient_id"], item["duplicate_id"]))
+    return {
+        "candidate_pairs": len(pairs),
+        "matches": len(scored),
+        "skipped_blocks": skipped_blocks,
+        "pairs": scored[:limit],
+    }
 
 
-# =================
-#   ЭНДПОИНТЫ ASSET
-# =================
-
-@app.post("/api/assets/", response_model=AssetResponse)
-async def create_asset(
-    asset: AssetCreate,
+@app.post("/api/patients/duplicates/check")
+async def check_patient_duplicates(
+    patient: PatientCreate,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Создать новый актив (кейс/запрос/задачу)."""
-    db_asset = Asset(**asset.dict())
-    db.add(db_asset)
-    db.commit()
-    db.refresh(db_asset)
-    return db_asset
+    """Проверить, нет ли уже такого пациента (до создания карточки). Возвращает кандидатов с оценкой."""
+    return find_duplicate_candidates(db, patient)
 
 
-@app.get("/api/assets/", response_model=List[AssetResponse])
-async def get_assets(
-    asset_type: Optional[str] = None,
-    status: Optional[str] = None,
+@app.get("/api/patients/duplicates")
+async def get_patient_duplicates(
+    min_score: float = Query(DUPLICATE_BLOCK_SCORE, ge=0, le=1),
+    limit: int = Query(500, ge=1, le=10000),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Отчёт о вероятных дубликатах по всей базе (только для администраторов).
+    Выполняется в пуле потоков со своей сессией, чтобы не блокировать остальные запросы.
+    """
+    return await run_in_threadpool(
+        run_job, "duplicate_report", lambda db: duplicate_report(db, min_score, limit), True
+    )
+
+
+# =========================
+#   МАССОВЫЙ ИМПОРТ ПАЦИЕНТОВ
+# =========================
+
+# Сколько строк вставляется одной транзакцией (executemany)
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+
+# Пределы одной записи CSV: строк (поле в кавычках может быть многострочным) и символов в строке.
+# Лишняя кавычка иначе склеила бы весь остаток файла в одну запись в памяти
+IMPORT_MAX_RECORD_LINES = int(os.getenv("IMPORT_MAX_RECORD_LINES", "50"))
+IMPORT_MAX_LINE_LENGTH = int(os.getenv("IMPORT_MAX_LINE_LENGTH", "65536"))
+
+# Сколько последних задач импорта помнить для просмотра прогресса
+IMPORT_JOBS_KEEP = 20
+
+# Прогресс задач импорта: (филиал, job_id) -> сводка (новые в конце)
+import_jobs = OrderedDict()
+
+
+def import_directory() -> str:
+    """Папка для файлов ошибок импорта: IMPORT_DIR или imports/ рядом с файлом базы."""
+    return tenant_subdir(os.getenv("IMPORT_DIR") or os.path.join(os.path.dirname(sqlite_database_path()), "imports"))
+
+
+async def iter_upload_lines(request: Request):
+    """
+    Строки загружаемого файла по мере поступления тела запроса.
+    В памяти держится только текущий фрагмент, а не весь файл.
+    Строка длиннее IMPORT_MAX_LINE_LENGTH не накапливается: вместо неё выдаётся None.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+    skipping = False
+    async for chunk in request.stream():
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            if skipping:
+                # Конец слишком длинной строки, о которой уже сообщили
+                skipping = False
+                continue
+            yield line.rstrip("\r") if len(line) <= IMPORT_MAX_LINE_LENGTH else None
+        if len(tail) > IMPORT_MAX_LINE_LENGTH:
+            if not skipping:
+                yield None
+            skipping, tail = True, ""
+    tail += decoder.decode(b"", final=True)
+    if tail.strip() and not skipping:
+        yield tail.rstrip("\r") if len(tail) <= IMPORT_MAX_LINE_LENGTH else None
+
+
+class CsvRecordTooLong(Exception):
+    """Запись CSV не уложилась в лимиты: скорее всего, в ней незакрытая кавычка."""
+
+
+async def iter_upload_records(request: Request, file_format: str):
+    """
+    Записи загружаемого файла: (номер строки, dict) или (номер строки, текст ошибки).
+    CSV: первая строка — заголовок с именами полей PatientCreate; поле в кавычках
+    может занимать несколько строк (разбирает csv.reader). JSONL: один JSON-объект на строку.
+    """
+    lines = iter_upload_lines(request)
+    if file_format == "jsonl":
+        line_no = 0
+        async for line in lines:
+            line_no += 1
+            if line is None:
+                yield line_no, f"Line longer than {IMPORT_MAX_LINE_LENGTH} characters"
+                continue
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, f"Invalid JSON: {e}"
+                continue
+            yield line_no, row if isinstance(row, dict) else "Expected a JSON object"
+        return
+
+    # csv.reader читает строки синхронно, поэтому перед каждой записью в буфере держим
+    # больше строк, чем может занять одна запись: читатель никогда не упирается в ещё не пришедшие данные
+    buffered = deque()   # (номер, строка), прочитанные из запроса, но ещё не отданные csv.reader
+    current = []         # строки текущей записи: номер для ошибки и повторный разбор после неё
+
+    def feed():
+        while buffered:
+            if len(current) >= IMPORT_MAX_RECORD_LINES:
+                raise CsvRecordTooLong(f"Record spans more than {IMPORT_MAX_RECORD_LINES} lines (unclosed quote?)")
+            item = buffered.popleft()
+            current.append(item)
+            if item[1] is None:
+                raise CsvRecordTooLong(f"Line longer than {IMPORT_MAX_LINE_LENGTH} characters")
+            # С переводом строки: внутри поля в кавычках он часть значения
+            yield item[1] + "\n"
+
+    reader = csv.reader(feed(), strict=True)
+    header = None
+    line_no = 0
+    eof = False
+    while True:
+        while not eof and len(buffered) <= IMPORT_MAX_RECORD_LINES:
+            try:
+                line = await lines.__anext__()
+            except StopAsyncIteration:
+                eof = True
+                break
+            line_no += 1
+            buffered.append((line_no, line))
+        try:
+            values = next(reader)
+        except StopIteration:
+            break
+        except (csv.Error, CsvRecordTooLong) as e:
+            bad_line = current[0][0]
+            # Ошибочной считается только первая строка записи, остальные разбираются заново:
+            # лишняя кавычка не должна утянуть за собой весь файл
+            buffered.extendleft(reversed(current[1:]))
+            current.clear()
+            reader = csv.reader(feed(), strict=True)
+            yield bad_line, f"Malformed CSV record: {e}"
+            continue
+        record_line = current[0][0]
+        current.clear()
+        if not any(values):
+            continue
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        if len(values) != len(header):
+            yield record_line, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        yield record_line, dict(zip(header, values))
+
+
+def patient_import_row(row: dict) -> dict:
+    """
+    Проверить строку импорта по PatientCreate и подготовить её к вставке.
+    Пустые строки считаются отсутствующими значениями. Бросает ValueError/ValidationError.
+    """
+    data = {
+        key: (value.strip() or None) if isinstance(value, str) else value
+        for key, value in row.items()
+        if key in PatientCreate.model_fields
+    }
+    patient = PatientCreate(**data)
+    values = patient.dict()
+    last_visit_raw = values.pop("last_visit", None)
+    values["last_visit"] = parse_optional_datetime(last_visit_raw)
+    if last_visit_raw and values["last_visit"] is None:
+        raise ValueError(f"Invalid last_visit: {last_visit_raw}")
+    # executemany идёт мимо ORM-событий, поэтому ключи дубликатов считаем сами
+    values.update(patient_dedup_keys(patient.full_name, patient.birth_date, patient.phone, patient.policy_number))
+    now = datetime.utcnow()
+    values["created_at"] = now
+    values["updated_at"] = now
+    return values
+
+
+def insert_patients_audited(db: Session, rows: List[dict]):
+    """
+    Вставить пациентов одним INSERT ... RETURNING и записать в аудит по строке на каждого.
+    Core-вставка идёт в обход flush, поэтому записи добавляются вручную — в ту же транзакцию.
+    Значения для журнала берутся из RETURNING вместе с id: порядок возвращённых строк
+    не гарантирован (а sort_by_parameter_order в SQLite дробит вставку по строке).
+    """
+    keys = [key for key in rows[0] if key not in AUDIT_SKIP_COLUMNS]
+    returned = db.execute(
+        insert(Patient).returning(Patient.id, *(getattr(Patient, key) for key in keys)), rows
+    ).all()
+    for row in returned:
+        changes = {key: [None, value] for key, value in zip(keys, row[1:]) if value is not None}
+        record_audit(db, "patients", row[0], "insert", changes)
+
+
+def insert_patient_chunk(chunk: List[tuple], actor=None) -> List[tuple]:
+    """
+    Вставить пачку пациентов одной транзакцией.
+    Если пачка целиком не прошла, вставляем её построчно, чтобы найти виноватые строки.
+    Возвращает список (номер строки, ошибка) для невставленных строк.
+    """
+    db = open_session()
+    db.info["audit_actor"] = actor
+    try:
+        try:
+            insert_patients_audited(db, [values for _, values in chunk])
+            db.commit()
+            return []
+        except Exception:
+            db.rollback()
+        errors = []
+        for line_no, values in chunk:
+            try:
+                insert_patients_audited(db, [values])
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                errors.append((line_no, f"Database error: {e}"))
+        return errors
+    finally:
+        db.close()
+
+
+@app.post("/api/patients/import")
+async def import_patients(
+    request: Request,
+    file_format: str = Query("csv", alias="format", pattern="^(csv|jsonl)$"),
+    job_id: Optional[str] = Query(None, pattern="^[A-Za-z0-9_-]{1,64}$"),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Массовый импорт пациентов (только для администраторов).
+    Тело запроса — CSV (с заголовком) или JSONL, читается потоком, без загрузки в память целиком.
+    Строки проверяются по PatientCreate и вставляются пачками по IMPORT_CHUNK_SIZE.
+    Прогресс: GET /api/patients/import/{job_id} (job_id можно задать самому,
+    но только новый — занятый id отклоняется с 409, чтобы не затереть чужой файл ошибок),
+    ошибки по строкам: GET /api/patients/import/{job_id}/errors.
+    """
+    tenant = current_tenant.get()
+    os.makedirs(import_directory(), exist_ok=True)
+    while True:
+        candidate = job_id or secrets.token_hex(8)
+        try:
+            if (tenant, candidate) in import_jobs:
+                raise FileExistsError(candidate)
+            # "x" — создание без перезаписи: id занимается атомарно, даже при параллельных загрузках
+            error_file = open(os.path.join(import_directory(), f"{candidate}.errors.jsonl"), "x", encoding="utf-8")
+        except FileExistsError:
+            if job_id:
+                raise HTTPException(status_code=409, detail="Import job id already in use")
+            continue
+        job_id = candidate
+        break
+    job = {
+        "job_id": job_id,
+        "status": "running",
+        "rows_read": 0,
+        "inserted": 0,
+        "failed": 0,
+        "started_at": datetime.utcnow(),
+        "finished_at": None,
+    }
+    import_jobs[(tenant, job_id)] = job
+    while len(import_jobs) > IMPORT_JOBS_KEEP:
+        import_jobs.popitem(last=False)
+
+    def record_error(error_file, line_no, error, row=None):
+        job["failed"] += 1
+        error_file.write(json.dumps({"line": line_no, "error": error, "row": row}, ensure_ascii=False, default=str) + "\n")
+
+    async def flush(chunk, error_file):
+        errors = await run_in_threadpool(insert_patient_chunk, list(chunk), (current_user.id, current_user.username))
+        for line_no, error in errors:
+            record_error(error_file, line_no, error)
+        job["inserted"] += len(chunk) - len(errors)
+        chunk.clear()
+
+    try:
+        with error_file:
+            chunk = []
+            async for line_no, row in iter_upload_records(request, file_format):
+                job["rows_read"] += 1
+                if isinstance(row, str):
+                    record_error(error_file, line_no, row)
+                    continue
+                try:
+                    chunk.append((line_no, patient_import_row(row)))
+                except ValidationError as e:
+                    message = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                    record_error(error_file, line_no, message, row)
+                    continue
+                except ValueError as e:
+                    record_error(error_file, line_no, str(e), row)
+                    continue
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    await flush(chunk, error_file)
+            if chunk:
+                await flush(chunk, error_file)
+        job["status"] = "completed"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+        raise
+    finally:
+        job["finished_at"] = datetime.utcnow()
+        if job["inserted"]:
+            audit_writer.add([audit_entry(
+                "patients", None, "import",
+                {"job_id": job_id, "inserted": job["inserted"], "failed": job["failed"]},
+                (current_user.id, current_user.username),
+            )])
+    return job
+
+
+@app.get("/api/patients/import/{job_id}")
+async def get_import_job(job_id: str, current_user: User = Depends(get_current_admin_user)):
+    """Прогресс/итог задачи импорта."""
+    job = import_jobs.get((current_tenant.get(), job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
+
+
+@app.get("/api/patients/import/{job_id}/errors")
+async def get_import_errors(job_id: str, current_user: User = Depends(get_current_admin_user)):
+    """Файл ошибок импорта (JSONL: номер строки, ошибка, исходная строка)."""
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", job_id):
+        raise HTTPException(status_code=404, detail="Import job not found")
+    path = os.path.join(import_directory(), f"{job_id}.errors.jsonl")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return FileResponse(path, media_type="application/x-ndjson", filename=f"{job_id}.errors.jsonl")
+
+
+# ===================
+#   ЭНДПОИНТЫ PATIENT
+# ===================
+
+# Триграммный индекс patients_fts (FTS5) доступен — выставляется при старте, см. ensure_patients_fts
+patients_fts_enabled = False
+
+# Колонки карточки, по которым ищет search
+PATIENT_SEARCH_COLUMNS = ("full_name", "policy_number", "phone")
+
+
+def ensure_patients_fts(bind) -> bool:
+    """
+    Создать триграммный индекс по ФИО, полису и телефону пациентов (SQLite FTS5, tokenize='trigram').
+    Триграммы позволяют искать по подстроке без учёта регистра (в том числе кириллицы) по индексу,
+    а не перебором всех карточек. Как и assets_fts, таблица хранит только индекс (content='patients'),
+    а триггеры поддерживают её при любых изменениях; на заполненной базе индекс перестраивается.
+    Возвращает False, если база не SQLite или SQLite без FTS5/trigram (тогда поиск идёт через LIKE).
+    """
+    if bind.dialect.name != "sqlite":
+        return False
+    columns = ", ".join(PATIENT_SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in PATIENT_SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in PATIENT_SEARCH_COLUMNS)
+    with bind.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'"
+        ).first()
+        try:
+            conn.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5("
+                f"{columns}, content='patients', content_rowid='id', tokenize='trigram')"
+            )
+        except OperationalError:
+            return False
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN "
+            f"INSERT INTO patients_fts(rowid, {columns}) VALUES (new.id, {new_values}); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN "
+            f"INSERT INTO patients_fts(patients_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE OF {columns} ON patients BEGIN "
+            f"INSERT INTO patients_fts(patients_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO patients_fts(rowid, {columns}) VALUES (new.id, {new_values}); "
+            "END"
+        )
+        if not exists:
+            conn.exec_driver_sql("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+    return True
+
+
+def patient_search_filter(search: str):
+    """
+    Условие поиска по подстроке в ФИО, полисе или телефоне (регистр не важен).
+    С триграммным индексом строка от 3 символов ищется через него; короче (триграмм нет)
+    или без FTS5 — LIKE по всем карточкам.
+    """
+    if patients_fts_enabled and len(search) >= 3:
+        match = '"' + search.replace('"', '""') + '"'
+        return Patient.id.in_(
+            text("SELECT rowid FROM patients_fts WHERE patients_fts MATCH :match")
+            .bindparams(match=match)
+            .columns(rowid=Integer)
+        )
+    pattern = f"%{search.lower()}%"
+    return or_(
+        func.lower(Patient.full_name).like(pattern),
+        func.lower(func.coalesce(Patient.policy_number, "")).like(pattern),
+        func.lower(func.coalesce(Patient.phone, "")).like(pattern)
+    )
+
+@app.get(
+    "/api/patients/",
+    response_model=Union[List[PatientResponse], List[PatientFieldsResponse]],
+    response_model_exclude_unset=True,
+)
+async def get_patients(
     search: Optional[str] = None,
+    order_by: str = Query("created", pattern="^(created|last_visit)$"),
+    fields: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """
-    Получить список активов с возможностью фильтрации по:
-    - типу (asset_type)
-    - статусу (status)
-    - поиску по заголовку (search)
+    Получить список пациентов.
+    Если передан search — ищет по ФИО, номеру полиса и телефону (по подстроке, регистр не важен;
+    от 3 символов — по триграммному индексу patients_fts).
+    order_by=last_visit — сначала недавно побывавшие (по индексу last_visit), иначе новые карточки сверху.
+    fields=id,full_name — вернуть только перечисленные поля (например, для выбора пациента):
+    большие текстовые поля (аллергии, препараты, заметки) тогда не читаются из базы.
     """
-    query = db.query(Asset)
-    if asset_type:
-        query = query.filter(Asset.asset_type == asset_type)
-    if status:
-        query = query.filter(Asset.status == status)
+    names = parse_fields(fields, PatientResponse)
+    query = db.query(Patient)
     if search:
-        query = query.filter(Asset.title.ilike(f"%{search}%"))
-    return query.all()
+        query = query.filter(patient_search_filter(search))
+    ordering = Patient.last_visit.desc() if order_by == "last_visit" else Patient.created_at.desc()
+    return fetch_fields(query.order_by(ordering), Patient, names)
 
 
-@app.get("/api/assets/{asset_id}", response_model=AssetResponse)
-async def get_asset(
-    asset_id: int,
+@app.post("/api/patients/", response_model=PatientResponse, status_code=status.HTTP_201_CREATED)
+async def create_patient(
+    patient: PatientCreate,
+    allow_duplicate: bool = False,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Получить актив по ID."""
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
-    if not asset:
-        raise HTTPException(status_code=404, detail="Asset not found")
-    return asset
+    """
+    Создать нового пациента.
+    last_visit (если передан строкой) конвертируется в datetime.
+    Если в базе уже есть очень похожий пациент (по полису, фамилии и дате рождения, телефону),
+    возвращается 409 со списком кандидатов; allow_duplicate=true создаёт карточку всё равно.
+    """
+    if not allow_duplicate:
+        candidates = [
+            candidate for candidate in find_duplicate_candidates(db, patient)
+            if candidate["score"] >= DUPLICATE_BLOCK_SCORE
+        ]
+        if candidates:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail={"message": "Possible duplicate patient", "candidates": candidates},
+            )
 
+    patient_data = patient.dict()
+    last_visit_raw = patient_data.pop("last_visit", None)
+    db_patient = Patient(**patient_data)
+    db_patient.last_visit = parse_optional_datetime(last_visit_raw)
+    db.add(db_patient)
+    db.commit()
+    db.refresh(db_patient)
+    return db_patient
 
-@app.put("/api/assets/{asset_id}", response_model=AssetResponse)
-async def update_asset(
-    asset_id: int,
-    asset_update: AssetUpdate,
+
+@app.get("/api/patients/{patient_id}", response_model=PatientResponse)
+async def get_patient(
+    patient_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Обновить актив (частично)."""
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
-    if not asset:
-        raise HTTPException(status_code=404, detail="Asset not found")
-    
-    for key, value in asset_update.dict(exclude_unset=True).items():
-        setattr(asset, key, value)
-    
-    asset.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(asset)
-    return asset
+    """Получить пациента по ID."""
+    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return patient
 
 
-@app.delete("/api/assets/{asset_id}")
-async def delete_asset(
-    asset_id: int,
+def encode_timeline_cursor(shift_date: str, start_time: str, shift_id: int) -> str:
+    """Курсор истории пациента: (date, start_time, id) последнего приёма на странице."""
+    raw = f"{shift_date}|{start_time}|{shift_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_timeline_cursor(cursor: str):
+    """Распаковать курсор истории пациента в (date, start_time, id); бросает ValueError."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    shift_date, start_time, shift_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+    return shift_date, start_time, int(shift_id)
+
+
+@app.get("/api/patients/{patient_id}/timeline", response_model=PatientTimelineResponse)
+async def get_patient_timeline(
+    patient_id: int,
+    limit: int = Query(20, ge=1, le=200),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Удалить актив по ID."""
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
-    if not asset:
-        raise HTTPException(status_code=404, detail="Asset not found")
-    
-    db.delete(asset)
+    """
+    История приёмов пациента, новые сверху, страницами по limit.
+    Читается по индексу (patient_id, date, start_time) с keyset-курсором: следующая страница —
+    cursor=next_cursor, без OFFSET и без загрузки всех смен. Архивные приёмы тоже попадают в историю.
+    """
+    if db.get(Patient, patient_id) is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    position = None
+    if cursor:
+        try:
+            position = decode_timeline_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    def criteria(table):
+        conditions = [table.c.patient_id == patient_id]
+        if position:
+            conditions.append(tuple_(table.c.date, table.c.start_time, table.c.id) < tuple_(*position))
+        return conditions
+
+    def newest_first(table):
+        return [table.c.date.desc(), table.c.start_time.desc(), table.c.id.desc()]
+
+    if range_needs_archive(db, "shifts", None):
+        shifts = select_hot_and_archive(Shift, shifts_archive, criteria)
+        items = db.execute(select(shifts).order_by(*newest_first(shifts)).limit(limit + 1)).all()
+    else:
+        table = Shift.__table__
+        items = db.query(Shift).filter(*criteria(table)).order_by(*newest_first(table)).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_timeline_cursor(items[-1].date, items[-1].start_time, items[-1].id)
+    return PatientTimelineResponse(items=items, next_cursor=next_cursor)
+
+
+def ensure_last_visit_triggers(bind) -> bool:
+    """
+    Триггеры SQLite, которые ведут patients.last_visit по завершённым приёмам.
+    Когда приём пациента становится completed (или сразу создаётся завершённым),
+    last_visit пациента сдвигается на дату и время начала приёма — одним UPDATE в базе,
+    и только вперёд. При первом создании триггеров last_visit досчитывается по уже завершённым приёмам.
+    Возвращает False, если база не SQLite.
+    """
+    if bind.dialect.name != "sqlite":
+        return False
+    # Время приёма в формате, в котором SQLAlchemy хранит DateTime в SQLite ("9:00" → "09:00")
+    visit = "{row}.date || ' ' || substr('0' || {row}.start_time, -5, 5) || ':00.000000'"
+    update = (
+        "UPDATE patients SET last_visit = {visit} "
+        "WHERE id = new.patient_id AND (last_visit IS NULL OR last_visit < {visit}); "
+    ).format(visit=visit.format(row="new"))
+    with bind.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'shifts_last_visit_au'"
+        ).first()
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS shifts_last_visit_ai AFTER INSERT ON shifts "
+            "WHEN new.status = 'completed' AND new.patient_id IS NOT NULL BEGIN " + update + "END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS shifts_last_visit_au AFTER UPDATE OF status, patient_id ON shifts "
+            "WHEN new.status = 'completed' AND new.patient_id IS NOT NULL BEGIN " + update + "END"
+        )
+        if not exists:
+            completed = visit.format(row="shifts")
+            conn.exec_driver_sql(
+                "UPDATE patients SET last_visit = ("
+                f"SELECT max({completed}) FROM shifts WHERE shifts.patient_id = patients.id AND shifts.status = 'completed'"
+                ") WHERE EXISTS ("
+                f"SELECT 1 FROM shifts WHERE shifts.patient_id = patients.id AND shifts.status = 'completed' "
+                f"AND (patients.last_visit IS NULL OR patients.last_visit < {completed}))"
+            )
+    return True
+
+
+@app.put("/api/patients/{patient_id}", response_model=PatientResponse)
+async def update_patient(
+    patient_id: int,
+    patient_update: PatientUpdate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Обновить данные пациента (частично или полностью)."""
+    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    update_data = patient_update.dict(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(patient, key, value)
+
+    patient.updated_at = datetime.utcnow()
     db.commit()
-    return {"message": "Asset deleted successfully"}
+    db.refresh(patient)
+    return patient
 
 
-# ====================
-#   ЭНДПОИНТЫ HANDOVER
-# ====================
+@app.patch("/api/patients/{patient_id}", response_model=PatientResponse)
+async def patch_patient(
+    patient_id: int,
+    patient_patch: PatientPatch,
+    response: Response,
+    expected_version: int = Depends(get_if_match_version),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Частичное обновление пациента с проверкой версии из If-Match."""
+    values = patient_patch.dict(exclude_unset=True)
+    values["updated_at"] = datetime.utcnow()
+
+    patient = conditional_update(db, Patient, patient_id, expected_version, values)
+    # UPDATE идёт мимо ORM-событий: ключи дубликатов пересчитываем сами, если менялись их поля
+    if values.keys() & {"full_name", "birth_date", "phone", "policy_number"}:
+        keys = patient_dedup_keys(patient.full_name, patient.birth_date, patient.phone, patient.policy_number)
+        db.execute(Patient.__table__.update().where(Patient.__table__.c.id == patient_id).values(**keys))
+    db.commit()
+    response.headers["ETag"] = f'"{patient.version}"'
+    return patient
 
-@app.post("/api/handovers/", response_model=HandoverResponse)
-async def create_handover(
-    handover: HandoverCreate,
+
+@app.delete("/api/patients/{patient_id}")
+async def delete_patient(
+    patient_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """
-    Создать передачу смены:
-    - связывает from_shift и to_shift (опционально)
-    - связывает с активами (asset_ids)
-    - создаёт упрощённый лог для последующего экспорта
+    Удалить пациента по ID (мягко: карточка скрывается сразу, а окончательно удаляется
+    фоновой очисткой после SOFT_DELETE_GRACE_DAYS, тогда же смены отвязываются от пациента).
     """
-    # Создаем handover без списка asset_ids (он обрабатывается отдельно)
-    handover_data = handover.dict()
-    asset_ids = handover_data.pop('asset_ids')
-    
-    db_handover = ShiftHandover(**handover_data)
-    db.add(db_handover)
-    db.commit()
-    db.refresh(db_handover)
-    
-    # Создаем связи с assets
-    for asset_id in asset_ids:
-        handover_asset = HandoverAsset(
-            handover_id=db_handover.id,
-            asset_id=asset_id
-        )
-        db.add(handover_asset)
-    
+    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    patient.deleted_at = datetime.utcnow()
     db.commit()
-    
-    # Получаем связанные assets для ответа
-    assets = (
-        db.query(Asset)
-        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
-        .filter(HandoverAsset.handover_id == db_handover.id)
-        .all()
-    )
-    
-    # Создаем лог передачи для простого экспорта
-    try:
-        # Получаем информацию о сменах
-        from_shift = db.query(Shift).filter(Shift.id == db_handover.from_shift_id).first() if db_handover.from_shift_id else None
-        to_shift = db.query(Shift).filter(Shift.id == db_handover.to_shift_id).first() if db_handover.to_shift_id else None
-        
-        # Подготавливаем информацию об активах (простая текстовая строка)
-        assets_info_list = []
-        for asset in assets:
-            assets_info_list.append(f"{asset.title} ({asset.asset_type}): {asset.description}")
+    return {"message": "Patient deleted successfully"}
+
+
+@app.post("/api/patients/{patient_id}/restore", response_model=PatientResponse)
+async def restore_patient(
+    patient_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Восстановить мягко удалённого пациента (админ-доступ)."""
+    return restore_deleted_row(db, Patient, patient_id)
+
+
+# ======================
+#   DASHBOARD SUMMARY
+# ======================
+
+@app.get("/api/dashboard/summary", response_model=DashboardSummary)
+async def get_dashboard_summary(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Сводка для дашборда:
+    - всего пациентов
+    - всего сотрудников
+    - активных кейсов
+    - количество будущих приёмов
+    - список ближайших 5 приёмов
+    - список 5 последних пациентов
+    """
+    total_patients = db.query(func.count(Patient.id)).scalar() or 0
+    total_staff = db.query(func.count(User.id)).scalar() or 0
+    active_cases = (
+        db.query(func.count(Asset.id))
+        .filter(Asset.status == "Active")
+        .scalar()
+        or 0
+    )
+
+    # Будущие приёмы: диапазон date >= сегодня по индексу (date, start_time),
+    # сегодняшние — только с ещё не наступившим временем начала (по местному времени клиники)
+    now = clinic_now()
+    today = now.strftime("%Y-%m-%d")
+    table = Shift.__table__
+    start = sql_time_minutes(table.c.start_time)
+    upcoming = [
+        table.c.date >= today,
+        or_(table.c.date > today, start >= now.hour * 60 + now.minute),
+    ]
+    upcoming_count = db.execute(select(func.count()).select_from(table).where(*upcoming)).scalar() or 0
+    next_appointments = (
+        db.query(Shift)
+        .filter(*upcoming)
+        .order_by(Shift.date, start)
+        .limit(5)
+        .all()
+    )
+    recent_patients = (
+        db.query(Patient)
+        .order_by(Patient.created_at.desc())
+        .limit(5)
+        .all()
+    )
+
+    return DashboardSummary(
+        total_patients=total_patients,
+        total_staff=total_staff,
+        active_cases=active_cases,
+        upcoming_appointments=upcoming_count,
+        next_appointments=next_appointments,
+        recent_patients=recent_patients,
+    )
+
+
+# =================
+#   ЭНДПОИНТЫ ASSET
+# =================
+
+# Полнотекстовый индекс assets_fts (FTS5) доступен — выставляется при старте, см. ensure_assets_fts
+assets_fts_enabled = False
+
+
+def ensure_assets_fts(bind) -> bool:
+    """
+    Создать полнотекстовый индекс по заголовку и описанию активов (SQLite FTS5).
+    Таблица assets_fts хранит только индекс (content='assets'), а триггеры держат его
+    в актуальном состоянии при любых INSERT/UPDATE/DELETE по assets.
+    Если индекс создаётся на уже заполненной базе — он перестраивается по существующим строкам.
+    Возвращает False, если база не SQLite или SQLite собран без FTS5 (тогда поиск идёт через LIKE).
+    """
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'assets_fts'"
+        ).first()
+        try:
+            conn.exec_driver_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS assets_fts USING fts5("
+                "title, description, content='assets', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')"
+            )
+        except OperationalError:
+            return False
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS assets_fts_ai AFTER INSERT ON assets BEGIN "
+            "INSERT INTO assets_fts(rowid, title, description) VALUES (new.id, new.title, new.description); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS assets_fts_ad AFTER DELETE ON assets BEGIN "
+            "INSERT INTO assets_fts(assets_fts, rowid, title, description) "
+            "VALUES ('delete', old.id, old.title, old.description); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS assets_fts_au AFTER UPDATE OF title, description ON assets BEGIN "
+            "INSERT INTO assets_fts(assets_fts, rowid, title, description) "
+            "VALUES ('delete', old.id, old.title, old.description); "
+            "INSERT INTO assets_fts(rowid, title, description) VALUES (new.id, new.title, new.description); "
+            "END"
+        )
+        if not exists:
+            conn.exec_driver_sql("INSERT INTO assets_fts(assets_fts) VALUES ('rebuild')")
+    return True
+
+
+def asset_search_filter(search: str):
+    """
+    Условие поиска по заголовку и описанию.
+    С FTS5 каждое слово ищется как префикс ("рентг" найдёт "рентген"), слова объединяются по И;
+    без FTS5 — ILIKE по подстроке.
+    """
+    words = re.findall(r"\w+", search)
+    if not words:
+        return None
+    if assets_fts_enabled:
+        match = " ".join(f'"{word}"*' for word in words)
+        return Asset.id.in_(
+            text("SELECT rowid FROM assets_fts WHERE assets_fts MATCH :match")
+            .bindparams(match=match)
+            .columns(rowid=Integer)
+        )
+    pattern = f"%{search}%"
+    return or_(Asset.title.ilike(pattern), Asset.description.ilike(pattern))
+
+
+def backfill_asset_updated_at(bind) -> int:
+    """Старые активы без updated_at (до onupdate его заполняли не везде) получают created_at."""
+    with bind.begin() as conn:
+        return conn.execute(
+            Asset.__table__.update()
+            .where(Asset.__table__.c.updated_at.is_(None))
+            .values(updated_at=func.coalesce(Asset.__table__.c.created_at, literal_column(f"'{EPOCH_SQL}'")))
+        ).rowcount
+
+
+def asset_sort_time(asset) -> datetime:
+    """Время изменения актива для курсора — то же, что ASSET_SORT_TIME в SQL."""
+    return asset.updated_at or asset.created_at or datetime.fromisoformat(EPOCH_SQL)
+
+
+def encode_asset_cursor(updated_at: datetime, asset_id: int) -> str:
+    """Курсор страницы активов: (время изменения, id) последнего элемента."""
+    raw = f"{updated_at.isoformat()}|{asset_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_asset_cursor(cursor: str):
+    """Распаковать курсор страницы активов в (updated_at, id); бросает ValueError."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    updated_raw, asset_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+    return datetime.fromisoformat(updated_raw), int(asset_id)
+
+
+@app.post("/api/assets/", response_model=AssetResponse)
+async def create_asset(
+    asset: AssetCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Создать новый актив (кейс/запрос/задачу)."""
+    db_asset = Asset(**asset.dict())
+    db.add(db_asset)
+    db.commit()
+    db.refresh(db_asset)
+    return db_asset
+
+
+@app.get(
+    "/api/assets/",
+    response_model=Union[List[AssetResponse], List[AssetFieldsResponse]],
+    response_model_exclude_unset=True,
+)
+async def get_assets(
+    asset_type: Optional[str] = None,
+    status: Optional[str] = None,
+    search: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Получить список активов с возможностью фильтрации по:
+    - типу (asset_type)
+    - статусу (status)
+    - поиску по заголовку (search)
+    fields=id,title,status — вернуть только перечисленные поля (без description).
+    Ответ кэшируется до следующего изменения таблицы assets.
+    """
+    return load_assets(db, parse_fields(fields, AssetResponse), asset_type, status, search)
+
+
+@query_cache("assets", tags=("assets",))
+def load_assets(
+    db: Session,
+    names: Optional[List[str]],
+    asset_type: Optional[str],
+    status: Optional[str],
+    search: Optional[str],
+) -> List[dict]:
+    """Список активов по фильтрам (кэшируется)."""
+    query = db.query(Asset)
+    if asset_type:
+        query = query.filter(Asset.asset_type == asset_type)
+    if status:
+        query = query.filter(Asset.status == status)
+    if search:
+        search_filter = asset_search_filter(search)
+        if search_filter is not None:
+            query = query.filter(search_filter)
+    return cacheable_rows(fetch_fields(query, Asset, names), AssetResponse, names)
+
+
+@app.get("/api/assets/page", response_model=AssetPageResponse)
+async def get_assets_page(
+    asset_type: Optional[str] = None,
+    status: Optional[str] = None,
+    search: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Страница активов (новые изменения сверху) и счётчики для фильтров.
+    - facets.asset_type — сколько активов каждого типа при текущих статусе и поиске
+    - facets.status — сколько активов в каждом статусе при текущих типе и поиске
+    - total — сколько активов подходит под все фильтры
+    Следующая страница — cursor=next_cursor (keyset по времени изменения и id, без OFFSET;
+    пустой updated_at заменяется на created_at).
+    """
+    search_filter = asset_search_filter(search) if search else None
+    type_filter = Asset.asset_type == asset_type if asset_type else None
+    status_filter = Asset.status == status if status else None
+
+    def where(*criteria):
+        return [criterion for criterion in criteria if criterion is not None]
+
+    # Все фасеты — одним запросом: GROUP BY по индексам (asset_type, status, ...) и (status, ...)
+    facet_rows = db.execute(union_all(
+        select(text("'asset_type'"), Asset.asset_type, func.count())
+        .where(*where(status_filter, search_filter))
+        .group_by(Asset.asset_type),
+        select(text("'status'"), Asset.status, func.count())
+        .where(*where(type_filter, search_filter))
+        .group_by(Asset.status),
+    )).all()
+    facets = {"asset_type": {}, "status": {}}
+    for facet, value, count in facet_rows:
+        facets[facet][value] = count
+    if asset_type:
+        total = sum(count for value, count in facets["status"].items() if not status or value == status)
+    else:
+        total = sum(facets["asset_type"].values())
+
+    query = db.query(Asset).filter(*where(type_filter, status_filter, search_filter))
+    if cursor:
+        try:
+            cursor_updated_at, cursor_id = decode_asset_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.filter(tuple_(ASSET_SORT_TIME, Asset.id) < tuple_(cursor_updated_at, cursor_id))
+    items = query.order_by(ASSET_SORT_TIME.desc(), Asset.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_asset_cursor(asset_sort_time(items[-1]), items[-1].id)
+    return AssetPageResponse(items=items, total=total, facets=facets, next_cursor=next_cursor)
+
+
+@app.get("/api/assets/{asset_id}", response_model=AssetResponse)
+async def get_asset(
+    asset_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Получить актив по ID."""
+    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+    if not asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return asset
+
+
+@app.put("/api/assets/{asset_id}", response_model=AssetResponse)
+async def update_asset(
+    asset_id: int,
+    asset_update: AssetUpdate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Обновить актив (частично)."""
+    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+    if not asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    
+    for key, value in asset_update.dict(exclude_unset=True).items():
+        setattr(asset, key, value)
+    
+    asset.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(asset)
+    return asset
+
+
+@app.delete("/api/assets/{asset_id}")
+async def delete_asset(
+    asset_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Удалить актив по ID (мягко: из передач смен он пропадает сразу,
+    а связи handover_assets удаляет фоновая очистка вместе с самим активом).
+    """
+    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+    if not asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    
+    asset.deleted_at = datetime.utcnow()
+    db.commit()
+    return {"message": "Asset deleted successfully"}
+
+
+@app.post("/api/assets/{asset_id}/restore", response_model=AssetResponse)
+async def restore_asset(
+    asset_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Восстановить мягко удалённый актив (админ-доступ)."""
+    return restore_deleted_row(db, Asset, asset_id)
+
+
+# ====================
+#   ЭНДПОИНТЫ HANDOVER
+# ====================
+
+def check_assets_exist(db: Session, asset_ids: List[int]):
+    """Все asset_ids должны ссылаться на существующие (не удалённые) активы, иначе 404."""
+    wanted = set(asset_ids)
+    if not wanted:
+        return
+    found = set(db.execute(select(Asset.id).where(Asset.id.in_(wanted))).scalars())
+    missing = sorted(wanted - found)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Assets not found: {missing}")
+
+
+def link_handover_assets(db: Session, handover_id: int, asset_ids: List[int]):
+    """Связать передачу с активами: один INSERT (executemany) на весь список вместо запроса на каждую связь."""
+    if asset_ids:
+        db.execute(insert(HandoverAsset), [{"handover_id": handover_id, "asset_id": asset_id} for asset_id in asset_ids])
+
+
+@app.post("/api/handovers/", response_model=HandoverResponse)
+async def create_handover(
+    handover: HandoverCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Создать передачу смены:
+    - связывает from_shift и to_shift (опционально)
+    - связывает с активами (asset_ids)
+    - создаёт упрощённый лог для последующего экспорта
+    """
+    # Создаем handover без списка asset_ids (он обрабатывается отдельно)
+    handover_data = handover.dict()
+    asset_ids = handover_data.pop('asset_ids')
+    check_assets_exist(db, asset_ids)
+    
+    db_handover = ShiftHandover(**handover_data)
+    db.add(db_handover)
+    db.flush()
+    
+    # Создаем связи с assets (в той же транзакции, что и сама передача)
+    link_handover_assets(db, db_handover.id, asset_ids)
+    db.commit()
+    
+    # Получаем связанные assets для ответа
+    assets = (
+        db.query(Asset)
+        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
+        .filter(HandoverAsset.handover_id == db_handover.id)
+        .all()
+    )
+    
+    # Ответ собираем до записи лога: коммит лога иначе заставил бы перечитывать каждый актив
+    result = HandoverResponse(
+        id=db_handover.id,
+        from_shift_id=db_handover.from_shift_id,
+        to_shift_id=db_handover.to_shift_id,
+        handover_notes=db_handover.handover_notes,
+        assets=assets,
+        created_at=db_handover.created_at,
+        version=db_handover.version
+    )
+    
+    # Создаем лог передачи для простого экспорта
+    try:
+        # Получаем информацию о сменах
+        from_shift = db.query(Shift).filter(Shift.id == db_handover.from_shift_id).first() if db_handover.from_shift_id else None
+        to_shift = db.query(Shift).filter(Shift.id == db_handover.to_shift_id).first() if db_handover.to_shift_id else None
+        
+        # Подготавливаем информацию об активах (простая текстовая строка)
+        assets_info_list = []
+        for asset in assets:
+            assets_info_list.append(f"{asset.title} ({asset.asset_type}): {asset.description}")
         assets_info_str = "; ".join(assets_info_list) if assets_info_list else "Нет активов"
         
         # Создаем лог (упрощённую запись для экспорта)
-        now = datetime.now()
+        now = clinic_now()
         handover_log = HandoverLog(
             log_date=now.strftime("%Y-%m-%d"),
             log_time=now.strftime("%H:%M:%S"),
@@ -1331,248 +5087,1865 @@ async def create_handover(
         # Логирование ошибок при создании лога, не ломает основной процесс
         print(f"Error creating handover log: {e}")
     
-    # Возвращаем HandoverResponse
-    return HandoverResponse(
-        id=db_handover.id,
-        from_shift_id=db_handover.from_shift_id,
-        to_shift_id=db_handover.to_shift_id,
-        handover_notes=db_handover.handover_notes,
-        assets=assets,
-        created_at=db_handover.created_at
-    )
+    return result
+
+
+@app.get("/api/handovers/", response_model=List[HandoverResponse])
+async def get_handovers(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Получить список всех передач смен.
+    Для каждой передачи также подтягиваются связанные активы.
+    """
+    handovers = db.query(ShiftHandover).order_by(ShiftHandover.created_at.desc()).all()
+
+    # Активы всех передач одним запросом вместо запроса на каждую передачу
+    assets_by_handover = {}
+    linked = db.query(HandoverAsset.handover_id, Asset).join(Asset, Asset.id == HandoverAsset.asset_id).all()
+    for handover_id, asset in linked:
+        assets_by_handover.setdefault(handover_id, []).append(asset)
+
+    result = []
+    for handover in handovers:
+        assets = assets_by_handover.get(handover.id, [])
+        result.append(HandoverResponse(
+            id=handover.id,
+            from_shift_id=handover.from_shift_id,
+            to_shift_id=handover.to_shift_id,
+            handover_notes=handover.handover_notes,
+            assets=assets,
+            created_at=handover.created_at,
+            version=handover.version
+        ))
+    
+    return result
+
+
+def handover_log_export_row(log: HandoverLog) -> dict:
+    """Представление одного лога передачи в формате экспорта."""
+    return {
+        "id": log.id,
+        "date": str(log.log_date),
+        "time": str(log.log_time),
+        "from_shift_user": str(log.from_shift_user),
+        "from_shift_time": str(log.from_shift_time),
+        "to_shift_user": str(log.to_shift_user),
+        "to_shift_time": str(log.to_shift_time),
+        "handover_notes": str(log.handover_notes),
+        "assets_info": str(log.assets_info)
+    }
+
+
+# Сколько дней хранятся "надгробия" удалённых логов; курсор, не дочитавший удаления за это время, отклоняется (410)
+HANDOVER_TOMBSTONE_RETENTION_DAYS = int(os.getenv("HANDOVER_TOMBSTONE_RETENTION_DAYS", "90"))
+
+
+def record_handover_log_tombstones(db: Session, ids_query):
+    """Записать "надгробия" логов, чьи id выбирает ids_query (SELECT id ...), — до самого удаления."""
+    ids = ids_query.subquery()
+    db.execute(
+        HandoverLogTombstone.__table__.insert().from_select(
+            ["log_id", "deleted_at"], select(ids.c[0], func.current_timestamp()).order_by(ids.c[0])
+        )
+    )
+
+
+def purge_handover_log_tombstones(db: Session, retention_days: Optional[int] = None) -> int:
+    """
+    Удалить надгробия старше срока хранения.
+    Границу (archive_watermarks) поднимаем ДО удаления: курсор, получивший удаления
+    только до неё, дальше не принимается — клиент делает полную выгрузку заново.
+    """
+    retention_days = retention_days if retention_days is not None else HANDOVER_TOMBSTONE_RETENTION_DAYS
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    raise_archive_watermark(db, "handover_log_tombstones", cutoff, cutoff.isoformat())
+    deleted = db.query(HandoverLogTombstone).filter(
+        HandoverLogTombstone.deleted_at < cutoff
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+def current_export_cursor(db: Session) -> str:
+    """Курсор, указывающий на текущий "конец" логов и удалений (оба чтения идут по индексам)."""
+    seen_at = datetime.utcnow()
+    last_log = (
+        db.query(HandoverLog.created_at, HandoverLog.id)
+        .order_by(HandoverLog.created_at.desc(), HandoverLog.id.desc())
+        .first()
+    )
+    if last_log is None and range_needs_archive(db, "handover_logs", None):
+        last_log = db.execute(
+            select(handover_logs_archive.c.created_at, handover_logs_archive.c.id)
+            .order_by(handover_logs_archive.c.created_at.desc(), handover_logs_archive.c.id.desc())
+            .limit(1)
+        ).first()
+    last_tombstone_id = db.query(func.max(HandoverLogTombstone.id)).scalar() or 0
+    if last_log:
+        return encode_export_cursor(last_log.created_at, last_log.id, last_tombstone_id, seen_at)
+    return encode_export_cursor(None, 0, last_tombstone_id, seen_at)
+
+
+def export_handover_log_delta(db: Session, since: str, limit: int) -> dict:
+    """
+    Инкрементальный экспорт логов передач.
+    Возвращает только записи новее курсора (в порядке индекса (created_at, id)),
+    id удалённых с тех пор записей и новый курсор.
+    Стоимость зависит от числа новых записей, а не от размера всей истории.
+    Если нужные курсору надгробия уже очищены — 410, клиенту нужна полная выгрузка.
+    """
+    started_at = datetime.utcnow()
+    try:
+        since_created_at, since_log_id, since_tombstone_id, since_seen_at = decode_export_cursor(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid export cursor")
+    if since:
+        pruned_before = get_archive_watermark(db, "handover_log_tombstones")
+        if pruned_before is not None and (since_seen_at is None or since_seen_at < pruned_before):
+            raise HTTPException(status_code=410, detail="Export cursor expired, run a full export")
+
+    def newer_than_cursor(table):
+        if since_created_at is None:
+            return []
+        # Сравнение кортежей (created_at, id) > (?, ?) SQLite выполняет как диапазон по индексу
+        return [tuple_(table.c.created_at, table.c.id) > tuple_(since_created_at, since_log_id)]
+
+    # Клиент, отставший дальше границы архивации, дочитывает и архивные записи
+    source = HandoverLog.__table__
+    if range_needs_archive(db, "handover_logs", since_created_at):
+        source = select_hot_and_archive(HandoverLog, handover_logs_archive, newer_than_cursor)
+    # Берём на одну запись больше, чтобы понять, есть ли продолжение
+    logs = db.execute(
+        select(source)
+        .where(*newer_than_cursor(source))
+        .order_by(source.c.created_at, source.c.id)
+        .limit(limit + 1)
+    ).all()
+    tombstones = (
+        db.query(HandoverLogTombstone)
+        .filter(HandoverLogTombstone.id > since_tombstone_id)
+        .order_by(HandoverLogTombstone.id)
+        .limit(limit + 1)
+        .all()
+    )
+    tombstones_left = len(tombstones) > limit
+    has_more = len(logs) > limit or tombstones_left
+    logs = logs[:limit]
+    tombstones = tombstones[:limit]
+
+    next_created_at, next_log_id = since_created_at, since_log_id
+    if logs:
+        next_created_at, next_log_id = logs[-1].created_at, logs[-1].id
+    next_tombstone_id = tombstones[-1].id if tombstones else since_tombstone_id
+    # Если удаления выданы не все, "прочитано до" остаётся прежним
+    next_seen_at = since_seen_at if tombstones_left else started_at
+
+    export_data = [handover_log_export_row(log) for log in logs]
+    return {
+        "data": export_data,
+        "deleted_ids": [tombstone.log_id for tombstone in tombstones],
+        "total": len(export_data),
+        "next_cursor": encode_export_cursor(next_created_at, next_log_id, next_tombstone_id, next_seen_at),
+        "has_more": has_more,
+        "success": True
+    }
+
+
+@app.get("/api/handovers/export")
+async def export_handovers(
+    since: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Экспорт всех передач смен из упрощённых логов (HandoverLog).
+    Возвращает простой JSON, пригодный для последующей выгрузки в Excel/Google Sheets.
+
+    Также, если логов ещё нет, создаёт тестовую запись для проверки.
+
+    Инкрементальный режим: если передан since (курсор из next_cursor прошлого ответа,
+    пустая строка — с начала), возвращаются только новые записи (не более limit),
+    список удалённых id (deleted_ids) и новый курсор. Пока has_more=true,
+    клиент повторяет запрос с новым курсором.
+    """
+    if since is not None:
+        return export_handover_log_delta(db, since, limit)
+
+    print(f"=== LOG EXPORT REQUEST START ===")
+    print(f"Export request from user: {current_user.username}")
+    
+    try:
+        # Сначала проверяем, есть ли уже логи
+        logs_count = db.query(HandoverLog).count()
+        print(f"Current logs count: {logs_count}")
+        
+        if logs_count == 0 and not range_needs_archive(db, "handover_logs", None):
+            print("No logs found, creating a test log entry...")
+            # Создаем тестовый лог
+            from datetime import datetime
+            test_log = HandoverLog(
+                log_date="2024-01-15",
+                log_time="14:30:00",
+                from_shift_user="Тестовый Пользователь 1",
+                from_shift_time="09:00-21:00",
+                to_shift_user="Тестовый Пользователь 2", 
+                to_shift_time="21:00-09:00",
+                handover_notes="Тестовая передача смены для проверки экспорта",
+                assets_info="Тестовый кейс (CASE): Проверка работы системы"
+            )
+            db.add(test_log)
+            db.commit()
+            print("Test log created successfully")
+        
+        # Получаем все логи передач (включая перенесённые в архив)
+        if range_needs_archive(db, "handover_logs", None):
+            all_logs = select_hot_and_archive(HandoverLog, handover_logs_archive, lambda table: [])
+            logs = db.execute(select(all_logs).order_by(all_logs.c.created_at.desc())).all()
+        else:
+            logs = db.query(HandoverLog).order_by(HandoverLog.created_at.desc()).all()
+        print(f"Found {len(logs)} handover logs to export")
+        
+        # Очень простая структура данных для экспорта
+        export_data = []
+        for i, log in enumerate(logs):
+            try:
+                log_dict = handover_log_export_row(log)
+                export_data.append(log_dict)
+                print(f"Processed log {i+1}/{len(logs)}: ID {log.id}")
+            except Exception as e:
+                # Если какая-то запись сломана — просто логируем ошибку и продолжаем
+                print(f"Error processing log {log.id}: {e}")
+                continue
+        
+        result = {
+            "data": export_data,
+            "total": len(export_data),
+            # Курсор для последующих инкрементальных выгрузок (?since=...)
+            "next_cursor": current_export_cursor(db),
+            "success": True
+        }
+        
+        print(f"Export completed successfully. Processed {len(export_data)} logs")
+        print(f"Returning result: {len(str(result))} characters")
+        
+        return result
+        
+    except Exception as e:
+        # Глобальная обработка ошибок экспорта
+        print(f"Log export error: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            "data": [],
+            "total": 0,
+            "error": str(e),
+            "success": False
+        }
+
+
+@app.get("/api/handovers/{handover_id}", response_model=HandoverResponse)
+async def get_handover(
+    handover_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Получить конкретную передачу смены по ID."""
+    handover = db.query(ShiftHandover).filter(ShiftHandover.id == handover_id).first()
+    if not handover:
+        raise HTTPException(status_code=404, detail="Handover not found")
+    
+    assets = (
+        db.query(Asset)
+        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
+        .filter(HandoverAsset.handover_id == handover.id)
+        .all()
+    )
+    
+    return HandoverResponse(
+        id=handover.id,
+        from_shift_id=handover.from_shift_id,
+        to_shift_id=handover.to_shift_id,
+        handover_notes=handover.handover_notes,
+        assets=assets,
+        created_at=handover.created_at,
+        version=handover.version
+    )
+
+
+@app.put("/api/handovers/{handover_id}", response_model=HandoverResponse)
+async def update_handover(
+    handover_id: int,
+    handover_update: HandoverCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Обновить передачу смены:
+    - меняем информацию о сменах
+    - переопределяем список связанных активов
+    """
+    handover = db.query(ShiftHandover).filter(ShiftHandover.id == handover_id).first()
+    if not handover:
+        raise HTTPException(status_code=404, detail="Handover not found")
+    
+    # Обновляем данные handover
+    handover_data = handover_update.dict()
+    asset_ids = handover_data.pop('asset_ids')
+    check_assets_exist(db, asset_ids)
+    
+    for key, value in handover_data.items():
+        setattr(handover, key, value)
+    
+    # Удаляем старые связи с assets
+    db.query(HandoverAsset).filter(HandoverAsset.handover_id == handover_id).delete()
+    
+    # Создаем новые связи с assets
+    link_handover_assets(db, handover.id, asset_ids)
+    
+    db.commit()
+    db.refresh(handover)
+    
+    # Получаем связанные assets для ответа
+    assets = (
+        db.query(Asset)
+        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
+        .filter(HandoverAsset.handover_id == handover.id)
+        .all()
+    )
+    
+    return HandoverResponse(
+        id=handover.id,
+        from_shift_id=handover.from_shift_id,
+        to_shift_id=handover.to_shift_id,
+        handover_notes=handover.handover_notes,
+        assets=assets,
+        created_at=handover.created_at,
+        version=handover.version
+    )
+
+
+@app.patch("/api/handovers/{handover_id}", response_model=HandoverResponse)
+async def patch_handover(
+    handover_id: int,
+    handover_patch: HandoverPatch,
+    response: Response,
+    expected_version: int = Depends(get_if_match_version),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Частичное обновление передачи смены с проверкой версии из If-Match.
+    Связи с активами перезаписываются, только если передан asset_ids.
+    """
+    values = handover_patch.dict(exclude_unset=True)
+    asset_ids = values.pop("asset_ids", None)
+    if asset_ids is not None:
+        check_assets_exist(db, asset_ids)
+
+    handover = conditional_update(db, ShiftHandover, handover_id, expected_version, values)
+    if asset_ids is not None:
+        db.query(HandoverAsset).filter(HandoverAsset.handover_id == handover_id).delete()
+        link_handover_assets(db, handover_id, asset_ids)
+    db.commit()
+
+    assets = (
+        db.query(Asset)
+        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
+        .filter(HandoverAsset.handover_id == handover_id)
+        .all()
+    )
+    response.headers["ETag"] = f'"{handover.version}"'
+    return HandoverResponse(
+        id=handover.id,
+        from_shift_id=handover.from_shift_id,
+        to_shift_id=handover.to_shift_id,
+        handover_notes=handover.handover_notes,
+        assets=assets,
+        created_at=handover.created_at,
+        version=handover.version
+    )
+
+
+@app.delete("/api/handovers/logs/{log_id}")
+async def delete_handover_log(
+    log_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Удалить одну запись журнала передач (ТОЛЬКО для администраторов), в том числе из архива.
+    Удаление попадает в инкрементальный экспорт через "надгробие".
+    """
+    deleted = 0
+    for table in (HandoverLog.__table__, handover_logs_archive):
+        record_handover_log_tombstones(db, select(table.c.id).where(table.c.id == log_id))
+        deleted += db.execute(table.delete().where(table.c.id == log_id)).rowcount
+    if not deleted:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="Handover log not found")
+    db.commit()
+    return {"message": "Handover log deleted", "id": log_id}
+
+
+@app.delete("/api/handovers/clear")
+async def clear_handovers(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Очистка всех передач смен и логов (ТОЛЬКО для администраторов).
+    Полностью удаляет:
+    - связи handover_assets
+    - сами handovers
+    - логи handover_logs
+    """
+    # Удаляем все связи с активами
+    db.query(HandoverAsset).delete()
+    
+    # Удаляем все передачи смен
+    handovers_count = db.query(ShiftHandover).count()
+    db.query(ShiftHandover).delete()
+    
+    # Удаляем все логи передач, оставляя "надгробия" для инкрементального экспорта
+    logs_count = db.query(HandoverLog).count()
+    record_handover_log_tombstones(db, select(HandoverLog.id))
+    db.query(HandoverLog).delete()
+    # Архивные логи тоже считаются частью журнала
+    record_handover_log_tombstones(db, select(handover_logs_archive.c.id))
+    logs_count += db.execute(handover_logs_archive.delete()).rowcount
+    
+    db.commit()
+    
+    return {
+        "message": f"Удалено {handovers_count} передач смен и {logs_count} логов", 
+        "deleted_handovers": handovers_count,
+        "deleted_logs": logs_count
+    }
+
+
+# ====================
+#   ПАКЕТНЫЕ ЗАПРОСЫ
+# ====================
+
+# Максимум подзапросов в одном пакете
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))
+
+# Заголовки подзапроса, которые клиент может задать сам (остальные не передаются)
+BATCH_FORWARDED_HEADERS = {"if-match", "idempotency-key"}
+
+
+async def run_batch_item(request: Request, item: BatchItem, db: Session, user: User) -> BatchResult:
+    """
+    Выполнить подзапрос через тот же ASGI-приложение (маршруты, валидация, обработчики ошибок),
+    но с общей сессией БД и уже проверенным пользователем из scope["state"].
+    """
+    path, _, query = item.path.partition("?")
+    if not path.startswith("/api/") or path.rstrip("/") == "/api/batch":
+        return BatchResult(id=item.id, status=400, body={"detail": "Only /api/ paths are allowed in a batch"})
+
+    body = json.dumps(item.body).encode() if item.body is not None else b""
+    headers = [
+        (b"authorization", request.headers.get("authorization", "").encode()),
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ] + [
+        (name.lower().encode(), value.encode())
+        for name, value in item.headers.items()
+        if name.lower() in BATCH_FORWARDED_HEADERS
+    ]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": item.method,
+        "scheme": request.url.scheme,
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": headers,
+        "client": request.scope.get("client"),
+        "server": request.scope.get("server"),
+        "state": {"batch_db": db, "batch_user": user},
+    }
+
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Клиент подзапроса никогда не "отключается"
+        await asyncio.Event().wait()
+
+    response = {"status": 500, "headers": {}, "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {
+                name.decode(): value.decode()
+                for name, value in message.get("headers", [])
+                if name.lower() not in (b"content-length", b"content-type")
+            }
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        # Ответ 500 уже сформирован; сессию возвращаем в рабочее состояние для следующих подзапросов
+        db.rollback()
+
+    try:
+        result_body = json.loads(response["body"]) if response["body"] else None
+    except ValueError:
+        result_body = response["body"].decode("utf-8", errors="replace")
+    return BatchResult(id=item.id, status=response["status"], headers=response["headers"], body=result_body)
+
+
+@app.post("/api/batch", response_model=BatchResponse)
+async def run_batch(
+    batch: BatchRequest,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Выполнить несколько запросов API одним обращением.
+    Пользователь проверяется один раз, все подзапросы работают в одной сессии БД строго по порядку
+    (сессия не рассчитана на одновременное использование, а обработчики синхронно ждут базу).
+    Если в пакете только чтения, они идут в одной транзакции чтения (согласованный снимок данных).
+    Подзапрос, который сам завершил транзакцию (commit при ошибке или побочной записи, rollback),
+    обрывает снимок: следующие читают уже новый, и в ответе consistent=false.
+    У каждого подзапроса свой статус: ошибка одного не отменяет остальные.
+    """
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} requests per batch")
+
+    # Подзапросы читают в транзакции пакета — мимо кэша запросов (см. query_cache)
+    db.info["query_cache_bypass"] = True
+    read_only = all(item.method == "GET" for item in batch.requests)
+    explicit_begin = read_only and db.get_bind().dialect.name == "sqlite"
+
+    def begin_snapshot():
+        if explicit_begin:
+            # В SQLite чтение без явной транзакции видит каждый SELECT отдельно — открываем её сами
+            db.connection().exec_driver_sql("BEGIN")
+        else:
+            db.connection()
+        return db.get_transaction()
+
+    results = []
+    consistent = read_only
+    snapshot = begin_snapshot() if read_only else None
+    try:
+        for item in batch.requests:
+            if snapshot is not None and db.get_transaction() is not snapshot:
+                # Предыдущий подзапрос завершил транзакцию снимка
+                consistent = False
+                snapshot = begin_snapshot()
+            results.append(await run_batch_item(request, item, db, current_user))
+        if snapshot is not None and db.get_transaction() is not snapshot:
+            consistent = False
+    finally:
+        if read_only:
+            db.rollback()
+    return BatchResponse(results=results, consistent=consistent)
+
+
+# ==================
+#   ЖУРНАЛ АУДИТА
+# ==================
+
+# Сколько записей пишется в базу одной транзакцией
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+
+# Как часто фоновый поток сбрасывает накопленное (в секундах); полная пачка пишется сразу
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "2"))
+
+# Сколько записей держать в памяти; лишнее сразу уходит в spool-файл
+AUDIT_MAX_BUFFER = int(os.getenv("AUDIT_MAX_BUFFER", "10000"))
+
+# Какие модели аудируются и какие колонки в журнал не попадают
+AUDITED_MODELS = (Patient, Shift, User, Asset)
+AUDIT_SKIP_COLUMNS = {"updated_at", "version", "dedup_name_key", "dedup_phone_key", "dedup_policy_key"}
+AUDIT_MASKED_COLUMNS = {"hashed_password"}
+
+
+def audit_spool_path() -> str:
+    """JSONL-файл для записей, которые не удалось записать в базу: AUDIT_SPOOL_PATH или рядом с базой."""
+    if os.getenv("AUDIT_SPOOL_PATH"):
+        return os.getenv("AUDIT_SPOOL_PATH")
+    if engine.url.get_backend_name() == "sqlite" and engine.url.database:
+        return os.path.join(os.path.dirname(os.path.abspath(engine.url.database)), "audit_spool.jsonl")
+    return os.path.abspath("audit_spool.jsonl")
+
+
+def audit_entry(entity: str, entity_id: Optional[int], action: str, changes: Optional[dict], actor=None) -> dict:
+    """Строка для таблицы audit_log; actor — (user_id, username) или None для системных изменений."""
+    user_id, username = actor or (None, None)
+    return {
+        "tenant": current_tenant.get(),    # в какую базу писать; в саму таблицу не попадает
+        "entity": entity,
+        "entity_id": entity_id,
+        "action": action,
+        "changes": json.dumps(changes, ensure_ascii=False, default=str) if changes else None,
+        "user_id": user_id,
+        "username": username,
+        "created_at": datetime.utcnow(),
+    }
+
+
+def record_audit(db: Session, entity: str, entity_id: Optional[int], action: str, changes: Optional[dict] = None):
+    """
+    Добавить запись к изменениям текущей транзакции сессии.
+    В журнал она попадёт только после commit (при rollback отбрасывается).
+    Используется там, где данные меняются Core-запросами в обход flush.
+    """
+    db.info.setdefault("audit_pending", []).append(
+        audit_entry(entity, entity_id, action, changes, db.info.get("audit_actor"))
+    )
+
+
+def audit_value(key: str, value):
+    return "***" if key in AUDIT_MASKED_COLUMNS and value is not None else value
+
+
+def audit_object_changes(obj, action: str) -> dict:
+    """
+    Изменения объекта ORM: {"поле": [старое, новое]}.
+    Значения берутся из состояния объекта и истории атрибутов, без запросов к базе.
+    """
+    state = inspect(obj)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        key = attr.key
+        if key in AUDIT_SKIP_COLUMNS:
+            continue
+        if action == "insert":
+            old, new = None, state.dict.get(key)
+        elif action == "delete":
+            old, new = state.dict.get(key), None
+        else:
+            history = state.attrs[key].history
+            if not history.has_changes():
+                continue
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+        if old != new:
+            changes[key] = [audit_value(key, old), audit_value(key, new)]
+    return changes
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def collect_audit_entries(session, flush_context):
+    """После flush (id уже известны, история атрибутов ещё не сброшена) собираем изменения сессии."""
+    actor = session.info.get("audit_actor")
+    pending = session.info.setdefault("audit_pending", [])
+    for objects, action in ((session.new, "insert"), (session.dirty, "update"), (session.deleted, "delete")):
+        for obj in objects:
+            if not isinstance(obj, AUDITED_MODELS):
+                continue
+            changes = audit_object_changes(obj, action)
+            entry_action = action
+            if action == "update":
+                if not changes:
+                    continue
+                if "deleted_at" in changes:
+                    entry_action = "restore" if changes["deleted_at"][1] is None else "delete"
+            pending.append(audit_entry(obj.__tablename__, obj.id, entry_action, changes, actor))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def queue_audit_entries(session):
+    """Транзакция зафиксирована — отдаём её записи фоновому писателю (без ожидания базы)."""
+    pending = session.info.pop("audit_pending", None)
+    if pending:
+        audit_writer.add(pending)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def drop_audit_entries(session):
+    session.info.pop("audit_pending", None)
+
+
+class AuditWriter:
+    """
+    Фоновая запись журнала аудита.
+    Записи копятся в памяти (не больше max_buffer) и пишутся в базу пачками из отдельного потока,
+    поэтому запрос не ждёт вставки в журнал. Если база недоступна или буфер переполнен,
+    записи дописываются в JSONL-файл (spool) и переносятся в базу при следующей удачной записи.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_buffer: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = deque()
+        self._lock = threading.Lock()        # буфер
+        self._flush_lock = threading.Lock()  # одна запись в базу за раз
+        self._spool_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, entries: List[dict]):
+        overflow = []
+        with self._lock:
+            self._buffer.extend(entries)
+            while len(self._buffer) > self.max_buffer:
+                overflow.append(self._buffer.popleft())
+            full = len(self._buffer) >= self.batch_size
+        if overflow:
+            self._spool(overflow)
+        if full:
+            self._wake.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def _take(self) -> List[dict]:
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+
+    def _insert(self, entries: List[dict]) -> List[dict]:
+        """
+        Вставить записи в базы их филиалов (по транзакции на филиал).
+        Возвращает записи, которые вставить не удалось.
+        """
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry.get("tenant"), []).append(entry)
+        failed = []
+        for tenant, group in groups.items():
+            try:
+                with engine_for(tenant).begin() as conn:
+                    conn.execute(insert(AuditLog), [
+                        {key: value for key, value in entry.items() if key != "tenant"} for entry in group
+                    ])
+            except Exception as e:
+                print(f"Audit flush failed{f' for tenant {tenant}' if tenant else ''}, {len(group)} entries spooled: {e}")
+                failed.extend(group)
+        return failed
+
+    def _spool(self, entries: List[dict]):
+        with self._spool_lock, open(audit_spool_path(), "a", encoding="utf-8") as spool:
+            for entry in entries:
+                spool.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+    def _replay_spool(self) -> int:
+        """
+        Перенести spool в базу. Файл сначала переименовывается (новые записи пойдут в новый spool),
+        затем вставляется (по транзакции на филиал) и удаляется; то, что вставить не удалось,
+        снова дописывается в spool. Если процесс упал посередине, файл перенесётся повторно —
+        записи могут задвоиться, но не теряются.
+        """
+        path = audit_spool_path()
+        claimed = f"{path}.{os.getpid()}.replay"
+        with self._spool_lock:
+            if os.path.exists(path) and not os.path.exists(claimed):
+                os.replace(path, claimed)
+        if not os.path.exists(claimed):
+            return 0
+        with open(claimed, encoding="utf-8") as spool:
+            entries = [json.loads(line) for line in spool if line.strip()]
+        for entry in entries:
+            entry["created_at"] = datetime.fromisoformat(entry["created_at"])
+        failed = self._insert(entries)
+        if failed:
+            self._spool(failed)
+        os.remove(claimed)
+        return len(entries) - len(failed)
+
+    def flush(self) -> int:
+        """Записать в базу всё накопленное (и spool). Возвращает число записанных строк."""
+        with self._flush_lock:
+            written = 0
+            try:
+                written += self._replay_spool()
+            except Exception as e:
+                print(f"Audit spool replay failed: {e}")
+            while True:
+                batch = self._take()
+                if not batch:
+                    break
+                failed = self._insert(batch)
+                written += len(batch) - len(failed)
+                if failed:
+                    self._spool(failed)
+                    break
+            return written
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=30)
+            self._thread = None
+        self.flush()
+
+
+audit_writer = AuditWriter(AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL_SECONDS, AUDIT_MAX_BUFFER)
+
+# Процесс без lifespan (скрипты, тесты) тоже не теряет накопленное при нормальном завершении
+atexit.register(audit_writer.flush)
+
+
+@app.on_event("startup")
+async def start_audit_writer():
+    audit_writer.start()
+
+
+@app.on_event("shutdown")
+async def stop_audit_writer():
+    await run_in_threadpool(audit_writer.stop)
+
+
+def ensure_audit_log_append_only(bind) -> bool:
+    """Запретить UPDATE и DELETE журнала аудита триггерами (только SQLite)."""
+    if bind.dialect.name != "sqlite":
+        return False
+    with bind.begin() as conn:
+        for operation in ("UPDATE", "DELETE"):
+            conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS audit_log_no_{operation.lower()} BEFORE {operation} ON audit_log "
+                "BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END"
+            )
+    return True
+
+
+def encode_audit_cursor(created_at: datetime, entry_id: int) -> str:
+    """Курсор журнала аудита: (created_at, id) последней записи страницы."""
+    raw = f"{created_at.isoformat()}|{entry_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_audit_cursor(cursor: str):
+    """Распаковать курсор журнала аудита в (created_at, id); бросает ValueError."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_raw, entry_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+    return datetime.fromisoformat(created_raw), int(entry_id)
+
+
+@app.get("/api/audit", response_model=AuditPageResponse)
+async def get_audit_log(
+    entity: Optional[str] = Query(None, pattern="^(patients|shifts|users|assets)$"),
+    entity_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Журнал аудита (только для администраторов), новые записи сверху.
+    entity + entity_id — история одной записи (по индексу entity, entity_id, created_at).
+    Перед чтением накопленные в памяти записи сбрасываются в базу.
+    Следующая страница — cursor=next_cursor.
+    """
+    if entity_id is not None and entity is None:
+        raise HTTPException(status_code=400, detail="entity_id requires entity")
+    await run_in_threadpool(audit_writer.flush)
+
+    query = db.query(AuditLog)
+    if entity:
+        query = query.filter(AuditLog.entity == entity)
+    if entity_id is not None:
+        query = query.filter(AuditLog.entity_id == entity_id)
+    if cursor:
+        try:
+            cursor_created_at, cursor_id = decode_audit_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.filter(tuple_(AuditLog.created_at, AuditLog.id) < tuple_(cursor_created_at, cursor_id))
+    rows = query.order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_audit_cursor(rows[-1].created_at, rows[-1].id)
+    items = [
+        AuditEntryResponse(
+            id=row.id,
+            entity=row.entity,
+            entity_id=row.entity_id,
+            action=row.action,
+            changes=json.loads(row.changes) if row.changes else None,
+            user_id=row.user_id,
+            username=row.username,
+            created_at=row.created_at,
+        )
+        for row in rows
+    ]
+    return AuditPageResponse(items=items, next_cursor=next_cursor)
+
+
+# =================
+#   ФОНОВЫЕ ЗАДАЧИ
+# =================
+
+# Зарегистрированные периодические задачи: (имя, интервал в секундах, функция(db))
+PERIODIC_JOBS = []
+
+# Запущенные asyncio-задачи (отменяются при остановке приложения)
+_periodic_tasks = []
+
+
+def register_periodic_job(name: str, interval_seconds: int, job, per_tenant: bool = True):
+    """
+    Зарегистрировать периодическую задачу.
+    job(db) выполняется в пуле потоков со своей сессией БД, чтобы не блокировать event loop.
+    При нескольких филиалах задача выполняется по очереди для базы каждого из них
+    (per_tenant=False — один раз, с основной базой).
+    Интервал <= 0 отключает расписание (задачу по-прежнему можно вызвать вручную).
+    """
+    if interval_seconds > 0:
+        PERIODIC_JOBS.append((name, interval_seconds, job, per_tenant))
+    return job
+
+
+def run_job(name: str, job, reraise: bool = False):
+    """
+    Выполнить задачу с отдельной сессией.
+    В периодическом режиме ошибки только логируются и не роняют цикл;
+    при ручном запуске (reraise=True) пробрасываются вызывающему.
+    """
+    db = open_session()
+    try:
+        return job(db)
+    except Exception as e:
+        db.rollback()
+        tenant = current_tenant.get()
+        print(f"Periodic job {name} failed{f' for tenant {tenant}' if tenant else ''}: {e}")
+        if reraise:
+            raise
+    finally:
+        db.close()
+
+
+async def _periodic_job_loop(name: str, interval_seconds: int, job, per_tenant: bool):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        for tenant in job_tenants() if per_tenant else [None]:
+            token = current_tenant.set(tenant)
+            try:
+                await run_in_threadpool(run_tenant_job, name, job)
+            finally:
+                current_tenant.reset(token)
+
+
+def run_tenant_job(name: str, job):
+    """Периодическая задача для текущего филиала: база берётся у реестра без отметки об использовании."""
+    tenant = current_tenant.get()
+    if tenant is None:
+        return run_job(name, job)
+    try:
+        with tenant_engines.borrow(tenant) as bind:
+            token = job_engine.set(bind)
+            try:
+                return run_job(name, job)
+            finally:
+                job_engine.reset(token)
+    except Exception as e:
+        # Базу филиала не удалось открыть — задача повторится на следующем тике
+        print(f"Periodic job {name} failed for tenant {tenant}: {e}")
+
+
+@app.on_event("startup")
+async def start_periodic_jobs():
+    """При старте приложения запускаем все зарегистрированные периодические задачи."""
+    for name, interval_seconds, job, per_tenant in PERIODIC_JOBS:
+        _periodic_tasks.append(asyncio.create_task(_periodic_job_loop(name, interval_seconds, job, per_tenant)))
+
+
+@app.on_event("shutdown")
+async def stop_periodic_jobs():
+    for task in _periodic_tasks:
+        task.cancel()
+    _periodic_tasks.clear()
+
+
+# ==============================
+#   АРХИВАЦИЯ СТАРЫХ ДАННЫХ
+# ==============================
+
+# Смены и логи передач старше этого срока (в днях) переносятся в архивные таблицы
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+
+# Сколько строк переносится за одну транзакцию (короткие блокировки записи)
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+
+# Как часто запускать архивацию автоматически (в минутах); 0 — только вручную
+ARCHIVE_INTERVAL_MINUTES = int(os.getenv("ARCHIVE_INTERVAL_MINUTES", "0"))
+
+
+def parse_watermark(value: str) -> datetime:
+    """Граница из строки: дата YYYY-MM-DD (полночь) или ISO datetime."""
+    return datetime.fromisoformat(value)
+
+
+def get_archive_watermark(db: Session, table_name: str) -> Optional[datetime]:
+    """Граница архивации таблицы или None, если в архив ещё ничего не переносилось."""
+    mark = db.get(ArchiveWatermark, table_name)
+    if mark is None:
+        return None
+    return mark.archived_before_at or parse_watermark(mark.archived_before)
+
+
+def range_needs_archive(db: Session, table_name: str, range_start: Union[str, datetime, None]) -> bool:
+    """
+    Нужно ли читать архив для диапазона, начинающегося с range_start
+    (дата YYYY-MM-DD или момент времени; None — диапазон без левой границы).
+    Сравниваются даты, а не строки: "2024-05-01" и "2024-05-01T10:00" иначе упорядочиваются неверно.
+    """
+    watermark = get_archive_watermark(db, table_name)
+    if watermark is None:
+        return False
+    if range_start is None:
+        return True
+    if isinstance(range_start, str):
+        try:
+            range_start = parse_watermark(range_start)
+        except ValueError:
+            # Нераспознанная дата не совпадёт ни с одной строкой — архив не нужен
+            return False
+    return range_start < watermark
+
+
+def select_hot_and_archive(model, archive, criteria):
+    """
+    UNION ALL горячей и архивной таблицы.
+    criteria(table) возвращает список условий — они применяются к каждой ветке отдельно,
+    чтобы обе части читались по своим индексам.
+    """
+    hot = model.__table__
+    return union_all(
+        select(*hot.c).where(*criteria(hot)),
+        select(*archive.c).where(*criteria(archive)),
+    ).subquery()
+
+
+def raise_archive_watermark(db: Session, table_name: str, archived_before: datetime, label: str):
+    """Сдвинуть границу архивации вперёд (назад она никогда не двигается); label — она же строкой."""
+    mark = db.get(ArchiveWatermark, table_name)
+    if mark is None:
+        db.add(ArchiveWatermark(table_name=table_name, archived_before=label, archived_before_at=archived_before))
+    elif get_archive_watermark(db, table_name) < archived_before:
+        mark.archived_before = label
+        mark.archived_before_at = archived_before
+    db.commit()
+
+
+def move_rows_to_archive(db: Session, model, archive, older_than, batch_size: int) -> int:
+    """
+    Перенести строки, подходящие под older_than(table), в архив небольшими пачками.
+    Каждая пачка — отдельная транзакция: INSERT ... SELECT в архив и DELETE из горячей таблицы.
+    """
+    hot = model.__table__
+    # Повторной выдачи id перенесённых строк не будет: горячие таблицы — AUTOINCREMENT
+    # (см. ensure_sqlite_table_layout), в PostgreSQL последовательности и так не откатываются
+    moved = 0
+    while True:
+        ids = db.execute(
+            select(hot.c.id)
+            .where(older_than(hot))
+            .order_by(hot.c.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        db.execute(archive.insert().from_select(list(hot.c.keys()), select(*hot.c).where(hot.c.id.in_(ids))))
+        db.execute(hot.delete().where(hot.c.id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+    return moved
+
+
+def archive_old_rows(db: Session, retention_days: Optional[int] = None, batch_size: Optional[int] = None) -> dict:
+    """
+    Перенести смены и логи передач старше срока хранения в архивные таблицы.
+    Границу архивации поднимаем ДО переноса: пока идёт перенос, запросы истории
+    уже смотрят и в архив, поэтому строки "посередине" не теряются.
+    """
+    retention_days = retention_days if retention_days is not None else ARCHIVE_RETENTION_DAYS
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    cutoff_date = cutoff.strftime("%Y-%m-%d")
+
+    raise_archive_watermark(db, "shifts", parse_watermark(cutoff_date), cutoff_date)
+    raise_archive_watermark(db, "handover_logs", cutoff, cutoff.isoformat())
+
+    moved_shifts = move_rows_to_archive(
+        db, Shift, shifts_archive, lambda table: table.c.date < cutoff_date, batch_size
+    )
+    moved_logs = move_rows_to_archive(
+        db, HandoverLog, handover_logs_archive, lambda table: table.c.created_at < cutoff, batch_size
+    )
+    print(f"Archived {moved_shifts} shifts and {moved_logs} handover logs older than {cutoff_date}")
+    return {
+        "archived_before": cutoff_date,
+        "archived_shifts": moved_shifts,
+        "archived_handover_logs": moved_logs,
+    }
+
+
+register_periodic_job("archive", ARCHIVE_INTERVAL_MINUTES * 60, archive_old_rows)
+
+
+def purge_login_throttle_state(db: Session) -> int:
+    """Удалить из общего состояния ограничителя давно неактивные ключи."""
+    now = time.time()
+    deleted = db.query(LoginThrottleState).filter(
+        LoginThrottleState.updated < now - 86400,
+        LoginThrottleState.blocked_until < now
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+register_periodic_job("login_throttle_purge", 3600 if LOGIN_THROTTLE_SHARED else 0, purge_login_throttle_state)
+
+# Истёкшие ключи идемпотентности чистим раз в час (индекс по created_at)
+register_periodic_job("idempotency_purge", 3600, purge_idempotency_keys)
+
+# Старые "надгробия" логов передач — тоже раз в час (индекс по deleted_at)
+register_periodic_job("handover_tombstone_purge", 3600, purge_handover_log_tombstones)
+
+# Прошедшие запланированные смены переводим в completed
+register_periodic_job("shift_auto_complete", SHIFT_AUTO_COMPLETE_INTERVAL_MINUTES * 60, auto_complete_shifts)
+
+# Простаивающие базы филиалов закрываем раз в минуту
+register_periodic_job(
+    "tenant_idle_eviction", 60 if MULTI_TENANT else 0, lambda db: tenant_engines.evict_idle(), per_tenant=False
+)
+
+
+@app.post("/api/admin/archive")
+async def run_archive(
+    retention_days: Optional[int] = Query(None, ge=0),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Запустить архивацию вручную (только для администраторов).
+    Выполняется в пуле потоков со своей сессией, пачками по ARCHIVE_BATCH_SIZE строк.
+    """
+    return await run_in_threadpool(
+        run_job, "archive", lambda db: archive_old_rows(db, retention_days), True
+    )
+
+
+# ====================================
+#   ОЧИСТКА МЯГКО УДАЛЁННЫХ ЗАПИСЕЙ
+# ====================================
+
+# Сколько дней мягко удалённые записи можно восстановить, прежде чем они удалятся окончательно
+SOFT_DELETE_GRACE_DAYS = int(os.getenv("SOFT_DELETE_GRACE_DAYS", "30"))
+
+# Сколько записей удаляется за одну транзакцию (вместе с зависимыми строками)
+SOFT_DELETE_PURGE_BATCH_SIZE = int(os.getenv("SOFT_DELETE_PURGE_BATCH_SIZE", "200"))
+
+# Как часто запускать очистку (в минутах); 0 — только вручную
+SOFT_DELETE_PURGE_INTERVAL_MINUTES = int(os.getenv("SOFT_DELETE_PURGE_INTERVAL_MINUTES", "60"))
+
+
+def detach_handovers_from_shifts(db: Session, shift_ids):
+    """Обнулить ссылки передач смен на удаляемые смены (ids — список или подзапрос)."""
+    handovers = ShiftHandover.__table__
+    for column in (handovers.c.from_shift_id, handovers.c.to_shift_id):
+        db.execute(
+            handovers.update()
+            .where(column.in_(shift_ids))
+            .values({column: None, handovers.c.version: handovers.c.version + 1})
+        )
+
+
+def purge_patient_refs(db: Session, ids: List[int]):
+    """Смены пациента остаются в расписании, но без ссылки на карточку (имя денормализовано)."""
+    shifts = Shift.__table__
+    db.execute(
+        shifts.update()
+        .where(shifts.c.patient_id.in_(ids))
+        .values(patient_id=None, version=shifts.c.version + 1)
+    )
+
+
+def purge_user_refs(db: Session, ids: List[int]):
+    """
+    Смены пользователя остаются в расписании и истории, но без ссылки на учётную запись
+    (имя и должность денормализованы); токены отзываются.
+    """
+    shifts = Shift.__table__
+    db.execute(
+        shifts.update()
+        .where(shifts.c.user_id.in_(ids))
+        .values(user_id=None, version=shifts.c.version + 1)
+    )
+    db.execute(shifts_archive.update().where(shifts_archive.c.user_id.in_(ids)).values(user_id=None))
+    db.execute(RefreshToken.__table__.delete().where(RefreshToken.__table__.c.user_id.in_(ids)))
+
+
+def purge_asset_refs(db: Session, ids: List[int]):
+    """Связи передач смен с активом удаляются вместе с ним."""
+    links = HandoverAsset.__table__
+    db.execute(links.delete().where(links.c.asset_id.in_(ids)))
+
+
+# Порядок очистки и "каскад" для каждой модели. Внешние ключи с ON DELETE есть
+# только у таблиц, созданных с нуля (SQLite не добавляет их через ALTER TABLE),
+# поэтому зависимые строки чистим явно — одинаково для старых и новых баз
+SOFT_DELETE_CASCADES = (
+    (Asset, purge_asset_refs),
+    (Patient, purge_patient_refs),
+    (User, purge_user_refs),
+)
+
+
+def purge_deleted_rows(db: Session, model, cascade, cutoff: datetime, batch_size: int) -> int:
+    """
+    Окончательно удалить строки, мягко удалённые раньше cutoff.
+    Кандидаты читаются по частичному индексу ix_<таблица>_deleted_at,
+    каждая пачка (зависимые строки + сами записи) — отдельная короткая транзакция.
+    """
+    table = model.__table__
+    purged = 0
+    while True:
+        ids = db.execute(
+            select(table.c.id)
+            .where(table.c.deleted_at < cutoff)
+            .order_by(table.c.deleted_at)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        cascade(db, ids)
+        for row_id in ids:
+            record_audit(db, table.name, row_id, "purge")
+        db.execute(table.delete().where(table.c.id.in_(ids)))
+        db.commit()
+        purged += len(ids)
+    return purged
+
+
+def purge_soft_deleted(db: Session, grace_days: Optional[int] = None, batch_size: Optional[int] = None) -> dict:
+    """Очистить все мягко удалённые записи старше срока ожидания."""
+    grace_days = grace_days if grace_days is not None else SOFT_DELETE_GRACE_DAYS
+    batch_size = batch_size or SOFT_DELETE_PURGE_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(days=grace_days)
+    result = {"deleted_before": cutoff.isoformat()}
+    for model, cascade in SOFT_DELETE_CASCADES:
+        result[f"purged_{model.__tablename__}"] = purge_deleted_rows(db, model, cascade, cutoff, batch_size)
+    print(f"Purged soft-deleted rows: {result}")
+    return result
+
+
+register_periodic_job("soft_delete_purge", SOFT_DELETE_PURGE_INTERVAL_MINUTES * 60, purge_soft_deleted)
+
+
+@app.post("/api/admin/purge-deleted")
+async def run_purge_deleted(
+    grace_days: Optional[int] = Query(None, ge=0),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Окончательно удалить мягко удалённые записи старше grace_days (только для администраторов).
+    Выполняется в пуле потоков, пачками по SOFT_DELETE_PURGE_BATCH_SIZE записей.
+    """
+    return await run_in_threadpool(
+        run_job, "soft_delete_purge", lambda db: purge_soft_deleted(db, grace_days), True
+    )
+
+
+# ===============================
+#   НАПОМИНАНИЯ О ПРИЁМАХ
+# ===============================
+
+# За сколько минут до начала приёма отправлять напоминание
+REMINDER_LEAD_MINUTES = int(os.getenv("REMINDER_LEAD_MINUTES", "60"))
+
+# Как часто просматривать ближайшее окно и отправлять наступившие напоминания (секунд)
+REMINDER_INTERVAL_SECONDS = int(os.getenv("REMINDER_INTERVAL_SECONDS", "60"))
+
+# Кому напоминать: user — сотруднику (email, Telegram), patient — пациенту (email)
+REMINDER_RECIPIENTS = {
+    name.strip() for name in os.getenv("REMINDER_RECIPIENTS", "user,patient").split(",") if name.strip()
+}
+
+# Сколько напоминаний отправлять за один проход диспетчера
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+
+# Повторы: пауза REMINDER_RETRY_BASE_SECONDS * 2^(попытка-1), но не больше часа;
+# после REMINDER_MAX_ATTEMPTS неудач напоминание помечается failed
+REMINDER_RETRY_BASE_SECONDS = int(os.getenv("REMINDER_RETRY_BASE_SECONDS", "60"))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "5"))
+
+# Сколько секунд захваченное напоминание не берут другие воркеры (упавший воркер его отпустит)
+REMINDER_CLAIM_SECONDS = int(os.getenv("REMINDER_CLAIM_SECONDS", "300"))
+
+# Email через SMTP (канал включается, если задан SMTP_SERVER)
+SMTP_SERVER = os.getenv("SMTP_SERVER", "")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_FROM = os.getenv("SMTP_FROM", "") or SMTP_USERNAME or "clinic@localhost"
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+
+# Telegram Bot API (канал включается, если задан TELEGRAM_BOT_TOKEN).
+# TELEGRAM_API_URL можно направить на совместимый шлюз или заглушку в тестах
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Ограничение скорости отправки, сообщений в секунду (у Telegram лимит около 30 в секунду на бота)
+REMINDER_EMAIL_RATE_PER_SECOND = float(os.getenv("REMINDER_EMAIL_RATE_PER_SECOND", "5"))
+REMINDER_TELEGRAM_RATE_PER_SECOND = float(os.getenv("REMINDER_TELEGRAM_RATE_PER_SECOND", "25"))
+
+# Таймаут соединения с почтовым сервером и Bot API, секунд
+REMINDER_SEND_TIMEOUT = float(os.getenv("REMINDER_SEND_TIMEOUT", "10"))
+
+
+class ReminderSendError(Exception):
+    """
+    Ошибка отправки одного сообщения.
+    permanent — повтор не поможет (адрес отклонён, чат недоступен);
+    retry_after — через сколько секунд сервер просит повторить.
+    """
+
+    def __init__(self, message: str, permanent: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.permanent = permanent
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Ограничение скорости исходящих сообщений: в среднем rate в секунду, подряд не больше burst.
+    acquire() резервирует токен и при необходимости ждёт его в текущем потоке
+    (отправка идёт в пуле потоков фоновых задач, event loop не блокируется).
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class SmtpReminderChannel:
+    """Письма через SMTP: вся пачка уходит через одно соединение (STARTTLS и вход — один раз)."""
+
+    name = "email"
+
+    def __init__(self, host: str, port: int, username: str, password: str, sender: str,
+                 starttls: bool, timeout: float, limiter: TokenBucket):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.starttls = starttls
+        self.timeout = timeout
+        self.limiter = limiter
+
+    def send_batch(self, messages: List[dict]) -> List[Optional[ReminderSendError]]:
+        """Отправить сообщения; для каждого — None или ошибка."""
+        results = []
+        smtp = None
+        try:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for message in messages:
+                self.limiter.acquire()
+                results.append(self._send(smtp, message))
+        except (OSError, smtplib.SMTPException) as e:
+            # Соединение не открылось или оборвалось: неотправленные повторим позже
+            error = ReminderSendError(f"SMTP unavailable: {e}")
+            results.extend([error] * (len(messages) - len(results)))
+        finally:
+            if smtp is not None:
+                try:
+                    smtp.quit()
+                except (OSError, smtplib.SMTPException):
+                    smtp.close()
+        return results
+
+    def _send(self, smtp, message: dict) -> Optional[ReminderSendError]:
+        email = EmailMessage()
+        email["From"] = self.sender
+        email["To"] = message["address"]
+        email["Subject"] = message["subject"]
+        email.set_content(message["text"])
+        try:
+            smtp.send_message(email)
+        except smtplib.SMTPRecipientsRefused as e:
+            # Адресат один: 4xx на RCPT (ящик переполнен, greylisting) — повторим, 5xx — нет
+            permanent = all(code >= 500 for code, _ in e.recipients.values())
+            return ReminderSendError(f"Recipient refused: {e.recipients}", permanent=permanent)
+        except smtplib.SMTPResponseException as e:
+            # 5xx — постоянная ошибка (адрес не существует и т.п.), 4xx — временная
+            return ReminderSendError(f"SMTP {e.smtp_code}: {e.smtp_error!r}", permanent=e.smtp_code >= 500)
+        return None
+
+
+class TelegramReminderChannel:
+    """
+    Сообщения через Telegram Bot API (sendMessage).
+    Пачка отправляется по одному keep-alive соединению; 429 учитывает retry_after из ответа.
+    """
+
+    name = "telegram"
+
+    def __init__(self, api_url: str, token: str, timeout: float, limiter: TokenBucket):
+        parsed = urllib.parse.urlsplit(api_url)
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = f"{parsed.path.rstrip('/')}/bot{token}/sendMessage"
+        self.timeout = timeout
+        self.limiter = limiter
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def send_batch(self, messages: List[dict]) -> List[Optional[ReminderSendError]]:
+        """Отправить сообщения; для каждого — None или ошибка."""
+        results = []
+        connection = None
+        for message in messages:
+            self.limiter.acquire()
+            connection = connection or self._connect()
+            try:
+                results.append(self._send(connection, message))
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                connection = None
+                results.append(ReminderSendError(f"Telegram API unavailable: {e}"))
+        if connection is not None:
+            connection.close()
+        return results
+
+    def _send(self, connection, message: dict) -> Optional[ReminderSendError]:
+        body = json.dumps({"chat_id": message["address"], "text": message["text"]}, ensure_ascii=False)
+        connection.request("POST", self.path, body.encode("utf-8"), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        payload = response.read()
+        if response.status == 200:
+            return None
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = {}
+        description = data.get("description") or f"HTTP {response.status}"
+        if response.status == 429:
+            return ReminderSendError(description, retry_after=data.get("parameters", {}).get("retry_after"))
+        # 400 — неверный chat_id, 403 — бот заблокирован: повтор не поможет. 401 и 5xx — повторим
+        return ReminderSendError(description, permanent=response.status in (400, 403))
+
+
+def make_reminder_channels() -> dict:
+    """Каналы, для которых есть настройки."""
+    channels = {}
+    if SMTP_SERVER:
+        channels["email"] = SmtpReminderChannel(
+            SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_FROM, SMTP_STARTTLS,
+            REMINDER_SEND_TIMEOUT, TokenBucket(REMINDER_EMAIL_RATE_PER_SECOND),
+        )
+    if TELEGRAM_BOT_TOKEN:
+        channels["telegram"] = TelegramReminderChannel(
+            TELEGRAM_API_URL, TELEGRAM_BOT_TOKEN, REMINDER_SEND_TIMEOUT,
+            TokenBucket(REMINDER_TELEGRAM_RATE_PER_SECOND),
+        )
+    return channels
 
 
-@app.get("/api/handovers/", response_model=List[HandoverResponse])
-async def get_handovers(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
+reminder_channels = make_reminder_channels()
+
+# Счётчики отправки по каналам (с запуска процесса)
+reminder_counters = {}
+
+
+def count_reminder(channel: str, outcome: str, amount: int = 1):
+    counters = reminder_counters.setdefault(channel, {"sent": 0, "retried": 0, "failed": 0})
+    counters[outcome] += amount
+
+
+def shift_start(date: str, start_time: str) -> Optional[datetime]:
+    """Начало приёма ("9:00" тоже допустимо); None, если время записано не в формате HH:MM."""
+    try:
+        return datetime.strptime(f"{date} {start_time}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+
+
+def schedule_reminders(db: Session, now: Optional[datetime] = None) -> int:
     """
-    Получить список всех передач смен.
-    Для каждой передачи также подтягиваются связанные активы.
+    Поставить в очередь напоминания о приёмах, которые начнутся в ближайшем окне
+    (now, now + REMINDER_LEAD_MINUTES + два интервала диспетчера].
+    Смены читаются диапазоном по индексу (date, start_time) — только дни окна;
+    окна соседних проходов перекрываются, уже поставленные напоминания пропускаются.
     """
-    handovers = db.query(ShiftHandover).order_by(ShiftHandover.created_at.desc()).all()
-    
-    result = []
-    for handover in handovers:
-        assets = (
-            db.query(Asset)
-            .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
-            .filter(HandoverAsset.handover_id == handover.id)
-            .all()
+    now = now or clinic_now()
+    horizon = now + timedelta(minutes=REMINDER_LEAD_MINUTES, seconds=2 * max(REMINDER_INTERVAL_SECONDS, 60))
+    table = Shift.__table__
+    start = sql_time_minutes(table.c.start_time)
+    days = []
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day <= horizon:
+        first = max(day, now)
+        last = min(day + timedelta(days=1) - timedelta(minutes=1), horizon)
+        days.append(and_(
+            table.c.date == day.strftime("%Y-%m-%d"),
+            start > first.hour * 60 + first.minute,
+            start <= last.hour * 60 + last.minute,
+        ))
+        day += timedelta(days=1)
+
+    users = User.__table__
+    patients = Patient.__table__
+    rows = db.execute(
+        select(
+            table.c.id, table.c.date, table.c.start_time,
+            users.c.email, users.c.telegram_id, patients.c.email.label("patient_email"),
         )
-        result.append(HandoverResponse(
-            id=handover.id,
-            from_shift_id=handover.from_shift_id,
-            to_shift_id=handover.to_shift_id,
-            handover_notes=handover.handover_notes,
-            assets=assets,
-            created_at=handover.created_at
+        .select_from(table)
+        .outerjoin(users, and_(
+            users.c.id == table.c.user_id, users.c.deleted_at.is_(None), users.c.is_active.is_(True)
         ))
-    
+        .outerjoin(patients, and_(patients.c.id == table.c.patient_id, patients.c.deleted_at.is_(None)))
+        .where(
+            table.c.date >= now.strftime("%Y-%m-%d"),
+            table.c.date <= horizon.strftime("%Y-%m-%d"),
+            table.c.status == "scheduled",
+            or_(*days),
+        )
+    ).all()
+
+    candidates = []
+    for row in rows:
+        start = shift_start(row.date, row.start_time)
+        if start is None:
+            continue
+        send_at = start - timedelta(minutes=REMINDER_LEAD_MINUTES)
+        addresses = []
+        if "user" in REMINDER_RECIPIENTS:
+            addresses += [("email", row.email, "user"), ("telegram", row.telegram_id, "user")]
+        if "patient" in REMINDER_RECIPIENTS:
+            addresses.append(("email", row.patient_email, "patient"))
+        for channel, address, recipient in addresses:
+            if address and channel in reminder_channels:
+                candidates.append((row.id, channel, address.strip(), recipient, send_at))
+    if not candidates:
+        return 0
+
+    reminders = ShiftReminder.__table__
+    existing = set(db.execute(
+        select(reminders.c.shift_id, reminders.c.channel, reminders.c.address, reminders.c.send_at)
+        .where(reminders.c.shift_id.in_({candidate[0] for candidate in candidates}))
+    ).all())
+    new_rows = [
+        {
+            "shift_id": shift_id, "channel": channel, "address": address, "recipient": recipient,
+            "send_at": send_at, "next_attempt_at": send_at, "status": "pending", "attempts": 0,
+            "created_at": datetime.utcnow(),
+        }
+        for shift_id, channel, address, recipient, send_at in candidates
+        if (shift_id, channel, address, send_at) not in existing
+    ]
+    if new_rows:
+        try:
+            db.execute(insert(reminders), new_rows)
+            db.commit()
+        except IntegrityError:
+            # То же окно одновременно просмотрел другой воркер — его строки уже в очереди
+            db.rollback()
+            return 0
+    return len(new_rows)
+
+
+def reminder_message(row) -> dict:
+    """Текст напоминания для сотрудника или пациента."""
+    when = f"{row.date} в {row.start_time}"
+    if row.recipient == "patient":
+        text_body = f"Напоминаем: вы записаны на {when}. Специалист: {row.user_name} ({row.position})."
+    else:
+        patient = f", пациент {row.patient_name}" if row.patient_name else ""
+        text_body = f"Напоминание: {when} — {row.shift_type}{patient}."
+    return {"address": row.address, "subject": f"Напоминание о приёме {when}", "text": text_body}
+
+
+def dispatch_reminders(db: Session, now: Optional[datetime] = None, batch_size: Optional[int] = None) -> dict:
+    """
+    Отправить наступившие напоминания.
+    Проход читает только наступившие строки по индексу (status, next_attempt_at) и захватывает их
+    одним UPDATE (status=sending на REMINDER_CLAIM_SECONDS) — другой воркер их не возьмёт,
+    а после падения воркера они вернутся в очередь. Сообщения группируются по каналам
+    и отправляются пачками; неудачные повторяются с растущей паузой.
+    Смена отменена, перенесена или уже началась — напоминание пропускается (skipped).
+    """
+    now = now or clinic_now()
+    batch_size = batch_size or REMINDER_BATCH_SIZE
+    reminders = ShiftReminder.__table__
+    shifts = Shift.__table__
+    result = {"sent": 0, "retried": 0, "failed": 0, "skipped": 0}
+    waiting = reminders.c.status.in_(("pending", "sending"))
+    while True:
+        due = db.execute(
+            select(reminders.c.id)
+            .where(waiting, reminders.c.next_attempt_at <= now)
+            .order_by(reminders.c.next_attempt_at)
+            .limit(batch_size)
+        ).scalars().all()
+        if not due:
+            break
+        claimed = db.execute(
+            reminders.update()
+            .where(reminders.c.id.in_(due), waiting, reminders.c.next_attempt_at <= now)
+            .values(status="sending", next_attempt_at=now + timedelta(seconds=REMINDER_CLAIM_SECONDS))
+            .returning(reminders.c.id)
+        ).scalars().all()
+        db.commit()
+
+        rows = db.execute(
+            select(
+                reminders.c.id, reminders.c.channel, reminders.c.address, reminders.c.recipient,
+                reminders.c.send_at, reminders.c.attempts,
+                shifts.c.date, shifts.c.start_time, shifts.c.status.label("shift_status"), shifts.c.shift_type,
+                shifts.c.user_name, shifts.c.position, shifts.c.patient_name,
+            )
+            .join(shifts, shifts.c.id == reminders.c.shift_id)
+            .where(reminders.c.id.in_(claimed))
+        ).all() if claimed else []
+
+        updates = []
+        by_channel = {}
+        for row in rows:
+            start = shift_start(row.date, row.start_time)
+            if (
+                start is None
+                or row.shift_status != "scheduled"
+                or start <= now
+                or start - timedelta(minutes=REMINDER_LEAD_MINUTES) != row.send_at
+                or row.channel not in reminder_channels
+            ):
+                updates.append({"id": row.id, "status": "skipped"})
+                result["skipped"] += 1
+            else:
+                by_channel.setdefault(row.channel, []).append(row)
+
+        for channel_name, channel_rows in by_channel.items():
+            errors = reminder_channels[channel_name].send_batch([reminder_message(row) for row in channel_rows])
+            for row, error in zip(channel_rows, errors):
+                attempts = row.attempts + 1
+                if error is None:
+                    updates.append({"id": row.id, "status": "sent", "attempts": attempts, "sent_at": clinic_now(), "last_error": None})
+                    outcome = "sent"
+                elif error.permanent or attempts >= REMINDER_MAX_ATTEMPTS:
+                    updates.append({"id": row.id, "status": "failed", "attempts": attempts, "last_error": str(error)})
+                    outcome = "failed"
+                else:
+                    delay = error.retry_after or min(REMINDER_RETRY_BASE_SECONDS * 2 ** (attempts - 1), 3600)
+                    updates.append({
+                        "id": row.id, "status": "pending", "attempts": attempts, "last_error": str(error),
+                        "next_attempt_at": clinic_now() + timedelta(seconds=delay),
+                    })
+                    outcome = "retried"
+                result[outcome] += 1
+                count_reminder(channel_name, outcome)
+
+        # Ключи у строк разные — обновляем группами с одинаковым набором полей
+        for keys in {tuple(sorted(update)) for update in updates}:
+            db.execute(
+                reminders.update().where(reminders.c.id == bindparam("reminder_id")),
+                [
+                    {("reminder_id" if key == "id" else key): value for key, value in update.items()}
+                    for update in updates if tuple(sorted(update)) == keys
+                ],
+            )
+        db.commit()
+        if len(due) < batch_size:
+            break
+    if result["sent"] or result["failed"]:
+        print(f"Reminders dispatched: {result}")
     return result
 
 
-@app.get("/api/handovers/{handover_id}", response_model=HandoverResponse)
-async def get_handover(
-    handover_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
-    """Получить конкретную передачу смены по ID."""
-    handover = db.query(ShiftHandover).filter(ShiftHandover.id == handover_id).first()
-    if not handover:
-        raise HTTPException(status_code=404, detail="Handover not found")
-    
-    assets = (
-        db.query(Asset)
-        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
-        .filter(HandoverAsset.handover_id == handover.id)
-        .all()
-    )
-    
-    return HandoverResponse(
-        id=handover.id,
-        from_shift_id=handover.from_shift_id,
-        to_shift_id=handover.to_shift_id,
-        handover_notes=handover.handover_notes,
-        assets=assets,
-        created_at=handover.created_at
-    )
+def run_reminders(db: Session) -> dict:
+    """Один тик: поставить напоминания ближайшего окна в очередь и отправить наступившие."""
+    return {"scheduled": schedule_reminders(db), **dispatch_reminders(db)}
 
 
-@app.put("/api/handovers/{handover_id}", response_model=HandoverResponse)
-async def update_handover(
-    handover_id: int,
-    handover_update: HandoverCreate,
+register_periodic_job("reminders", REMINDER_INTERVAL_SECONDS if reminder_channels else 0, run_reminders)
+
+
+@app.get("/api/admin/reminders")
+async def get_reminder_stats(
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """
-    Обновить передачу смены:
-    - меняем информацию о сменах
-    - переопределяем список связанных активов
+    Состояние напоминаний (только для администраторов): настроенные каналы, очередь по статусам
+    и счётчики отправки с запуска процесса.
     """
-    handover = db.query(ShiftHandover).filter(ShiftHandover.id == handover_id).first()
-    if not handover:
-        raise HTTPException(status_code=404, detail="Handover not found")
-    
-    # Обновляем данные handover
-    handover_data = handover_update.dict()
-    asset_ids = handover_data.pop('asset_ids')
-    
-    for key, value in handover_data.items():
-        setattr(handover, key, value)
-    
-    # Удаляем старые связи с assets
-    db.query(HandoverAsset).filter(HandoverAsset.handover_id == handover_id).delete()
-    
-    # Создаем новые связи с assets
-    for asset_id in asset_ids:
-        handover_asset = HandoverAsset(
-            handover_id=handover.id,
-            asset_id=asset_id
-        )
-        db.add(handover_asset)
-    
-    db.commit()
-    db.refresh(handover)
-    
-    # Получаем связанные assets для ответа
-    assets = (
-        db.query(Asset)
-        .join(HandoverAsset, Asset.id == HandoverAsset.asset_id)
-        .filter(HandoverAsset.handover_id == handover.id)
-        .all()
-    )
-    
-    return HandoverResponse(
-        id=handover.id,
-        from_shift_id=handover.from_shift_id,
-        to_shift_id=handover.to_shift_id,
-        handover_notes=handover.handover_notes,
-        assets=assets,
-        created_at=handover.created_at
+    reminders = ShiftReminder.__table__
+    queue = dict(db.execute(select(reminders.c.status, func.count()).group_by(reminders.c.status)).all())
+    return {"channels": sorted(reminder_channels), "queue": queue, "counters": reminder_counters}
+
+
+@app.post("/api/admin/reminders/run")
+async def run_reminders_now(current_user: User = Depends(get_current_admin_user)):
+    """Выполнить тик напоминаний сейчас, не дожидаясь расписания (только для администраторов)."""
+    return await run_in_threadpool(run_job, "reminders", run_reminders, True)
+
+
+# ==================
+#   БЭКАПЫ БАЗЫ
+# ==================
+
+# Параметры онлайн-бэкапа (см. backup.py и DATABASE_BACKUP.md)
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "gzip")
+BACKUP_KEEP_LAST = int(os.getenv("BACKUP_KEEP_LAST", "14"))
+BACKUP_RETENTION_DAYS = int(os.getenv("BACKUP_RETENTION_DAYS", "30"))
+
+# Автоматический бэкап раз в BACKUP_INTERVAL_HOURS часов
+AUTO_BACKUP_ENABLED = os.getenv("AUTO_BACKUP_ENABLED", "false").lower() == "true"
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+
+
+def sqlite_database_path() -> str:
+    """Путь к файлу SQLite-базы текущего филиала (DATABASE_URL или TENANT_DATABASE_URL_TEMPLATE)."""
+    url = current_engine().url
+    if url.get_backend_name() != "sqlite" or not url.database:
+        raise HTTPException(status_code=400, detail="Backups are supported only for file-based SQLite")
+    return os.path.abspath(url.database)
+
+
+def backup_directory() -> str:
+    """Папка для бэкапов: BACKUP_DIR или backups/ рядом с файлом базы."""
+    return tenant_subdir(os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(sqlite_database_path()), "backups"))
+
+
+def run_backup() -> dict:
+    """Сделать бэкап с настройками из окружения."""
+    return backup_database(
+        sqlite_database_path(),
+        backup_directory(),
+        pages_per_step=BACKUP_PAGES_PER_STEP,
+        step_sleep=BACKUP_STEP_SLEEP,
+        compression=BACKUP_COMPRESSION,
+        keep_last=BACKUP_KEEP_LAST,
+        max_age_days=BACKUP_RETENTION_DAYS,
     )
 
 
-@app.get("/api/handovers/export")
-async def export_handovers(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
+register_periodic_job(
+    "backup", BACKUP_INTERVAL_HOURS * 3600 if AUTO_BACKUP_ENABLED else 0, lambda db: run_backup()
+)
+
+
+@app.post("/api/admin/backup")
+async def create_backup(current_user: User = Depends(get_current_admin_user)):
     """
-    Экспорт всех передач смен из упрощённых логов (HandoverLog).
-    Возвращает простой JSON, пригодный для последующей выгрузки в Excel/Google Sheets.
-    
-    Также, если логов ещё нет, создаёт тестовую запись для проверки.
+    Создать бэкап базы (только для администраторов).
+    Копирование идёт порциями страниц в пуле потоков и не блокирует работу API.
     """
-    
-    print(f"=== LOG EXPORT REQUEST START ===")
-    print(f"Export request from user: {current_user.username}")
-    
     try:
-        # Сначала проверяем, есть ли уже логи
-        logs_count = db.query(HandoverLog).count()
-        print(f"Current logs count: {logs_count}")
-        
-        if logs_count == 0:
-            print("No logs found, creating a test log entry...")
-            # Создаем тестовый лог
-            from datetime import datetime
-            test_log = HandoverLog(
-                log_date="2024-01-15",
-                log_time="14:30:00",
-                from_shift_user="Тестовый Пользователь 1",
-                from_shift_time="09:00-21:00",
-                to_shift_user="Тестовый Пользователь 2", 
-                to_shift_time="21:00-09:00",
-                handover_notes="Тестовая передача смены для проверки экспорта",
-                assets_info="Тестовый кейс (CASE): Проверка работы системы"
-            )
-            db.add(test_log)
-            db.commit()
-            print("Test log created successfully")
-        
-        # Получаем все логи передач
-        logs = db.query(HandoverLog).order_by(HandoverLog.created_at.desc()).all()
-        print(f"Found {len(logs)} handover logs to export")
-        
-        # Очень простая структура данных для экспорта
-        export_data = []
-        for i, log in enumerate(logs):
-            try:
-                log_dict = {
-                    "id": log.id,
-                    "date": str(log.log_date),
-                    "time": str(log.log_time),
-                    "from_shift_user": str(log.from_shift_user),
-                    "from_shift_time": str(log.from_shift_time),
-                    "to_shift_user": str(log.to_shift_user),
-                    "to_shift_time": str(log.to_shift_time),
-                    "handover_notes": str(log.handover_notes),
-                    "assets_info": str(log.assets_info)
-                }
-                export_data.append(log_dict)
-                print(f"Processed log {i+1}/{len(logs)}: ID {log.id}")
-            except Exception as e:
-                # Если какая-то запись сломана — просто логируем ошибку и продолжаем
-                print(f"Error processing log {log.id}: {e}")
-                continue
-        
-        result = {
-            "data": export_data,
-            "total": len(export_data),
-            "success": True
-        }
-        
-        print(f"Export completed successfully. Processed {len(export_data)} logs")
-        print(f"Returning result: {len(str(result))} characters")
-        
-        return result
-        
-    except Exception as e:
-        # Глобальная обработка ошибок экспорта
-        print(f"Log export error: {e}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "data": [],
-            "total": 0,
-            "error": str(e),
-            "success": False
-        }
+        return await run_in_threadpool(run_backup)
+    except BackupError as e:
+        raise HTTPException(status_code=500, detail=f"Backup failed: {e}")
 
 
-@app.delete("/api/handovers/clear")
-async def clear_handovers(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_admin_user)
-):
+@app.get("/api/admin/backups")
+async def get_backups(current_user: User = Depends(get_current_admin_user)):
+    """Список имеющихся бэкапов (только для администраторов)."""
+    return list_backups(backup_directory())
+
+
+# ==================
+#   ПРОФИЛИ ЗАПРОСОВ
+# ==================
+
+def find_profile(profile_id: str) -> RequestProfile:
+    """Профиль из буфера (только своего филиала); вытесненный или чужой — 404."""
+    for profile in profile_buffer:
+        if profile.id == profile_id and profile.tenant == current_tenant.get():
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+
+@app.get("/api/admin/profiles")
+async def get_profiles(current_user: User = Depends(get_current_admin_user)):
+    """Последние профили запросов, новые сверху (только для администраторов)."""
+    tenant = current_tenant.get()
+    return [profile.summary() for profile in reversed(profile_buffer) if profile.tenant == tenant]
+
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, current_user: User = Depends(get_current_admin_user)):
+    """Профиль запроса: время Python, SQL и сериализации, самые долгие SQL-запросы."""
+    return find_profile(profile_id).details()
+
+
+@app.get("/api/admin/profiles/{profile_id}/folded")
+async def download_profile(profile_id: str, current_user: User = Depends(get_current_admin_user)):
+    """Стеки профиля в формате folded (flamegraph.pl, speedscope, inferno)."""
+    profile = find_profile(profile_id)
+    return Response(
+        content=profile.folded(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.folded"'},
+    )
+
+
+# ==========================
+#   СТАТИСТИКА КЭША ЗАПРОСОВ
+# ==========================
+
+@app.get("/api/admin/cache")
+async def get_query_cache_stats(current_user: User = Depends(get_current_admin_user)):
     """
-    Очистка всех передач смен и логов (ТОЛЬКО для администраторов).
-    Полностью удаляет:
-    - связи handover_assets
-    - сами handovers
-    - логи handover_logs
+    Статистика кэша запросов (только для администраторов):
+    попадания, промахи, ожидания чужого запроса и ошибки — по каждому кэшу отдельно,
+    только для филиала администратора. backend_stats — общие для процесса.
     """
-    # Удаляем все связи с активами
-    db.query(HandoverAsset).delete()
-    
-    # Удаляем все передачи смен
-    handovers_count = db.query(ShiftHandover).count()
-    db.query(ShiftHandover).delete()
-    
-    # Удаляем все логи передач
-    logs_count = db.query(HandoverLog).count()
-    db.query(HandoverLog).delete()
-    
-    db.commit()
-    
+    tenant = current_tenant.get()
     return {
-        "message": f"Удалено {handovers_count} передач смен и {logs_count} логов", 
-        "deleted_handovers": handovers_count,
-        "deleted_logs": logs_count
+        "backend": query_cache_backend.name if query_cache_backend else "off",
+        "backend_stats": query_cache_backend.stats() if query_cache_backend else {},
+        **query_cache_invalidation.get(tenant, {"invalidations": 0, "errors": 0}),
+        "caches": {name: cache.stats(tenant) for name, cache in QUERY_CACHES.items()},
     }
 
 
@@ -1586,7 +6959,7 @@ def create_default_admin(db: Session):
     Используется при старте приложения.
     """
     # Проверяем, есть ли уже администратор с username "Sideffect"
-    admin_user = db.query(User).filter(User.username == "Sideffect").first()
+    admin_user = db.query(User).execution_options(include_deleted=True).filter(User.username == "Sideffect").first()
     if not admin_user:
         # Создаем администратора по умолчанию
         admin_user = User(
@@ -1602,18 +6975,144 @@ def create_default_admin(db: Session):
         print("✅ Создан администратор по умолчанию: Sideffect / admin123")
 
 
+# Индексы, заменённые частичными (только по живым строкам) — удаляются при обновлении схемы
+OBSOLETE_INDEXES = (
+    "ix_assets_type_status_updated", "ix_assets_status_updated", "ix_patients_last_visit",
+    "ux_idempotency_keys_scope", "ix_assets_live_type_status_updated", "ix_assets_live_status_updated",
+)
+
+
+def ensure_sqlite_table_layout(bind):
+    """
+    SQLite не меняет объявление колонок через ALTER TABLE, поэтому таблицы старых баз
+    пересоздаются по модели (данные копируются как есть), если:
+    - таблица объявлена AUTOINCREMENT, а в базе создана без него. Горячим таблицам с архивом
+      он нужен: без него SQLite выдаёт новой строке max(id) + 1, и после переноса самых новых
+      строк в архив (или их удаления) id повторяются;
+    - колонка, которая в модели допускает NULL, в базе объявлена NOT NULL
+      (например, shifts.user_id: смены окончательно удалённого сотрудника остаются без ссылки).
+    Счётчик sqlite_sequence не опускается ниже наибольшего id из горячей и архивной таблиц.
+    """
+    if bind.dialect.name != "sqlite":
+        return
+    tables = Base.metadata.sorted_tables
+    with bind.connect() as conn:
+        # Внешние ключи выключаются только вне транзакции; иначе DROP TABLE удалил бы зависимые строки
+        conn.exec_driver_sql("PRAGMA foreign_keys = OFF")
+        conn.commit()
+        try:
+            for table in tables:
+                autoincrement = table.dialect_options["sqlite"]["autoincrement"]
+                ddl = conn.exec_driver_sql(
+                    "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+                ).scalar()
+                # PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
+                relaxed = [
+                    name for _, name, _, notnull, _, pk in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")
+                    if notnull and not pk and name in table.c and table.c[name].nullable
+                ]
+                if (autoincrement and "AUTOINCREMENT" not in ddl.upper()) or relaxed:
+                    rebuilt = f"{table.name}__rebuild"
+                    columns = ", ".join(column.name for column in table.columns)
+                    create = str(CreateTable(table).compile(bind)).strip()
+                    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {rebuilt}")
+                    conn.exec_driver_sql(create.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {rebuilt} ", 1))
+                    conn.exec_driver_sql(f"INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}")
+                    # Вместе с таблицей удаляются её индексы и триггеры — их пересоздаёт init_database
+                    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+                    conn.exec_driver_sql(f"ALTER TABLE {rebuilt} RENAME TO {table.name}")
+                    conn.commit()
+                    print(f"Table {table.name} rebuilt to match the model")
+                if not autoincrement:
+                    continue
+                archive = Base.metadata.tables.get(f"{table.name}_archive")
+                top = conn.execute(select(func.max(archive.c.id))).scalar() if archive is not None else None
+                if top is not None:
+                    seeded = conn.exec_driver_sql(
+                        "UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?", (top, table.name, top)
+                    ).rowcount
+                    if not seeded and conn.exec_driver_sql(
+                        "SELECT 1 FROM sqlite_sequence WHERE name = ?", (table.name,)
+                    ).first() is None:
+                        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, top))
+                conn.commit()
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql("PRAGMA foreign_keys = ON")
+            conn.commit()
+
+
+def upgrade_schema(bind) -> List[str]:
+    """
+    Лёгкая "миграция" существующей базы.
+    create_all создаёт колонки и индексы только вместе с новыми таблицами,
+    поэтому колонки, добавленные в модели позже, досоздаём через ALTER TABLE ADD COLUMN,
+    а индексы — через CREATE INDEX IF NOT EXISTS.
+    Возвращает список добавленных колонок ("таблица.колонка").
+    """
+    added = []
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            with bind.begin() as conn:
+                conn.exec_driver_sql(ddl)
+            added.append(f"{table.name}.{column.name}")
+    ensure_sqlite_table_layout(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                # IF NOT EXISTS, а не checkfirst: индексы по выражениям SQLAlchemy не отражает
+                conn.execute(CreateIndex(index, if_not_exists=True))
+    with bind.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    return added
+
+
 # ВАЖНО: мы не дропаем таблицы, чтобы не потерять данные
 # Base.metadata.drop_all(bind=engine)  # ЗАКОММЕНТИРОВАНО - не удаляем данные!
 
-# Создаем только новые таблицы, если их ещё нет
-Base.metadata.create_all(bind=engine)
+def init_database(bind) -> List[str]:
+    """
+    Подготовить базу к работе: таблицы, догон схемы, триггеры и администратор по умолчанию.
+    Вызывается при старте для основной базы и при первом открытии базы каждого филиала.
+    Возвращает список добавленных колонок.
+    """
+    global assets_fts_enabled, patients_fts_enabled
+    # Создаем только новые таблицы, если их ещё нет
+    Base.metadata.create_all(bind=bind)
+    # И догоняем схему уже существующих таблиц (новые колонки и индексы)
+    added = upgrade_schema(bind)
+    # Полнотекстовый индекс активов (FTS5 + триггеры) живёт вне моделей
+    assets_fts_enabled = ensure_assets_fts(bind)
+    # Триграммный индекс поиска пациентов по подстроке
+    patients_fts_enabled = ensure_patients_fts(bind)
+    backfill_asset_updated_at(bind)
+    # last_visit пациентов ведётся триггерами по завершённым приёмам
+    ensure_last_visit_triggers(bind)
+    # Журнал аудита только дописывается
+    ensure_audit_log_append_only(bind)
+
+    # Создаём дефолтного админа (если ещё не создан)
+    db = SessionLocal(bind=bind)
+    try:
+        create_default_admin(db)
+        # Ключи дубликатов появились в уже заполненной базе — считаем их для всех пациентов
+        if "patients.dedup_name_key" in added:
+            backfill_patient_dedup_keys(db)
+    finally:
+        db.close()
+    return added
+
 
-# При старте приложения создаём дефолтного админа (если ещё не создан)
-db = SessionLocal()
-try:
-    create_default_admin(db)
-finally:
-    db.close()
+# При старте приложения готовим основную базу (базы филиалов — при первом обращении)
+added_columns = init_database(engine)
 
 
 # =================
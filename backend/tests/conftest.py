@@ -0,0 +1,186 @@
+"""
+Общие фикстуры тестов производительности API.
+
+main создаёт движок и схему при импорте, поэтому окружение (временная база,
+выключенный кэш запросов, каналы напоминаний) задаётся до `import main`.
+База заполняется один раз на сессию данными "как в жизни": десятки сотрудников,
+сотни пациентов, тысячи приёмов за три месяца, активы и передачи смен.
+"""
+
+import os
+import random
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+DATA_DIR = tempfile.mkdtemp(prefix="clinic-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{DATA_DIR}/clinic.db"
+# Бюджеты считают настоящие запросы к базе — кэш результатов их бы скрыл
+os.environ["QUERY_CACHE_BACKEND"] = "off"
+os.environ["LOGIN_THROTTLE_USER_BURST"] = "1000"
+os.environ["LOGIN_THROTTLE_IP_BURST"] = "1000"
+for name in ("TENANT_DATABASE_URL_TEMPLATE", "SMTP_SERVER", "TELEGRAM_BOT_TOKEN", "IMPORT_DIR", "BACKUP_DIR"):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+import main  # noqa: E402
+
+ADMIN_USERNAME = "Sideffect"
+ADMIN_PASSWORD = "admin123"
+USER_PASSWORD = "secret123"
+
+SEED_DOCTORS = 20
+SEED_PATIENTS = 500
+SEED_DAYS_BACK = 60
+SEED_DAYS_AHEAD = 30
+SEED_SLOTS = ("09:00", "10:30", "13:00", "15:30")
+SEED_ASSETS = 200
+SEED_HANDOVERS = 60
+
+ASSET_TYPES = ("CASE", "CHANGE_MANAGEMENT", "ORANGE_CASE", "CLIENT_REQUESTS")
+ASSET_STATUSES = ("Active", "Completed", "On Hold")
+SURNAMES = ("Иванов", "Петров", "Сидоров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов", "Михайлов", "Новиков")
+
+
+def seed_handovers(db, shift_ids, asset_ids, rng) -> list:
+    """Передачи смен с тремя активами каждая и их логи."""
+    handover_ids = []
+    for i in range(SEED_HANDOVERS):
+        handover = main.ShiftHandover(
+            from_shift_id=rng.choice(shift_ids), to_shift_id=rng.choice(shift_ids), handover_notes=f"Передача {i}"
+        )
+        db.add(handover)
+        db.flush()
+        handover_ids.append(handover.id)
+        for asset_id in rng.sample(asset_ids, 3):
+            db.add(main.HandoverAsset(handover_id=handover.id, asset_id=asset_id))
+        db.add(main.HandoverLog(
+            log_date=datetime.now().strftime("%Y-%m-%d"), log_time="08:00",
+            from_shift_user="doctor0", from_shift_time="09:00-10:00",
+            to_shift_user="doctor1", to_shift_time="10:30-11:30",
+            handover_notes=f"Передача {i}", assets_info="-",
+        ))
+    db.commit()
+    return handover_ids
+
+
+@pytest.fixture(scope="session")
+def seed():
+    """Заполнить базу и вернуть id и даты, на которые опираются тесты."""
+    rng = random.Random(42)
+    today = datetime.now().date()
+    db = main.open_session()
+    try:
+        password = main.get_password_hash(USER_PASSWORD)
+        doctors = [
+            main.User(
+                username=f"doctor{i}", hashed_password=password, name=f"Врач {i}", position="терапевт",
+                email=f"doctor{i}@clinic.test", is_active=True, is_admin=False,
+            )
+            for i in range(SEED_DOCTORS)
+        ]
+        patients = [
+            main.Patient(
+                full_name=f"{rng.choice(SURNAMES)} Пациент {i}",
+                birth_date=f"19{rng.randint(40, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+                phone=f"+7900{i:07d}", policy_number=f"{1000000 + i}",
+            )
+            for i in range(SEED_PATIENTS)
+        ]
+        db.add_all(doctors + patients)
+        db.commit()
+
+        shifts = []
+        for offset in range(-SEED_DAYS_BACK, SEED_DAYS_AHEAD + 1):
+            day = (today + timedelta(days=offset)).strftime("%Y-%m-%d")
+            for doctor in doctors:
+                for slot in SEED_SLOTS:
+                    patient = rng.choice(patients)
+                    status = "scheduled" if offset >= 0 else rng.choice(("completed", "completed", "cancelled"))
+                    shifts.append({
+                        "date": day, "start_time": slot, "end_time": f"{int(slot[:2]) + 1}:{slot[3:]}",
+                        "shift_type": "консультация", "user_id": doctor.id, "user_name": doctor.name,
+                        "position": doctor.position, "patient_id": patient.id, "patient_name": patient.full_name,
+                        "status": status, "created_at": datetime.utcnow(), "updated_at": datetime.utcnow(),
+                    })
+        db.execute(insert(main.Shift), shifts)
+        db.commit()
+        shift_ids = [row[0] for row in db.query(main.Shift.id).all()]
+
+        assets = [
+            main.Asset(
+                title=f"Кейс {i} рентген" if i % 5 == 0 else f"Кейс {i}", description=f"Описание кейса {i}",
+                asset_type=ASSET_TYPES[i % len(ASSET_TYPES)], status=ASSET_STATUSES[i % len(ASSET_STATUSES)],
+                created_at=datetime.utcnow(), updated_at=datetime.utcnow() - timedelta(minutes=i),
+            )
+            for i in range(SEED_ASSETS)
+        ]
+        db.add_all(assets)
+        db.commit()
+        asset_ids = [asset.id for asset in assets]
+        handover_ids = seed_handovers(db, shift_ids, asset_ids, rng)
+
+        return {
+            "today": today.strftime("%Y-%m-%d"),
+            "week_start": (today - timedelta(days=3)).strftime("%Y-%m-%d"),
+            "week_end": (today + timedelta(days=3)).strftime("%Y-%m-%d"),
+            "doctor_ids": [doctor.id for doctor in doctors],
+            "patient_ids": [patient.id for patient in patients],
+            "shift_ids": shift_ids,
+            "asset_ids": asset_ids,
+            "handover_ids": handover_ids,
+            "rng": rng,
+        }
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="session")
+def client(seed):
+    """Клиент без запуска startup-событий: периодические задачи и фоновый писатель аудита не мешают подсчёту."""
+    return TestClient(main.app)
+
+
+def login(client, username: str, password: str) -> dict:
+    response = client.post("/api/login", json={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    return login(client, ADMIN_USERNAME, ADMIN_PASSWORD)
+
+
+@pytest.fixture(scope="session")
+def user_headers(client):
+    return login(client, "doctor0", USER_PASSWORD)
+
+
+@pytest.fixture
+def sql_log():
+    """
+    Контекстный менеджер, собирающий SQL-запросы (текст и параметры), выполненные внутри блока
+    любым движком приложения.
+    """
+    @contextmanager
+    def capture():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+
+    return capture
@@ -0,0 +1,65 @@
+"""
+Онлайн-бэкап под нагрузкой: пока идёт копирование, база постоянно пишется.
+Пошаговый бэкап SQLite при каждой записи начинает копирование заново —
+бэкап всё равно должен закончиться, а копия пройти integrity_check.
+"""
+
+import sqlite3
+import threading
+import time
+
+import backup
+
+
+def make_database(path, rows=2000):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT)")
+    conn.executemany("INSERT INTO notes (body) VALUES (?)", [("x" * 200,) for _ in range(rows)])
+    conn.commit()
+    conn.close()
+
+
+def test_backup_finishes_while_database_is_written(tmp_path):
+    db_path = str(tmp_path / "live.db")
+    make_database(db_path)
+    stop = threading.Event()
+    writes = []
+
+    def writer():
+        conn = sqlite3.connect(db_path, timeout=30)
+        while not stop.is_set():
+            conn.execute("INSERT INTO notes (body) VALUES ('during backup')")
+            conn.commit()
+            writes.append(1)
+            time.sleep(0.002)
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        started = time.monotonic()
+        # Маленькие шаги с паузами: без ограничения перезапусков такой бэкап не заканчивается
+        result = backup.backup_database(
+            db_path, str(tmp_path / "backups"), pages_per_step=5, step_sleep=0.01, compression="none"
+        )
+        elapsed = time.monotonic() - started
+    finally:
+        stop.set()
+        thread.join()
+
+    assert writes, "writer never ran"
+    assert elapsed < 20
+    backup.verify_backup(result["path"])
+    conn = sqlite3.connect(result["path"])
+    try:
+        assert conn.execute("SELECT count(*) FROM notes").fetchone()[0] >= 2000
+    finally:
+        conn.close()
+
+
+def test_idle_backup_is_copied_step_by_step(tmp_path):
+    db_path = str(tmp_path / "idle.db")
+    make_database(db_path, rows=200)
+    result = backup.backup_database(db_path, str(tmp_path / "backups"), step_sleep=0, compression="gzip")
+    assert result["file"].endswith(".db.gz")
+    assert [item["file"] for item in backup.list_backups(str(tmp_path / "backups"))] == [result["file"]]
@@ -0,0 +1,73 @@
+"""
+"Сейчас" для расписания берётся в часовом поясе клиники (CLINIC_TZ), а не сервера:
+в контейнере системное время — UTC, и без этого автозавершение, напоминания
+и свободные окна смещались бы на разницу поясов.
+"""
+
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clinic_behind_utc(monkeypatch):
+    """Клиника на UTC-12: её "сейчас" сильно отстаёт от системного времени тестовой машины."""
+    monkeypatch.setattr(main, "clinic_timezone", ZoneInfo("Etc/GMT+12"))
+
+
+def test_clinic_now_follows_clinic_timezone(clinic_behind_utc):
+    expected = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=12)
+    assert abs(main.clinic_now() - expected) < timedelta(seconds=5)
+
+
+def test_auto_complete_uses_clinic_time(clinic_behind_utc, seed):
+    # Приём через час по времени клиники — по системным часам он "закончился" много часов назад
+    start = main.clinic_now() + timedelta(hours=1)
+    end = start + timedelta(minutes=30)
+    db = main.open_session()
+    try:
+        shift = main.Shift(
+            date=start.strftime("%Y-%m-%d"), start_time=start.strftime("%H:%M"), end_time=end.strftime("%H:%M"),
+            shift_type="осмотр", user_id=seed["doctor_ids"][4], user_name="Врач 4", position="терапевт",
+        )
+        db.add(shift)
+        db.commit()
+        main.auto_complete_shifts(db, grace_minutes=0)
+        db.expire_all()
+        assert db.get(main.Shift, shift.id).status == "scheduled"
+    finally:
+        db.rollback()
+        db.query(main.Shift).filter(main.Shift.id == shift.id).delete()
+        db.commit()
+        db.close()
+
+
+def test_reminder_window_uses_clinic_time(clinic_behind_utc, monkeypatch, seed):
+    monkeypatch.setattr(main, "reminder_channels", {"telegram": object()})
+    lead = main.REMINDER_LEAD_MINUTES
+    start = (main.clinic_now() + timedelta(minutes=lead + 2)).replace(second=0, microsecond=0)
+    db = main.open_session()
+    try:
+        doctor = db.get(main.User, seed["doctor_ids"][5])
+        doctor.telegram_id = "clinic-time-chat"
+        shift = main.Shift(
+            date=start.strftime("%Y-%m-%d"), start_time=start.strftime("%H:%M"),
+            end_time=(start + timedelta(minutes=20)).strftime("%H:%M"),
+            shift_type="осмотр", user_id=doctor.id, user_name=doctor.name, position=doctor.position,
+        )
+        db.add(shift)
+        db.commit()
+        assert main.schedule_reminders(db) >= 1
+        reminder = db.query(main.ShiftReminder).filter(main.ShiftReminder.shift_id == shift.id).one()
+        assert reminder.send_at == start - timedelta(minutes=lead)
+    finally:
+        # База общая на сессию: не оставляем напоминание следующим тестам
+        db.rollback()
+        db.query(main.ShiftReminder).filter(main.ShiftReminder.shift_id == shift.id).delete()
+        db.query(main.Shift).filter(main.Shift.id == shift.id).delete()
+        doctor.telegram_id = None
+        db.commit()
+        db.close()
@@ -0,0 +1,73 @@
+"""
+Ограничитель попыток входа: опечатки разных сотрудников за одним IP (NAT, nginx)
+не должны накапливать задержку, которая потом блокирует верный пароль другого пользователя.
+"""
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_request(peer="203.0.113.7", real_ip=None):
+    headers = [(b"x-real-ip", real_ip.encode())] if real_ip else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 40000)})
+
+
+@pytest.fixture
+def throttles(monkeypatch):
+    """Свежие ограничители с настройками по умолчанию и управляемыми часами."""
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "time", clock)
+    monkeypatch.setattr(main, "user_login_throttle", main.LoginThrottle(5, 60))
+    monkeypatch.setattr(main, "ip_login_throttle", main.LoginThrottle(20, 3, progressive=False))
+    return clock
+
+
+def test_spaced_typos_do_not_block_other_users_behind_one_ip(throttles):
+    request = make_request()
+    for i in range(12):
+        username = f"typo{i % 3}"
+        main.check_login_throttle(request, username)
+        main.record_login_result(request, username, success=False)
+        # Опечатки разнесены во времени: лимит частоты успевает восстановиться
+        throttles.now += 30
+
+    main.check_login_throttle(request, "Sideffect")
+    main.record_login_result(request, "Sideffect", success=True)
+
+
+def test_ip_rate_limit_still_applies(throttles):
+    request = make_request()
+    for i in range(20):
+        main.check_login_throttle(request, f"user{i}")
+    with pytest.raises(HTTPException) as exc:
+        main.check_login_throttle(request, "Sideffect")
+    assert exc.value.status_code == 429
+    assert int(exc.value.headers["Retry-After"]) <= 4
+
+
+def test_user_key_keeps_progressive_delay(throttles):
+    request = make_request()
+    for _ in range(main.LOGIN_THROTTLE_FREE_FAILURES + 3):
+        main.record_login_result(request, "victim", success=False)
+    with pytest.raises(HTTPException) as exc:
+        main.check_login_throttle(request, "victim")
+    assert exc.value.status_code == 429
+
+
+def test_real_ip_header_trusted_only_from_proxy(monkeypatch):
+    monkeypatch.setattr(main, "TRUST_PROXY_HEADERS", True)
+    assert main.client_ip(make_request(peer="172.18.0.5", real_ip="198.51.100.1")) == "198.51.100.1"
+    assert main.client_ip(make_request(peer="203.0.113.7", real_ip="198.51.100.1")) == "203.0.113.7"
+    monkeypatch.setattr(main, "TRUST_PROXY_HEADERS", False)
+    assert main.client_ip(make_request(peer="172.18.0.5", real_ip="198.51.100.1")) == "172.18.0.5"
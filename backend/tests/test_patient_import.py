@@ -0,0 +1,72 @@
+"""
+Потоковый импорт пациентов из CSV: многострочные поля в кавычках разбираются,
+а лишняя кавычка даёт ошибку одной строки, не склеивая остаток файла в одну запись.
+"""
+
+import time
+
+import main
+
+HEADER = "full_name,birth_date,phone,policy_number"
+
+
+def csv_rows(count, prefix):
+    return [f"{prefix} Пациент {i},1980-02-{i % 28 + 1:02d},+7913{i:07d},{prefix}{i}" for i in range(count)]
+
+
+def post_import(client, headers, lines):
+    return client.post("/api/patients/import?format=csv", headers=headers, content="\n".join(lines).encode())
+
+
+def errors_of(client, headers, job_id):
+    response = client.get(f"/api/patients/import/{job_id}/errors", headers=headers)
+    assert response.status_code == 200
+    return [main.json.loads(line) for line in response.text.splitlines()]
+
+
+def test_stray_quote_fails_one_row_and_resyncs(client, admin_headers):
+    rows = csv_rows(20000, "Кавычкин")
+    rows[5] = '"Кавычкин Сломанный,1980-01-01,+79130000000,X1'
+    started = time.monotonic()
+    response = post_import(client, admin_headers, [HEADER] + rows)
+    elapsed = time.monotonic() - started
+    assert response.status_code == 200, response.text
+    job = response.json()
+    assert job["failed"] == 1
+    assert job["inserted"] == 19999
+    assert elapsed < 60
+    errors = errors_of(client, admin_headers, job["job_id"])
+    assert [error["line"] for error in errors] == [7]
+    assert "Malformed CSV record" in errors[0]["error"]
+
+
+def test_multiline_quoted_field_is_one_record(client, admin_headers):
+    lines = [
+        "full_name,birth_date,notes",
+        'Многострочный Пациент,1975-03-03,"первая строка',
+        "вторая строка",
+        'третья"',
+        "Следующий Пациент,1975-03-04,-",
+    ]
+    job = post_import(client, admin_headers, lines).json()
+    assert (job["inserted"], job["failed"]) == (2, 0)
+    db = main.open_session()
+    try:
+        notes = db.query(main.Patient.notes).filter(main.Patient.full_name == "Многострочный Пациент").scalar()
+    finally:
+        db.close()
+    assert notes == "первая строка\nвторая строка\nтретья"
+
+
+def test_unterminated_quote_at_end_is_reported(client, admin_headers):
+    lines = [HEADER] + csv_rows(3, "Хвостов") + ['"Хвостов Незакрытый,1980-01-01,+79130000009,Z']
+    job = post_import(client, admin_headers, lines).json()
+    assert (job["inserted"], job["failed"]) == (3, 1)
+    assert errors_of(client, admin_headers, job["job_id"])[0]["line"] == 5
+
+
+def test_overlong_line_is_not_buffered(client, admin_headers):
+    lines = [HEADER, "Длинный," + "x" * (main.IMPORT_MAX_LINE_LENGTH + 10)] + csv_rows(2, "Коротков")
+    job = post_import(client, admin_headers, lines).json()
+    assert (job["inserted"], job["failed"]) == (2, 1)
+    assert "longer than" in errors_of(client, admin_headers, job["job_id"])[0]["error"]
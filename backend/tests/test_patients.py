@@ -0,0 +1,44 @@
+"""
+Карточки пациентов: last_visit ведут триггеры по завершённым приёмам,
+вручную через PUT/PATCH его не поменять.
+Проверка дубликатов одинаково оценивает новые данные и карточки из базы.
+"""
+
+import main
+
+
+def test_put_ignores_last_visit(client, admin_headers):
+    created = client.post(
+        "/api/patients/?allow_duplicate=true", headers=admin_headers,
+        json={"full_name": "Визитов Ручной", "birth_date": "1970-07-07", "last_visit": "2024-05-01"},
+    ).json()
+    assert created["last_visit"].startswith("2024-05-01")
+
+    response = client.put(
+        f"/api/patients/{created['id']}", headers=admin_headers,
+        json={"full_name": "Визитов Ручной", "last_visit": "2020-01-01"},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["last_visit"].startswith("2024-05-01")
+    assert "last_visit" not in main.PatientUpdate.model_fields
+
+
+def test_duplicate_check_scores_incoming_like_stored(client, admin_headers):
+    body = {
+        "full_name": "Дублев Пётр Ильич", "birth_date": "12.03.1961", "phone": "8 (921) 555-44-33",
+        "email": " Dublev@Clinic.Test ", "policy_number": "50 1234-5678",
+    }
+    created = client.post("/api/patients/?allow_duplicate=true", headers=admin_headers, json=body).json()
+    # Те же данные в другой записи: формат даты, телефона, полиса и регистр email не важны
+    incoming = {**body, "birth_date": "1961-03-12", "phone": "+79215554433", "email": "dublev@clinic.test",
+                "policy_number": "5012345678"}
+    response = client.post("/api/patients/duplicates/check", headers=admin_headers, json=incoming)
+    assert response.status_code == 200, response.text
+    match = next(item for item in response.json() if item["id"] == created["id"])
+    assert match["score"] == 1.0
+    assert set(match["reasons"]) == {"policy_number", "surname_birth_date", "given_name", "full_name", "phone", "email"}
+
+    twin = client.post("/api/patients/?allow_duplicate=true", headers=admin_headers, json=incoming).json()
+    pairs = client.get("/api/patients/duplicates", headers=admin_headers).json()["pairs"]
+    pair = next(item for item in pairs if {item["patient_id"], item["duplicate_id"]} == {created["id"], twin["id"]})
+    assert (pair["score"], set(pair["reasons"])) == (match["score"], set(match["reasons"]))
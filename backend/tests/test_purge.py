@@ -0,0 +1,72 @@
+"""
+Окончательное удаление мягко удалённого сотрудника: его смены остаются в расписании
+и истории (без ссылки на учётную запись, с именем и должностью), как смены удалённого
+пациента. Старые базы, где shifts.user_id объявлен NOT NULL, пересоздаются при старте.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateTable
+
+import main
+
+
+def test_purged_user_keeps_shifts(seed):
+    db = main.open_session()
+    shift_id = None
+    try:
+        user = main.User(
+            username="purged-doctor", hashed_password="-", name="Уволенный врач", position="хирург",
+            is_active=False, deleted_at=datetime(2000, 1, 1),
+        )
+        db.add(user)
+        db.flush()
+        shift = main.Shift(
+            date="2000-01-01", start_time="10:00", end_time="10:30", shift_type="осмотр",
+            user_id=user.id, user_name=user.name, position=user.position, status="completed",
+        )
+        db.add(shift)
+        db.flush()
+        handover = main.ShiftHandover(from_shift_id=shift.id, handover_notes="Передача перед увольнением")
+        db.add(handover)
+        db.commit()
+        user_id, shift_id, handover_id, version = user.id, shift.id, handover.id, shift.version
+
+        purged = main.purge_deleted_rows(db, main.User, main.purge_user_refs, datetime(2000, 1, 2), 10)
+        db.expire_all()
+
+        assert purged == 1
+        assert db.query(main.User).execution_options(include_deleted=True).filter(main.User.id == user_id).first() is None
+        kept = db.get(main.Shift, shift_id)
+        assert (kept.user_id, kept.user_name, kept.position) == (None, "Уволенный врач", "хирург")
+        assert kept.version == version + 1
+        assert db.get(main.ShiftHandover, handover_id).from_shift_id == shift_id
+    finally:
+        db.rollback()
+        db.query(main.ShiftHandover).filter(main.ShiftHandover.from_shift_id == shift_id).delete()
+        db.query(main.Shift).filter(main.Shift.id == shift_id).delete()
+        db.commit()
+        db.close()
+
+
+def test_old_schema_allows_detached_shifts(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    # Так таблица смен создавалась до того, как user_id стал необязательным
+    ddl = str(CreateTable(main.Shift.__table__).compile(engine))
+    assert "user_id INTEGER," in ddl
+    with engine.begin() as conn:
+        conn.exec_driver_sql(ddl.replace("user_id INTEGER,", "user_id INTEGER NOT NULL,"))
+        conn.exec_driver_sql(
+            "INSERT INTO shifts (date, start_time, end_time, shift_type, user_id, user_name, position, version) "
+            "VALUES ('2024-01-01', '09:00', '09:30', 'осмотр', 5, 'Врач', 'терапевт', 1)"
+        )
+    try:
+        main.init_database(engine)
+        with engine.begin() as conn:
+            notnull = {row[1]: row[3] for row in conn.exec_driver_sql("PRAGMA table_info(shifts)")}
+            assert notnull["user_id"] == 0
+            assert conn.exec_driver_sql("SELECT user_id, user_name FROM shifts").all() == [(5, "Врач")]
+            conn.exec_driver_sql("UPDATE shifts SET user_id = NULL")
+    finally:
+        engine.dispose()
@@ -0,0 +1,131 @@
+"""
+Планы запросов горячих маршрутов.
+
+SELECT-запросы, выполненные во время запроса к API, прогоняются через EXPLAIN QUERY PLAN
+с теми же параметрами. Полный проход по таблице (SCAN без USING INDEX) там, где ожидается индекс,
+роняет тест: значит, индекс потерян или запрос переписан так, что SQLite не может его использовать.
+Проход по индексу (SCAN ... USING [COVERING] INDEX) обычно допустим — так читаются отсортированные
+списки. Но для поиска он тот же перебор всех строк, только в порядке индекса: в таких маршрутах
+(index_scan=False) запрещён любой SCAN, таблица должна читаться через SEARCH.
+"""
+
+import re
+from collections import namedtuple
+
+import pytest
+
+import main
+
+# forbidden — таблицы, которые в этом маршруте нельзя читать полным проходом;
+# index_scan=False — нельзя и проходом по индексу без границ
+PlanCase = namedtuple("PlanCase", "name url forbidden headers index_scan", defaults=("user", True))
+
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+ANY_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: |$)")
+
+
+def plan_cases(seed):
+    doctor_id = seed["doctor_ids"][0]
+    patient_id = seed["patient_ids"][0]
+    period = f"from={seed['week_start']}&to={seed['week_end']}"
+    return [
+        # Диапазон смен
+        PlanCase("shift range", f"/api/shifts/?{period}&order_by=start", {"shifts"}),
+        PlanCase("shift day", f"/api/shifts/?date={seed['today']}", {"shifts"}),
+        PlanCase("doctor schedule", f"/api/shifts/?{period}&user_id={doctor_id}&order_by=start", {"shifts"}),
+        PlanCase("shift calendar", f"/api/shifts/calendar?{period}&group_by=day", {"shifts"}),
+        PlanCase("availability", f"/api/availability?user_id={doctor_id}&{period}", {"shifts"}),
+        PlanCase("patient timeline", f"/api/patients/{patient_id}/timeline", {"shifts", "patients"}),
+        # Поиск пациентов: подстрока ищется по триграммному индексу, карточки читаются по id
+        PlanCase("patient search", "/api/patients/?search=петров&fields=id,full_name", {"patients"},
+                 index_scan=False),
+        PlanCase("patient card", f"/api/patients/{patient_id}", {"patients"}),
+        # Список передач читается целиком, но активы к нему — только по ключу
+        PlanCase("handover listing", "/api/handovers/", {"assets"}),
+        PlanCase("handover card", f"/api/handovers/{seed['handover_ids'][0]}",
+                 {"shift_handovers", "handover_assets", "assets"}),
+        PlanCase("handover export", "/api/handovers/export?since=", {"handover_logs", "handover_log_tombstones"}),
+        # Дашборд
+        PlanCase("dashboard", "/api/dashboard/summary", {"shifts", "patients", "assets"}),
+        PlanCase("assets page", "/api/assets/page?status=Active&limit=20", {"assets"}),
+        PlanCase("audit history", f"/api/audit?entity=patients&entity_id={patient_id}", {"audit_log"}, "admin"),
+    ]
+
+
+def explain(sql: str, parameters) -> list:
+    """Строки плана (detail) для запроса с его параметрами."""
+    with main.engine.connect() as conn:
+        return [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", parameters or ())]
+
+
+def full_scans(plan: list, tables: set, index_scan: bool = True) -> list:
+    pattern = FULL_SCAN if index_scan else ANY_SCAN
+    return [detail for detail in plan if (match := pattern.match(detail)) and match.group(1) in tables]
+
+
+@pytest.fixture(scope="module")
+def cases(seed):
+    return {case.name: case for case in plan_cases(seed)}
+
+
+CASE_NAMES = [
+    "shift range", "shift day", "doctor schedule", "shift calendar", "availability", "patient timeline",
+    "patient search", "patient card", "handover listing", "handover card", "handover export",
+    "dashboard", "assets page", "audit history",
+]
+
+
+@pytest.mark.parametrize("name", CASE_NAMES)
+def test_hot_queries_use_indexes(name, cases, client, admin_headers, user_headers, sql_log):
+    case = cases[name]
+    headers = admin_headers if case.headers == "admin" else user_headers
+    with sql_log() as statements:
+        response = client.get(case.url, headers=headers)
+    assert response.status_code == 200, response.text
+
+    selects = [(sql, params) for sql, params in statements if sql.lstrip().upper().startswith(("SELECT", "WITH"))]
+    assert selects, f"{name}: no SELECT statements captured"
+
+    problems = []
+    for sql, params in selects:
+        plan = explain(sql, params)
+        scans = full_scans(plan, case.forbidden, case.index_scan)
+        if scans:
+            problems.append(f"{sql}\n  params: {params}\n  plan: {plan}")
+    assert not problems, f"{name}: full table scan where an index is expected\n" + "\n\n".join(problems)
+
+
+def test_full_scan_detection():
+    """Сама проверка: полный проход ловится в обоих форматах SQLite, проход по индексу — нет."""
+    assert full_scans(["SCAN shifts"], {"shifts"}) == ["SCAN shifts"]
+    assert full_scans(["SCAN TABLE shifts"], {"shifts"}) == ["SCAN TABLE shifts"]
+    assert full_scans(["SCAN shifts USING INDEX ix_shifts_date_start"], {"shifts"}) == []
+    assert full_scans(["SCAN patients USING COVERING INDEX ix_patients_live_created_at"], {"patients"}) == []
+    assert full_scans(["SEARCH assets USING INTEGER PRIMARY KEY (rowid=?)"], {"assets"}) == []
+    assert full_scans(["SCAN users"], {"shifts"}) == []
+    # Для поиска проход по индексу — тоже перебор
+    scan = "SCAN patients USING INDEX ix_patients_live_created_at"
+    assert full_scans([scan], {"patients"}, index_scan=False) == [scan]
+    assert full_scans(["SCAN patients_fts VIRTUAL TABLE INDEX 0:M1"], {"patients"}, index_scan=False) == []
+    assert full_scans(["SEARCH patients USING INTEGER PRIMARY KEY (rowid=?)"], {"patients"}, index_scan=False) == []
+
+
+def test_dropped_index_is_detected(seed):
+    """Если индекс диапазона пропадёт, выборка смен за период превратится в полный проход — это должно ловиться."""
+    sql = "SELECT id FROM shifts NOT INDEXED WHERE date >= ? AND date <= ? ORDER BY date, start_time"
+    plan = explain(sql, (seed["week_start"], seed["week_end"]))
+    assert full_scans(plan, {"shifts"})
+
+
+def test_unindexed_search_is_detected(cases, client, user_headers, sql_log):
+    """Поиск пациентов перебором (LIKE в порядке created_at) проверка поиска должна ронять."""
+    enabled = main.patients_fts_enabled
+    main.patients_fts_enabled = False
+    try:
+        with sql_log() as statements:
+            response = client.get(cases["patient search"].url, headers=user_headers)
+    finally:
+        main.patients_fts_enabled = enabled
+    assert response.status_code == 200
+    plans = [explain(sql, params) for sql, params in statements if "FROM patients" in sql]
+    assert any(full_scans(plan, {"patients"}, index_scan=False) for plan in plans)
@@ -0,0 +1,315 @@
+"""
+Каналы напоминаний против локальных заглушек: SMTP-сервер на socketserver
+и HTTP-сервер вместо Telegram Bot API. Проверяются отправка пачки по одному
+соединению, классификация ошибок, повтор с паузой и то, что перезапуск
+диспетчера не отправляет уже отправленное второй раз.
+"""
+
+import json
+import socketserver
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+
+# ---------- Заглушка SMTP ----------
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Минимальный диалог SMTP: EHLO, MAIL, RCPT, DATA, RSET, QUIT."""
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 clinic-test ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode("ascii", "replace").strip()[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-clinic-test")
+                self.reply("250 8BITMIME")
+            elif verb == "RCPT":
+                with server.lock:
+                    self.reply(server.rcpt_replies.pop(0) if server.rcpt_replies else "250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in iter(self.rfile.readline, b""):
+                    if data_line == b".\r\n":
+                        break
+                    data.append(data_line)
+                with server.lock:
+                    server.messages.append(b"".join(data))
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            elif verb in ("HELO", "MAIL", "RSET", "NOOP"):
+                self.reply("250 OK")
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+        # Ответы на RCPT по очереди (например, "451 ..."); пустая очередь — 250
+        self.rcpt_replies = []
+
+
+# ---------- Заглушка Telegram Bot API ----------
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append((self.path, body))
+            status, payload = server.responses.pop(0) if server.responses else (200, {"ok": True})
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TelegramStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), TelegramHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        # Ответы по очереди: (HTTP-статус, JSON); пустая очередь — 200 {"ok": true}
+        self.responses = []
+
+
+@contextmanager
+def serving(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.fixture
+def smtp_server():
+    with serving(SmtpStandIn()) as server:
+        yield server
+
+
+@pytest.fixture
+def telegram_server():
+    with serving(TelegramStandIn()) as server:
+        yield server
+
+
+def smtp_channel(server) -> main.SmtpReminderChannel:
+    host, port = server.server_address
+    return main.SmtpReminderChannel(host, port, "", "", "clinic@clinic.test", False, 5, main.TokenBucket(1000))
+
+
+def telegram_channel(server) -> main.TelegramReminderChannel:
+    host, port = server.server_address
+    return main.TelegramReminderChannel(f"http://{host}:{port}", "TEST:TOKEN", 5, main.TokenBucket(1000))
+
+
+def message(address: str) -> dict:
+    return {"address": address, "subject": "Напоминание о приёме", "text": "Напоминание: завтра в 10:00 — осмотр."}
+
+
+# ---------- Каналы ----------
+
+def test_smtp_batch_uses_one_connection(smtp_server):
+    errors = smtp_channel(smtp_server).send_batch([message("a@clinic.test"), message("b@clinic.test")])
+    assert errors == [None, None]
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    assert b"To: b@clinic.test" in smtp_server.messages[1]
+
+
+def test_smtp_recipient_errors_are_classified(smtp_server):
+    smtp_server.rcpt_replies = ["451 Try again later", "550 No such user"]
+    temporary, permanent, sent = smtp_channel(smtp_server).send_batch(
+        [message("busy@clinic.test"), message("gone@clinic.test"), message("ok@clinic.test")]
+    )
+    # 4xx на RCPT — повторим позже, 5xx — адрес не существует
+    assert not temporary.permanent
+    assert permanent.permanent
+    assert sent is None
+    assert len(smtp_server.messages) == 1
+
+
+def test_smtp_unavailable_is_temporary():
+    server = SmtpStandIn()
+    server.server_close()  # порт свободен, но никто не слушает
+    errors = smtp_channel(server).send_batch([message("a@clinic.test"), message("b@clinic.test")])
+    assert len(errors) == 2
+    assert all(error is not None and not error.permanent for error in errors)
+
+
+def test_telegram_batch_uses_one_connection(telegram_server):
+    errors = telegram_channel(telegram_server).send_batch([message("100"), message("200")])
+    assert errors == [None, None]
+    assert telegram_server.connections == 1
+    assert [body["chat_id"] for _, body in telegram_server.requests] == ["100", "200"]
+    assert all(path == "/botTEST:TOKEN/sendMessage" for path, _ in telegram_server.requests)
+
+
+def test_telegram_errors_are_classified(telegram_server):
+    telegram_server.responses = [
+        (429, {"ok": False, "description": "Too Many Requests", "parameters": {"retry_after": 7}}),
+        (403, {"ok": False, "description": "Forbidden: bot was blocked by the user"}),
+        (502, {"ok": False}),
+    ]
+    throttled, blocked, unavailable, sent = telegram_channel(telegram_server).send_batch(
+        [message("1"), message("2"), message("3"), message("4")]
+    )
+    assert not throttled.permanent and throttled.retry_after == 7
+    assert blocked.permanent
+    assert not unavailable.permanent
+    assert sent is None
+
+
+# ---------- Диспетчер ----------
+
+@pytest.fixture
+def due_reminder(seed):
+    """Приём через 55 минут и его напоминание, которое уже пора отправить."""
+    lead = main.REMINDER_LEAD_MINUTES
+    start = (main.clinic_now() + timedelta(minutes=55)).replace(second=0, microsecond=0)
+    db = main.open_session()
+    try:
+        shift = main.Shift(
+            date=start.strftime("%Y-%m-%d"), start_time=start.strftime("%H:%M"),
+            end_time=(start + timedelta(minutes=20)).strftime("%H:%M"),
+            shift_type="осмотр", user_id=seed["doctor_ids"][6], user_name="Врач 6", position="терапевт",
+        )
+        db.add(shift)
+        db.flush()
+        send_at = start - timedelta(minutes=lead)
+        reminder = main.ShiftReminder(
+            shift_id=shift.id, channel="telegram", address="777", recipient="user",
+            send_at=send_at, next_attempt_at=send_at, status="pending", attempts=0,
+        )
+        db.add(reminder)
+        db.commit()
+        shift_id, reminder_id = shift.id, reminder.id
+    finally:
+        db.close()
+    yield reminder_id
+    db = main.open_session()
+    try:
+        # База общая на сессию: не оставляем очередь следующим тестам
+        db.query(main.ShiftReminder).filter(main.ShiftReminder.shift_id == shift_id).delete()
+        db.query(main.Shift).filter(main.Shift.id == shift_id).delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def dispatch(now):
+    """Один проход диспетчера в отдельной сессии — как после перезапуска процесса."""
+    db = main.open_session()
+    try:
+        return main.dispatch_reminders(db, now=now)
+    finally:
+        db.close()
+
+
+def reminder_row(reminder_id: int) -> main.ShiftReminder:
+    db = main.open_session()
+    try:
+        return db.get(main.ShiftReminder, reminder_id)
+    finally:
+        db.close()
+
+
+def test_dispatch_retries_with_backoff_then_sends_once(monkeypatch, telegram_server, due_reminder):
+    monkeypatch.setattr(main, "reminder_channels", {"telegram": telegram_channel(telegram_server)})
+    telegram_server.responses = [(500, {"ok": False, "description": "Internal Server Error"})]
+    now = main.clinic_now()
+
+    assert dispatch(now)["retried"] == 1
+    row = reminder_row(due_reminder)
+    assert (row.status, row.attempts) == ("pending", 1)
+    delay = row.next_attempt_at - now
+    assert timedelta(seconds=main.REMINDER_RETRY_BASE_SECONDS - 5) < delay < timedelta(seconds=main.REMINDER_RETRY_BASE_SECONDS + 5)
+
+    # Пауза ещё не прошла — повторной отправки нет
+    assert dispatch(now)["retried"] == 0
+    assert len(telegram_server.requests) == 1
+
+    later = row.next_attempt_at + timedelta(seconds=1)
+    assert dispatch(later)["sent"] == 1
+    row = reminder_row(due_reminder)
+    assert (row.status, row.attempts, row.last_error) == ("sent", 2, None)
+
+    # Перезапущенный диспетчер отправленное не трогает
+    assert dispatch(later + timedelta(minutes=5))["sent"] == 0
+    assert len(telegram_server.requests) == 2
+
+
+def test_dispatch_respects_retry_after(monkeypatch, telegram_server, due_reminder):
+    monkeypatch.setattr(main, "reminder_channels", {"telegram": telegram_channel(telegram_server)})
+    telegram_server.responses = [(429, {"ok": False, "parameters": {"retry_after": 600}})]
+    now = main.clinic_now()
+
+    assert dispatch(now)["retried"] == 1
+    delay = reminder_row(due_reminder).next_attempt_at - now
+    assert timedelta(seconds=595) < delay < timedelta(seconds=605)
+
+
+def test_claimed_reminder_is_not_sent_twice(monkeypatch, telegram_server, due_reminder):
+    monkeypatch.setattr(main, "reminder_channels", {"telegram": telegram_channel(telegram_server)})
+    now = main.clinic_now()
+    db = main.open_session()
+    try:
+        # Другой воркер захватил строку и ещё отправляет её
+        row = db.get(main.ShiftReminder, due_reminder)
+        row.status = "sending"
+        row.next_attempt_at = now + timedelta(seconds=main.REMINDER_CLAIM_SECONDS)
+        db.commit()
+    finally:
+        db.close()
+
+    assert dispatch(now)["sent"] == 0
+    assert telegram_server.requests == []
+
+    # Воркер упал, захват истёк — строка вернулась в очередь и ушла один раз
+    expired = now + timedelta(seconds=main.REMINDER_CLAIM_SECONDS + 1)
+    assert dispatch(expired)["sent"] == 1
+    assert dispatch(expired)["sent"] == 0
+    assert len(telegram_server.requests) == 1
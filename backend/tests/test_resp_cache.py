@@ -0,0 +1,173 @@
+"""
+Внешний кэш запросов (QUERY_CACHE_BACKEND=redis) против заглушки RESP-сервера на socketserver:
+MGET / SET PX / INCR, инвалидация тегов между двумя воркерами с общим кэшем,
+сброс соединения после ошибки AUTH/SELECT и работа без кэша, когда сервер недоступен.
+"""
+
+import socketserver
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """Команды, которые использует RespCacheBackend, плюс AUTH и SELECT."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+        return args
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        authenticated = server.password is None
+        db = 0
+        while True:
+            args = self.read_command()
+            if not args:
+                return
+            command = args[0].upper()
+            with server.lock:
+                server.commands.append(command)
+            if command == "AUTH":
+                authenticated = args[1] == server.password
+                reply = b"+OK\r\n" if authenticated else b"-WRONGPASS invalid password\r\n"
+            elif not authenticated:
+                reply = b"-NOAUTH Authentication required.\r\n"
+            elif command == "SELECT":
+                if int(args[1]) < server.databases:
+                    db = int(args[1])
+                    reply = b"+OK\r\n"
+                else:
+                    reply = b"-ERR DB index is out of range\r\n"
+            else:
+                reply = server.execute(db, command, args[1:])
+            self.wfile.write(reply)
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None, databases=16):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.password = password
+        self.databases = databases
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = []
+        self.data = {}  # (база, ключ) -> (значение, истекает в или None)
+
+    def _get(self, db, key):
+        item = self.data.get((db, key))
+        if item is not None and item[1] is not None and item[1] < time.monotonic():
+            del self.data[(db, key)]
+            item = None
+        return item[0] if item is not None else None
+
+    def execute(self, db, command, args):
+        with self.lock:
+            if command == "MGET":
+                values = [self._get(db, key) for key in args]
+                return b"*%d\r\n" % len(values) + b"".join(
+                    b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value) for value in values
+                )
+            if command == "SET" and len(args) == 4 and args[2].upper() == "PX":
+                self.data[(db, args[0])] = (args[1].encode("utf-8"), time.monotonic() + int(args[3]) / 1000)
+                return b"+OK\r\n"
+            if command == "INCR":
+                value = int(self._get(db, args[0]) or 0) + 1
+                self.data[(db, args[0])] = (str(value).encode(), None)
+                return b":%d\r\n" % value
+        return b"-ERR unknown command\r\n"
+
+
+@pytest.fixture
+def resp_server():
+    server = RespStandIn(password="secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def backend_for(server, password="secret", db=1) -> main.RespCacheBackend:
+    host, port = server.server_address
+    return main.RespCacheBackend(f"redis://:{password}@{host}:{port}/{db}", 0.5)
+
+
+def test_mget_set_px_incr(resp_server):
+    backend = backend_for(resp_server)
+    assert backend.get_many(["qc:a", "qc:b"]) == [None, None]
+    backend.set("qc:a", {"value": ["Иванов"], "tags": [0]}, 60)
+    backend.set("qc:short", [1], 0.05)
+    assert backend.incr("qc:tag") == 1
+    assert backend.incr("qc:tag") == 2
+    time.sleep(0.1)
+    assert backend.get_many(["qc:a", "qc:short", "qc:tag"]) == [{"value": ["Иванов"], "tags": [0]}, None, 2]
+    # Вход и выбор базы — один раз на соединение
+    assert resp_server.connections == 1
+    assert resp_server.commands.count("AUTH") == 1
+    assert resp_server.commands.count("SELECT") == 1
+    assert (1, "qc:tag") in resp_server.data
+
+
+def test_tag_invalidation_is_shared_between_workers(monkeypatch, resp_server):
+    first, second = backend_for(resp_server), backend_for(resp_server)
+    cache = main.QueryCache("resp_test_patients", ("patients",), 60)
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return [{"id": len(computed)}]
+
+    monkeypatch.setattr(main, "query_cache_backend", first)
+    assert cache.get_or_compute(("all",), compute) == [{"id": 1}]
+    # Второй воркер видит запись первого
+    monkeypatch.setattr(main, "query_cache_backend", second)
+    assert cache.get_or_compute(("all",), compute) == [{"id": 1}]
+
+    # Коммит во втором воркере инвалидирует тег — первый перечитывает базу
+    main.invalidate_cache_tags(None, ["patients"])
+    monkeypatch.setattr(main, "query_cache_backend", first)
+    assert cache.get_or_compute(("all",), compute) == [{"id": 2}]
+    assert len(computed) == 2
+    assert cache.stats(None)["hits"] == 1
+
+
+@pytest.mark.parametrize("password, db", [("wrong", 1), ("secret", 99)])
+def test_handshake_error_resets_connection(resp_server, password, db):
+    backend = backend_for(resp_server, password=password, db=db)
+    for attempt in (1, 2):
+        with pytest.raises(RuntimeError):
+            backend.get_many(["qc:a"])
+        assert backend._local.conn is None
+        # Каждый вызов — новое соединение с новым входом, а не MGET в соединении без входа
+        assert resp_server.connections == attempt
+    assert "MGET" not in resp_server.commands
+
+
+def test_unavailable_server_falls_back_to_database(monkeypatch):
+    server = RespStandIn()
+    server.server_close()  # порт свободен, но никто не слушает
+    monkeypatch.setattr(main, "query_cache_backend", backend_for(server))
+    cache = main.QueryCache("resp_test_down", ("patients",), 60)
+
+    assert cache.get_or_compute(("all",), lambda: ["from db"]) == ["from db"]
+    assert cache.stats(None)["errors"] == 1
+
+    errors = main.query_cache_invalidation[None]["errors"]
+    main.invalidate_cache_tags(None, ["patients"])
+    assert main.query_cache_invalidation[None]["errors"] == errors + 1
@@ -0,0 +1,70 @@
+"""
+Завершение приёмов: completed допускается только для уже закончившихся смен,
+иначе триггер last_visit сдвинул бы дату последнего визита пациента в будущее.
+"""
+
+from datetime import datetime, timedelta
+
+import main
+
+
+def add_shift(seed, days, start="10:00", end="10:30", patient_index=0):
+    db = main.open_session()
+    try:
+        shift = main.Shift(
+            date=(datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d"), start_time=start, end_time=end,
+            shift_type="осмотр", user_id=seed["doctor_ids"][3], user_name="Врач 3", position="терапевт",
+            patient_id=seed["patient_ids"][patient_index],
+        )
+        db.add(shift)
+        db.commit()
+        return shift.id
+    finally:
+        db.close()
+
+
+def last_visit(patient_id):
+    db = main.open_session()
+    try:
+        return db.get(main.Patient, patient_id).last_visit
+    finally:
+        db.close()
+
+
+def test_bulk_complete_rejects_future_shifts(client, admin_headers, seed):
+    past, future = add_shift(seed, -3, patient_index=7), add_shift(seed, 5 * 365, patient_index=7)
+    response = client.post(
+        "/api/shifts/status", headers=admin_headers, json={"status": "completed", "ids": [past, future, 10 ** 9]}
+    )
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert body["updated"] == [past]
+    assert [(item["id"], item["reason"], item["status_code"]) for item in body["rejected"]] == [
+        (future, "not_ended", 409), (10 ** 9, "not_found", 404),
+    ]
+    assert last_visit(seed["patient_ids"][7]) < datetime.now()
+
+    again = client.post("/api/shifts/status", headers=admin_headers, json={"status": "completed", "ids": [past]})
+    assert again.json()["rejected"][0]["reason"] == "invalid_transition"
+
+
+def test_patch_complete_requires_ended_shift(client, admin_headers, seed):
+    future = add_shift(seed, 30, patient_index=8)
+    url = f"/api/shifts/{future}"
+    version = client.get(url, headers=admin_headers).json()["version"]
+    response = client.patch(url, headers={**admin_headers, "If-Match": f'"{version}"'}, json={"status": "completed"})
+    assert response.status_code == 409
+
+    # Перенос в прошлое вместе с завершением — допустим
+    past_day = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    response = client.patch(
+        url, headers={**admin_headers, "If-Match": f'"{version}"'}, json={"status": "completed", "date": past_day}
+    )
+    assert response.status_code == 200, response.text
+
+
+def test_overnight_shift_ends_next_day():
+    moment = datetime(2024, 3, 2, 7, 0)
+    assert main.shift_has_ended("2024-03-01", "22:00", "06:00", moment)
+    assert not main.shift_has_ended("2024-03-01", "22:00", "08:00", moment)
+    assert not main.shift_has_ended("2024-03-02", "06:00", "07:30", moment)
@@ -0,0 +1,371 @@
+"""
+Бюджет SQL-запросов на каждый маршрут API.
+
+Каждый маршрут main.app вызывается на заполненной базе, и число выполненных SQL-запросов
+сравнивается с бюджетом. Бюджет не зависит от объёма данных: новый N+1 (запрос на каждую
+строку списка) сразу выводит маршрут за предел. Подготовка (создание записей, которые маршрут
+меняет или удаляет) идёт вне окна подсчёта.
+
+Новый маршрут без строки в ROUTE_CASES роняет test_every_route_has_budget.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.routing import APIRoute
+
+import main
+from conftest import ADMIN_PASSWORD, ADMIN_USERNAME, USER_PASSWORD, login, seed_handovers
+
+# prepare(ctx) -> аргументы client.request (url, json, headers, content); after(ctx) — уборка после вызова
+RouteCase = namedtuple("RouteCase", "method route budget prepare after", defaults=(None,))
+
+
+class Context:
+    """Всё, что нужно подготовке запроса: клиент, заголовки админа и врача, id из seed."""
+
+    def __init__(self, client, admin, user, seed):
+        self.client = client
+        self.admin = admin
+        self.user = user
+        self.seed = seed
+
+    def add(self, row):
+        """Создать строку напрямую через ORM (вне окна подсчёта) и вернуть её id."""
+        db = main.open_session()
+        try:
+            db.add(row)
+            db.commit()
+            return row.id
+        finally:
+            db.close()
+
+    def new_user(self, deleted=False):
+        return self.add(main.User(
+            username=f"tmp{datetime.utcnow().timestamp()}", hashed_password=main.get_password_hash(USER_PASSWORD),
+            name="Временный", position="медсестра", deleted_at=datetime.utcnow() if deleted else None,
+        ))
+
+    def new_patient(self, deleted=False):
+        return self.add(main.Patient(
+            full_name="Временный Пациент", birth_date="1990-01-01",
+            deleted_at=datetime.utcnow() if deleted else None,
+        ))
+
+    def new_asset(self, deleted=False):
+        return self.add(main.Asset(
+            title="Временный кейс", description="-", asset_type="CASE", status="Active",
+            deleted_at=datetime.utcnow() if deleted else None,
+        ))
+
+    def new_shift(self, days_ahead=10):
+        doctor_id = self.seed["doctor_ids"][1]
+        return self.add(main.Shift(
+            date=(datetime.now() + timedelta(days=days_ahead)).strftime("%Y-%m-%d"), start_time="18:00",
+            end_time="18:30", shift_type="осмотр", user_id=doctor_id, user_name="Врач 1", position="терапевт",
+        ))
+
+    def new_handover_log(self):
+        return self.add(main.HandoverLog(
+            log_date=datetime.now().strftime("%Y-%m-%d"), log_time="09:00", from_shift_user="doctor0",
+            from_shift_time="09:00-10:00", to_shift_user="doctor1", to_shift_time="10:30-11:30",
+            handover_notes="Временная передача", assets_info="-",
+        ))
+
+    def version_headers(self, url, headers=None):
+        """Заголовок If-Match с текущей версией записи."""
+        headers = headers or self.admin
+        version = self.client.get(url, headers=headers).json()["version"]
+        return {**headers, "If-Match": f'"{version}"'}
+
+
+def shift_body(ctx, count=1):
+    day = (datetime.now() + timedelta(days=20)).strftime("%Y-%m-%d")
+    return {
+        "date": day, "start_time": "19:00", "end_time": "19:30", "shift_type": "осмотр",
+        "user_id": ctx.seed["doctor_ids"][2], "patient_id": ctx.seed["patient_ids"][count],
+    }
+
+
+def patient_body(name="Новиков Андрей"):
+    return {"full_name": name, "birth_date": "1985-05-05", "phone": "+7 911 000-00-01", "policy_number": "77 0001"}
+
+
+def import_body():
+    rows = ["full_name,birth_date,phone,policy_number"]
+    rows += [f"Импортов Пациент {i},1970-01-{i + 1:02d},+7912{i:07d},{9000000 + i}" for i in range(20)]
+    return "\n".join(rows)
+
+
+def reseed_handovers(ctx):
+    db = main.open_session()
+    try:
+        ctx.seed["handover_ids"] = seed_handovers(db, ctx.seed["shift_ids"], ctx.seed["asset_ids"], ctx.seed["rng"])
+    finally:
+        db.close()
+
+
+def audit_request(ctx):
+    # Буфер аудита сбрасывается заранее: иначе в окно попадёт запись всего, что накопили предыдущие тесты
+    main.audit_writer.flush()
+    return {"url": f"/api/audit?entity=patients&entity_id={ctx.seed['patient_ids'][10]}", "headers": ctx.admin}
+
+
+def first(ids):
+    return ids[0]
+
+
+ROUTE_CASES = [
+    RouteCase("GET", "/", 0, lambda ctx: {"url": "/"}),
+    RouteCase("POST", "/token", 2, lambda ctx: {
+        "url": "/token", "data": {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD},
+    }),
+    RouteCase("POST", "/api/login", 2, lambda ctx: {
+        "url": "/api/login", "json": {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD},
+    }),
+    RouteCase("POST", "/api/token/refresh", 3, lambda ctx: {
+        "url": "/api/token/refresh",
+        "json": {"refresh_token": ctx.client.post(
+            "/api/login", json={"username": "doctor3", "password": USER_PASSWORD}
+        ).json()["refresh_token"]},
+    }),
+    RouteCase("POST", "/api/logout", 1, lambda ctx: {
+        "url": "/api/logout",
+        "json": {"refresh_token": ctx.client.post(
+            "/api/login", json={"username": "doctor3", "password": USER_PASSWORD}
+        ).json()["refresh_token"]},
+    }),
+    RouteCase("POST", "/api/register", 3, lambda ctx: {
+        "url": "/api/register",
+        "json": {"username": "registered", "password": USER_PASSWORD, "name": "Новый", "position": "медсестра"},
+    }),
+    RouteCase("GET", "/api/me", 1, lambda ctx: {"url": "/api/me", "headers": ctx.user}),
+    RouteCase("PUT", "/api/profile", 3, lambda ctx: {
+        "url": "/api/profile", "headers": ctx.user,
+        "json": {"name": "Врач 0", "position": "терапевт", "phone": "+7 900 000-00-00"},
+    }),
+
+    # ----- Пользователи -----
+    RouteCase("POST", "/api/users/", 4, lambda ctx: {
+        "url": "/api/users/", "headers": ctx.admin,
+        "json": {"username": "created", "password": USER_PASSWORD, "name": "Создан", "position": "медсестра"},
+    }),
+    RouteCase("GET", "/api/users/", 2, lambda ctx: {"url": "/api/users/", "headers": ctx.admin}),
+    RouteCase("GET", "/api/users/public", 2, lambda ctx: {
+        "url": "/api/users/public?fields=id,name,position", "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/users/{user_id}", 2, lambda ctx: {
+        "url": f"/api/users/{first(ctx.seed['doctor_ids'])}", "headers": ctx.admin,
+    }),
+    RouteCase("PUT", "/api/users/{user_id}", 5, lambda ctx: {
+        "url": f"/api/users/{ctx.seed['doctor_ids'][4]}", "headers": ctx.admin,
+        "json": {"username": "doctor4", "password": USER_PASSWORD, "name": "Врач 4", "position": "хирург"},
+    }),
+    RouteCase("PATCH", "/api/users/{user_id}", 3, lambda ctx: {
+        "url": f"/api/users/{ctx.seed['doctor_ids'][5]}", "json": {"phone": "+7 900 555-55-55"},
+        "headers": ctx.version_headers(f"/api/users/{ctx.seed['doctor_ids'][5]}"),
+    }),
+    RouteCase("DELETE", "/api/users/{user_id}", 4, lambda ctx: {
+        "url": f"/api/users/{ctx.new_user()}", "headers": ctx.admin,
+    }),
+    RouteCase("POST", "/api/users/{user_id}/restore", 4, lambda ctx: {
+        "url": f"/api/users/{ctx.new_user(deleted=True)}/restore", "headers": ctx.admin,
+    }),
+
+    # ----- Смены -----
+    RouteCase("POST", "/api/shifts/", 4, lambda ctx: {"url": "/api/shifts/", "json": shift_body(ctx)}),
+    RouteCase("POST", "/api/shifts/bulk", 13, lambda ctx: {
+        "url": "/api/shifts/bulk", "json": {"shifts": [shift_body(ctx, i) for i in range(1, 11)]},
+    }),
+    RouteCase("GET", "/api/shifts/", 2, lambda ctx: {
+        "url": f"/api/shifts/?from={ctx.seed['week_start']}&to={ctx.seed['week_end']}&order_by=start",
+    }),
+    RouteCase("GET", "/api/shifts/calendar", 3, lambda ctx: {
+        "url": f"/api/shifts/calendar?from={ctx.seed['week_start']}&to={ctx.seed['week_end']}&group_by=user",
+        "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/availability", 3, lambda ctx: {
+        "url": f"/api/availability?user_id={first(ctx.seed['doctor_ids'])}"
+               f"&from={ctx.seed['today']}&to={ctx.seed['week_end']}",
+        "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/shifts/{shift_id}", 1, lambda ctx: {"url": f"/api/shifts/{first(ctx.seed['shift_ids'])}"}),
+    RouteCase("PUT", "/api/shifts/{shift_id}", 4, lambda ctx: {
+        "url": f"/api/shifts/{ctx.new_shift()}", "json": shift_body(ctx),
+    }),
+    RouteCase("PATCH", "/api/shifts/{shift_id}", 2, lambda ctx: {
+        "url": f"/api/shifts/{ctx.seed['shift_ids'][-1]}", "json": {"notes": "Перенос по просьбе пациента"},
+        "headers": ctx.version_headers(f"/api/shifts/{ctx.seed['shift_ids'][-1]}", {}),
+    }),
+    RouteCase("DELETE", "/api/shifts/{shift_id}", 4, lambda ctx: {"url": f"/api/shifts/{ctx.new_shift()}"}),
+    RouteCase("POST", "/api/shifts/status", 2, lambda ctx: {
+        "url": "/api/shifts/status", "headers": ctx.admin,
+        "json": {"status": "cancelled", "ids": [ctx.new_shift() for _ in range(10)]},
+    }),
+
+    # ----- Пациенты -----
+    RouteCase("POST", "/api/patients/duplicates/check", 2, lambda ctx: {
+        "url": "/api/patients/duplicates/check", "headers": ctx.user, "json": patient_body("Иванов Пациент 1"),
+    }),
+    RouteCase("GET", "/api/patients/duplicates", 5, lambda ctx: {
+        "url": "/api/patients/duplicates", "headers": ctx.admin,
+    }),
+    RouteCase("POST", "/api/patients/import", 2, lambda ctx: {
+        "url": "/api/patients/import?format=csv&job_id=budget", "headers": ctx.admin, "content": import_body(),
+    }),
+    RouteCase("GET", "/api/patients/import/{job_id}", 1, lambda ctx: {
+        "url": "/api/patients/import/budget", "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/patients/import/{job_id}/errors", 1, lambda ctx: {
+        "url": "/api/patients/import/budget/errors", "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/patients/", 2, lambda ctx: {
+        "url": "/api/patients/?search=петров&fields=id,full_name", "headers": ctx.user,
+    }),
+    RouteCase("POST", "/api/patients/", 4, lambda ctx: {
+        "url": "/api/patients/", "headers": ctx.user, "json": patient_body(),
+    }),
+    RouteCase("GET", "/api/patients/{patient_id}", 2, lambda ctx: {
+        "url": f"/api/patients/{first(ctx.seed['patient_ids'])}", "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/patients/{patient_id}/timeline", 4, lambda ctx: {
+        "url": f"/api/patients/{first(ctx.seed['patient_ids'])}/timeline?limit=20", "headers": ctx.user,
+    }),
+    RouteCase("PUT", "/api/patients/{patient_id}", 4, lambda ctx: {
+        "url": f"/api/patients/{ctx.seed['patient_ids'][10]}", "headers": ctx.user,
+        "json": {**patient_body("Смирнов Пациент 10"), "notes": "аллергия на пенициллин"},
+    }),
+    RouteCase("PATCH", "/api/patients/{patient_id}", 4, lambda ctx: {
+        "url": f"/api/patients/{ctx.seed['patient_ids'][11]}", "json": {"phone": "+7 900 111-11-11"},
+        "headers": ctx.version_headers(f"/api/patients/{ctx.seed['patient_ids'][11]}", ctx.user),
+    }),
+    RouteCase("DELETE", "/api/patients/{patient_id}", 3, lambda ctx: {
+        "url": f"/api/patients/{ctx.new_patient()}", "headers": ctx.user,
+    }),
+    RouteCase("POST", "/api/patients/{patient_id}/restore", 4, lambda ctx: {
+        "url": f"/api/patients/{ctx.new_patient(deleted=True)}/restore", "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/dashboard/summary", 7, lambda ctx: {"url": "/api/dashboard/summary", "headers": ctx.user}),
+
+    # ----- Активы -----
+    RouteCase("POST", "/api/assets/", 3, lambda ctx: {
+        "url": "/api/assets/", "headers": ctx.user,
+        "json": {"title": "Новый кейс", "description": "Описание", "asset_type": "CASE", "status": "Active"},
+    }),
+    RouteCase("GET", "/api/assets/", 2, lambda ctx: {
+        "url": "/api/assets/?asset_type=CASE&status=Active", "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/assets/page", 3, lambda ctx: {
+        "url": "/api/assets/page?status=Active&limit=20", "headers": ctx.user,
+    }),
+    RouteCase("GET", "/api/assets/{asset_id}", 2, lambda ctx: {
+        "url": f"/api/assets/{first(ctx.seed['asset_ids'])}", "headers": ctx.user,
+    }),
+    RouteCase("PUT", "/api/assets/{asset_id}", 4, lambda ctx: {
+        "url": f"/api/assets/{ctx.new_asset()}", "headers": ctx.user, "json": {"status": "Completed"},
+    }),
+    RouteCase("DELETE", "/api/assets/{asset_id}", 3, lambda ctx: {
+        "url": f"/api/assets/{ctx.new_asset()}", "headers": ctx.user,
+    }),
+    RouteCase("POST", "/api/assets/{asset_id}/restore", 4, lambda ctx: {
+        "url": f"/api/assets/{ctx.new_asset(deleted=True)}/restore", "headers": ctx.admin,
+    }),
+
+    # ----- Передачи смен -----
+    RouteCase("POST", "/api/handovers/", 10, lambda ctx: {
+        "url": "/api/handovers/", "headers": ctx.user,
+        "json": {
+            "from_shift_id": ctx.seed["shift_ids"][0], "to_shift_id": ctx.seed["shift_ids"][1],
+            "handover_notes": "Передача дежурства", "asset_ids": ctx.seed["asset_ids"][:5],
+        },
+    }),
+    RouteCase("GET", "/api/handovers/", 3, lambda ctx: {"url": "/api/handovers/", "headers": ctx.user}),
+    RouteCase("GET", "/api/handovers/export", 4, lambda ctx: {"url": "/api/handovers/export?since=", "headers": ctx.user}),
+    RouteCase("DELETE", "/api/handovers/logs/{log_id}", 5, lambda ctx: {
+        "url": f"/api/handovers/logs/{ctx.new_handover_log()}", "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/handovers/{handover_id}", 3, lambda ctx: {
+        "url": f"/api/handovers/{first(ctx.seed['handover_ids'])}", "headers": ctx.user,
+    }),
+    RouteCase("PUT", "/api/handovers/{handover_id}", 8, lambda ctx: {
+        "url": f"/api/handovers/{ctx.seed['handover_ids'][1]}", "headers": ctx.user,
+        "json": {"handover_notes": "Уточнено", "asset_ids": ctx.seed["asset_ids"][5:10]},
+    }),
+    RouteCase("PATCH", "/api/handovers/{handover_id}", 6, lambda ctx: {
+        "url": f"/api/handovers/{ctx.seed['handover_ids'][2]}",
+        "json": {"handover_notes": "Дополнено", "asset_ids": ctx.seed["asset_ids"][10:14]},
+        "headers": ctx.version_headers(f"/api/handovers/{ctx.seed['handover_ids'][2]}", ctx.user),
+    }),
+
+    # ----- Пакеты, аудит, обслуживание -----
+    RouteCase("POST", "/api/batch", 13, lambda ctx: {
+        "url": "/api/batch", "headers": ctx.user,
+        "json": {"requests": [
+            {"method": "GET", "path": f"/api/patients/{pid}"} for pid in ctx.seed["patient_ids"][:5]
+        ] + [{"method": "GET", "path": "/api/dashboard/summary"}]},
+    }),
+    RouteCase("GET", "/api/audit", 2, audit_request),
+    RouteCase("POST", "/api/admin/archive", 9, lambda ctx: {"url": "/api/admin/archive", "headers": ctx.admin}),
+    RouteCase("POST", "/api/admin/purge-deleted", 4, lambda ctx: {
+        "url": "/api/admin/purge-deleted", "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/admin/reminders", 2, lambda ctx: {"url": "/api/admin/reminders", "headers": ctx.admin}),
+    RouteCase("POST", "/api/admin/reminders/run", 3, lambda ctx: {
+        "url": "/api/admin/reminders/run", "headers": ctx.admin,
+    }),
+    RouteCase("POST", "/api/admin/backup", 1, lambda ctx: {"url": "/api/admin/backup", "headers": ctx.admin}),
+    RouteCase("GET", "/api/admin/backups", 1, lambda ctx: {"url": "/api/admin/backups", "headers": ctx.admin}),
+    RouteCase("GET", "/api/admin/profiles", 1, lambda ctx: {"url": "/api/admin/profiles", "headers": ctx.admin}),
+    RouteCase("GET", "/api/admin/profiles/{profile_id}", 1, lambda ctx: {
+        "url": f"/api/admin/profiles/{ctx.client.get('/api/me', headers={**ctx.admin, 'X-Profile': '1'}).headers['X-Profile-Id']}",
+        "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/admin/profiles/{profile_id}/folded", 1, lambda ctx: {
+        "url": f"/api/admin/profiles/{ctx.client.get('/api/me', headers={**ctx.admin, 'X-Profile': '1'}).headers['X-Profile-Id']}/folded",
+        "headers": ctx.admin,
+    }),
+    RouteCase("GET", "/api/admin/cache", 1, lambda ctx: {"url": "/api/admin/cache", "headers": ctx.admin}),
+
+    # Последним: очищает все передачи, after заполняет их снова
+    RouteCase("DELETE", "/api/handovers/clear", 9, lambda ctx: {
+        "url": "/api/handovers/clear", "headers": ctx.admin,
+    }, after=reseed_handovers),
+]
+
+
+def case_id(case):
+    return f"{case.method} {case.route}"
+
+
+@pytest.fixture
+def ctx(client, admin_headers, user_headers, seed):
+    return Context(client, admin_headers, user_headers, seed)
+
+
+def test_every_route_has_budget():
+    routes = {
+        (method, route.path)
+        for route in main.app.routes if isinstance(route, APIRoute)
+        for method in route.methods if method != "HEAD"
+    }
+    covered = {(case.method, case.route) for case in ROUTE_CASES}
+    assert routes - covered == set(), "routes without a statement budget"
+    assert covered - routes == set(), "budgets for routes that no longer exist"
+
+
+@pytest.mark.parametrize("case", ROUTE_CASES, ids=case_id)
+def test_statement_budget(case, ctx, sql_log):
+    kwargs = case.prepare(ctx)
+    try:
+        with sql_log() as statements:
+            response = ctx.client.request(case.method, **kwargs)
+    finally:
+        if case.after:
+            case.after(ctx)
+
+    assert response.status_code < 400, response.text
+    listing = "\n".join(f"{i + 1}. {sql} {params}" for i, (sql, params) in enumerate(statements))
+    assert len(statements) <= case.budget, (
+        f"{case_id(case)}: {len(statements)} SQL statements, budget {case.budget}\n{listing}"
+    )
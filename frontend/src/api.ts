@@ -2,8 +2,14 @@ import axios from 'axios';
 import {
   User,
   Shift,
+  ShiftCalendar,
+  ShiftFilters,
+  ShiftPatch,
   Handover,
   Asset,
+  AssetPage,
+  BatchItem,
+  BatchResult,
   CreateUser,
   CreateShift,
   CreateHandover,
@@ -13,8 +19,10 @@ import {
   Patient,
   CreatePatient,
   UpdatePatient,
+  PatientPatch,
   DashboardSummary,
 } from './types.ts';
+import { authService } from './services/auth.ts';
 
 const API_BASE_URL = 'http://localhost:8000';
 
@@ -34,11 +42,44 @@ api.interceptors.request.use((config) => {
   return config;
 });
 
-// Response interceptor to handle auth errors
+// Idempotency-Key for writes that must not run twice: one key per logical request,
+// reused by every retry of it, so the server replays the stored response instead of writing again
+const newIdempotencyKey = (): string =>
+  typeof crypto !== 'undefined' && 'randomUUID' in crypto
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
+const idempotent = () => ({ headers: { 'Idempotency-Key': newIdempotencyKey() } });
+
+// PATCH sends only changed fields and the row version it was based on;
+// 412 means someone else changed the row in the meantime
+const ifMatch = (version: number) => ({ headers: { 'If-Match': `"${version}"` } });
+
+const MAX_NETWORK_RETRIES = 2;
+
+// Response interceptor to handle auth errors:
+// on 401 try to renew the access token once, otherwise log out.
+// Idempotent writes are retried on network errors (no response) with the same key.
 api.interceptors.response.use(
   (response) => response,
-  (error) => {
+  async (error) => {
+    const original = error.config;
+    if (!error.response && original?.headers?.['Idempotency-Key']) {
+      original._networkRetries = (original._networkRetries || 0) + 1;
+      if (original._networkRetries <= MAX_NETWORK_RETRIES) {
+        await new Promise(resolve => setTimeout(resolve, 500 * original._networkRetries));
+        return api(original);
+      }
+    }
     if (error.response?.status === 401) {
+      if (original && !original._retried) {
+        original._retried = true;
+        const renewed = await authService.refresh();
+        if (renewed) {
+          original.headers.Authorization = `Bearer ${renewed.access_token}`;
+          return api(original);
+        }
+      }
       localStorage.removeItem('access_token');
       window.location.reload();
     }
@@ -65,16 +106,19 @@ export const profileApi = {
 
 // Shifts API
 export const shiftsApi = {
-  getAll: (date?: string): Promise<Shift[]> => {
-    const params = date ? { date } : {};
-    return api.get('/api/shifts/', { params }).then(res => res.data);
-  },
+  getAll: (params?: ShiftFilters): Promise<Shift[]> =>
+    api.get('/api/shifts/', { params }).then(res => res.data),
+  getCalendar: (from: string, to: string, groupBy: ShiftCalendar['group_by'] = 'day'): Promise<ShiftCalendar> =>
+    api.get('/api/shifts/calendar', { params: { from, to, group_by: groupBy } }).then(res => res.data),
   getById: (id: number): Promise<Shift> => api.get(`/api/shifts/${id}`).then(res => res.data),
-  create: (shift: CreateShift): Promise<Shift> => api.post('/api/shifts/', shift).then(res => res.data),
+  create: (shift: CreateShift): Promise<Shift> =>
+    api.post('/api/shifts/', shift, idempotent()).then(res => res.data),
   createMultiple: (shifts: CreateShift[]): Promise<Shift[]> => 
-    api.post('/api/shifts/bulk', { shifts }).then(res => res.data),
+    api.post('/api/shifts/bulk', { shifts }, idempotent()).then(res => res.data),
   update: (id: number, shift: CreateShift): Promise<Shift> => 
     api.put(`/api/shifts/${id}`, shift).then(res => res.data),
+  patch: (id: number, changes: ShiftPatch, version: number): Promise<Shift> =>
+    api.patch(`/api/shifts/${id}`, changes, ifMatch(version)).then(res => res.data),
   delete: (id: number): Promise<void> => api.delete(`/api/shifts/${id}`).then(() => {}),
 };
 
@@ -84,6 +128,10 @@ export const assetsApi = {
     const url = params ? `/api/assets/?${params}` : '/api/assets/';
     return api.get(url).then(res => res.data);
   },
+  getPage: (params?: string): Promise<AssetPage> => {
+    const url = params ? `/api/assets/page?${params}` : '/api/assets/page';
+    return api.get(url).then(res => res.data);
+  },
   getById: (id: number): Promise<Asset> => api.get(`/api/assets/${id}`).then(res => res.data),
   create: (asset: CreateAsset): Promise<Asset> => api.post('/api/assets/', asset).then(res => res.data),
   update: (id: number, asset: UpdateAsset): Promise<Asset> => 
@@ -96,7 +144,7 @@ export const handoversApi = {
   getAll: (): Promise<Handover[]> => api.get('/api/handovers/').then(res => res.data),
   getById: (id: number): Promise<Handover> => api.get(`/api/handovers/${id}`).then(res => res.data),
   create: (handover: CreateHandover): Promise<Handover> => 
-    api.post('/api/handovers/', handover).then(res => res.data),
+    api.post('/api/handovers/', handover, idempotent()).then(res => res.data),
   update: (id: number, handover: CreateHandover): Promise<Handover> => 
     api.put(`/api/handovers/${id}`, handover).then(res => res.data),
   delete: (id: number): Promise<void> => api.delete(`/api/handovers/${id}`).then(() => {}),
@@ -112,9 +160,12 @@ export const patientsApi = {
     return api.get('/api/patients/', params).then(res => res.data);
   },
   getById: (id: number): Promise<Patient> => api.get(`/api/patients/${id}`).then(res => res.data),
-  create: (patient: CreatePatient): Promise<Patient> => api.post('/api/patients/', patient).then(res => res.data),
+  create: (patient: CreatePatient, allowDuplicate = false): Promise<Patient> =>
+    api.post('/api/patients/', patient, { params: allowDuplicate ? { allow_duplicate: true } : {} }).then(res => res.data),
   update: (id: number, patient: UpdatePatient): Promise<Patient> =>
     api.put(`/api/patients/${id}`, patient).then(res => res.data),
+  patch: (id: number, changes: PatientPatch, version: number): Promise<Patient> =>
+    api.patch(`/api/patients/${id}`, changes, ifMatch(version)).then(res => res.data),
   delete: (id: number): Promise<void> => api.delete(`/api/patients/${id}`).then(() => {}),
 };
 
@@ -123,4 +174,19 @@ export const dashboardApi = {
   getSummary: (): Promise<DashboardSummary> => api.get('/api/dashboard/summary').then(res => res.data),
 };
 
+// Batch API: several requests in one round trip (one auth check, one DB session on the server)
+export const batchApi = {
+  run: (requests: BatchItem[]): Promise<BatchResult[]> =>
+    api.post('/api/batch', { requests }).then(res => res.data.results),
+  // GET several paths at once; rejects if any of them failed
+  getAll: async (paths: string[]): Promise<any[]> => {
+    const results = await batchApi.run(paths.map(path => ({ path })));
+    const failed = results.find(result => result.status >= 400);
+    if (failed) {
+      throw new Error(`Batch request failed with status ${failed.status}`);
+    }
+    return results.map(result => result.body);
+  },
+};
+
 export default api;
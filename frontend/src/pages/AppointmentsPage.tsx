@@ -1,10 +1,18 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import { Plus, ChevronLeft, ChevronRight, Edit, Trash2, Stethoscope } from 'lucide-react';
 import { shiftsApi, usersApi, patientsApi } from '../api.ts';
-import { Shift, User, CreateShift, Patient } from '../types';
+import { Shift, User, CreateShift, Patient, ShiftCalendar, ShiftPatch } from '../types';
 import { useForm } from 'react-hook-form';
 import toast from 'react-hot-toast';
 
+// Границы месяца (YYYY-MM-DD)
+const getMonthRange = (monthDate: Date) => {
+  const year = monthDate.getFullYear();
+  const month = String(monthDate.getMonth() + 1).padStart(2, '0');
+  const lastDay = new Date(year, monthDate.getMonth() + 1, 0).getDate();
+  return { from: `${year}-${month}-01`, to: `${year}-${month}-${lastDay}` };
+};
+
 const AppointmentsPage: React.FC = () => {
   const [shifts, setShifts] = useState<Shift[]>([]);
   const [users, setUsers] = useState<User[]>([]);
@@ -14,6 +22,7 @@ const AppointmentsPage: React.FC = () => {
   const [editingShift, setEditingShift] = useState<Shift | null>(null);
   const [currentMonth, setCurrentMonth] = useState(new Date());
   const [selectedUsers, setSelectedUsers] = useState<number[]>([]);
+  const [calendar, setCalendar] = useState<ShiftCalendar | null>(null);
   const [isMultipleMode, setIsMultipleMode] = useState(false);
 
   const { register, handleSubmit, reset, watch, setValue, formState: { errors } } = useForm<CreateShift>();
@@ -51,15 +60,35 @@ const AppointmentsPage: React.FC = () => {
     dot: 'bg-slate-500',
   };
 
+  // Смены только за отображаемый месяц, уже отсортированные сервером по дате и времени начала,
+  // и итоги месяца (приёмы и часы по дням), которые сервер считает одним GROUP BY.
+  // Загружаются вместе: и при смене месяца, и после изменений — по одному запросу каждого
+  const loadShifts = useCallback(async () => {
+    const { from, to } = getMonthRange(currentMonth);
+    const [shiftsResult, calendarResult] = await Promise.allSettled([
+      shiftsApi.getAll({ from, to, order_by: 'start' }),
+      shiftsApi.getCalendar(from, to),
+    ]);
+    if (shiftsResult.status === 'fulfilled') {
+      setShifts(shiftsResult.value);
+    } else {
+      console.error('Error loading shifts:', shiftsResult.reason);
+      toast.error('Ошибка загрузки расписания');
+    }
+    if (calendarResult.status === 'fulfilled') {
+      setCalendar(calendarResult.value);
+    } else {
+      console.error('Error loading calendar summary:', calendarResult.reason);
+    }
+  }, [currentMonth]);
+
   const loadData = useCallback(async () => {
     try {
       setLoading(true);
-      const [shiftsData, usersData, patientsData] = await Promise.all([
-        shiftsApi.getAll(),
+      const [usersData, patientsData] = await Promise.all([
         usersApi.getAllPublic(),
         patientsApi.getAll()
       ]);
-      setShifts(shiftsData);
       setUsers(usersData);
       setPatients(patientsData);
     } catch (error) {
@@ -74,6 +103,10 @@ const AppointmentsPage: React.FC = () => {
     loadData();
   }, [loadData]);
 
+  useEffect(() => {
+    loadShifts();
+  }, [loadShifts]);
+
   // Принудительный ререндер при изменении месяца
   useEffect(() => {
     // Заставляем React полностью перерисовать календарь
@@ -163,6 +196,12 @@ const AppointmentsPage: React.FC = () => {
     return shifts.filter(shift => shift.date === dateStr);
   };
 
+  // Итоги дня из серверной сводки
+  const getDaySummary = (day: number) => {
+    const dateStr = `${currentMonth.getFullYear()}-${String(currentMonth.getMonth() + 1).padStart(2, '0')}-${String(day).padStart(2, '0')}`;
+    return calendar?.buckets.find(bucket => bucket.key === dateStr);
+  };
+
   // Открытие модального окна создания смены
   const openCreateModal = (day?: number) => {
     setEditingShift(null);
@@ -214,7 +253,7 @@ const AppointmentsPage: React.FC = () => {
     const normalizedType = appointmentTypes[shift.shift_type] ? shift.shift_type : 'consultation';
     reset({
       date: shift.date,
-      user_id: shift.user_id,
+      user_id: shift.user_id ?? 0,
       start_time: shift.start_time,
       end_time: shift.end_time,
       shift_type: normalizedType,
@@ -233,7 +272,15 @@ const AppointmentsPage: React.FC = () => {
       };
 
       if (editingShift) {
-        await shiftsApi.update(editingShift.id, payload);
+        // Отправляем только изменённые поля и версию, с которой начинали редактирование
+        const changes: Record<string, unknown> = {};
+        (Object.keys(payload) as (keyof CreateShift)[]).forEach(key => {
+          const value = payload[key] ?? null;
+          if (value !== (editingShift[key] ?? null)) {
+            changes[key] = value;
+          }
+        });
+        await shiftsApi.patch(editingShift.id, changes as ShiftPatch, editingShift.version);
         toast.success('Приём обновлён');
       } else if (isMultipleMode && selectedUsers.length > 0) {
         const shiftsToCreate = selectedUsers.map(userId => ({
@@ -251,8 +298,15 @@ const AppointmentsPage: React.FC = () => {
       setEditingShift(null);
       setSelectedUsers([]);
       reset();
-      loadData();
-    } catch (error) {
+      loadShifts();
+    } catch (error: any) {
+      if (error?.response?.status === 412) {
+        toast.error('Приём уже изменил другой сотрудник — расписание обновлено, проверьте данные');
+        setShowModal(false);
+        setEditingShift(null);
+        loadShifts();
+        return;
+      }
       console.error('Error creating/updating shift:', error);
       toast.error('Ошибка при сохранении смены');
     }
@@ -267,7 +321,7 @@ const AppointmentsPage: React.FC = () => {
     try {
       await shiftsApi.delete(shiftId);
       toast.success('Приём удалён');
-      loadData();
+      loadShifts();
     } catch (error) {
       console.error('Error deleting shift:', error);
       toast.error('Ошибка при удалении смены');
@@ -345,9 +399,16 @@ const AppointmentsPage: React.FC = () => {
         >
           <ChevronLeft size={20} />
         </button>
-        <h2 className="text-xl font-semibold">
-          {monthNames[currentMonth.getMonth()]} {currentMonth.getFullYear()}
-        </h2>
+        <div className="text-center">
+          <h2 className="text-xl font-semibold">
+            {monthNames[currentMonth.getMonth()]} {currentMonth.getFullYear()}
+          </h2>
+          {calendar && (
+            <p className="text-sm text-gray-500">
+              Приёмов: {calendar.total_count} · {calendar.total_hours} ч
+            </p>
+          )}
+        </div>
         <button
           onClick={() => changeMonth(1)}
           className="p-2 hover:bg-gray-100 rounded-lg"
@@ -375,6 +436,7 @@ const AppointmentsPage: React.FC = () => {
             }
 
             const dayShifts = getShiftsForDay(day);
+            const daySummary = getDaySummary(day);
             const isToday = new Date().toDateString() === new Date(currentMonth.getFullYear(), currentMonth.getMonth(), day).toDateString();
 
             return (
@@ -387,6 +449,11 @@ const AppointmentsPage: React.FC = () => {
                 <div className="flex justify-between items-start mb-2">
                   <span className={`text-sm font-medium ${isToday ? 'text-primary-700' : 'text-gray-900'}`}>
                     {day}
+                    {daySummary && (
+                      <span className="ml-1 text-[11px] font-normal text-gray-500" title={`Отменено: ${daySummary.cancelled}`}>
+                        {daySummary.count} · {daySummary.hours} ч
+                      </span>
+                    )}
                   </span>
                   <button
                     onClick={() => openCreateModal(day)}
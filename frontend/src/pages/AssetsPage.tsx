@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import { Plus, Edit, Trash2, Filter, Maximize2, X } from 'lucide-react';
 import { assetsApi } from '../api.ts';
-import { Asset, CreateAsset } from '../types';
+import { Asset, AssetPage, CreateAsset } from '../types';
 
 export default function AssetsPage() {
   const formatMoscow = (iso: string) => {
@@ -9,6 +9,9 @@ export default function AssetsPage() {
     return new Date(normalized).toLocaleString('ru-RU', { timeZone: 'Europe/Moscow' });
   };
   const [assets, setAssets] = useState<Asset[]>([]);
+  const [total, setTotal] = useState(0);
+  const [facets, setFacets] = useState<AssetPage['facets']>({ asset_type: {}, status: {} });
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [showCreateModal, setShowCreateModal] = useState(false);
   const [showEditModal, setShowEditModal] = useState(false);
   const [editingAsset, setEditingAsset] = useState<Asset | null>(null);
@@ -24,16 +27,21 @@ export default function AssetsPage() {
     status: 'Active'
   });
 
-  const loadAssets = useCallback(async () => {
+  const loadAssets = useCallback(async (cursor?: string) => {
     try {
       setLoading(true);
       const params = new URLSearchParams();
       if (filterType) params.append('asset_type', filterType);
       if (filterStatus) params.append('status', filterStatus);
       if (searchQuery) params.append('search', searchQuery);
+      if (cursor) params.append('cursor', cursor);
       
-      const data = await assetsApi.getAll(params.toString());
-      setAssets(data);
+      // Страница кейсов и счётчики для фильтров приходят одним ответом
+      const page = await assetsApi.getPage(params.toString());
+      setAssets(prev => (cursor ? [...prev, ...page.items] : page.items));
+      setTotal(page.total);
+      setFacets(page.facets);
+      setNextCursor(page.next_cursor ?? null);
     } catch (error) {
       console.error('Ошибка загрузки кейсов:', error);
     } finally {
@@ -136,6 +144,8 @@ export default function AssetsPage() {
     }
   };
 
+  const withCount = (label: string, count?: number) => `${label} (${count ?? 0})`;
+
   return (
     <div className="p-6">
       <div className="flex justify-between items-center mb-6">
@@ -156,7 +166,7 @@ export default function AssetsPage() {
           <div className="flex-1 max-w-md relative">
             <input
               type="text"
-              placeholder="Поиск по названию кейса..."
+              placeholder="Поиск по названию и описанию кейса..."
               value={searchQuery}
               onChange={(e) => setSearchQuery(e.target.value)}
               className="w-full border rounded-lg px-3 py-2 pl-10 focus:ring-2 focus:ring-blue-500 focus:border-blue-500"
@@ -178,10 +188,10 @@ export default function AssetsPage() {
             className="border rounded-lg px-3 py-2"
           >
             <option value="">Все типы</option>
-            <option value="CASE">Клинический случай</option>
-            <option value="CHANGE_MANAGEMENT">Изменения плана лечения</option>
-            <option value="ORANGE_CASE">Экстренный кейс</option>
-            <option value="CLIENT_REQUESTS">Обращения пациентов</option>
+            <option value="CASE">{withCount('Клинический случай', facets.asset_type['CASE'])}</option>
+            <option value="CHANGE_MANAGEMENT">{withCount('Изменения плана лечения', facets.asset_type['CHANGE_MANAGEMENT'])}</option>
+            <option value="ORANGE_CASE">{withCount('Экстренный кейс', facets.asset_type['ORANGE_CASE'])}</option>
+            <option value="CLIENT_REQUESTS">{withCount('Обращения пациентов', facets.asset_type['CLIENT_REQUESTS'])}</option>
           </select>
           <select
             value={filterStatus}
@@ -189,10 +199,11 @@ export default function AssetsPage() {
             className="border rounded-lg px-3 py-2"
           >
             <option value="">Все статусы</option>
-            <option value="Active">В работе</option>
-            <option value="Completed">Завершён</option>
-            <option value="On Hold">Приостановлен</option>
+            <option value="Active">{withCount('В работе', facets.status['Active'])}</option>
+            <option value="Completed">{withCount('Завершён', facets.status['Completed'])}</option>
+            <option value="On Hold">{withCount('Приостановлен', facets.status['On Hold'])}</option>
           </select>
+          <span className="text-sm text-gray-500">Найдено: {total}</span>
         </div>
       </div>
 
@@ -260,6 +271,17 @@ export default function AssetsPage() {
         </div>
       )}
 
+      {!loading && nextCursor && (
+        <div className="text-center mt-4">
+          <button
+            onClick={() => loadAssets(nextCursor)}
+            className="border rounded-lg px-4 py-2 text-gray-700 hover:bg-gray-50"
+          >
+            Показать ещё
+          </button>
+        </div>
+      )}
+
       {/* Модальное окно создания */}
       {showCreateModal && (
         <div className="fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50 modal-overlay">
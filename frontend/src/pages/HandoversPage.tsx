@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import { Plus, Download, Trash2, Maximize2, X } from 'lucide-react';
-import { handoversApi, shiftsApi, assetsApi } from '../api.ts';
+import { handoversApi, batchApi } from '../api.ts';
 import { Handover, Shift, Asset, CreateHandover } from '../types';
 import { useForm } from 'react-hook-form';
 import toast from 'react-hot-toast';
@@ -106,10 +106,10 @@ const HandoversPage: React.FC = () => {
   const loadData = async () => {
     try {
       setLoading(true);
-      const [handoversData, shiftsData, assetsData] = await Promise.all([
-        handoversApi.getAll(),
-        shiftsApi.getAll(),
-        assetsApi.getAll()
+      const [handoversData, shiftsData, assetsData] = await batchApi.getAll([
+        '/api/handovers/',
+        '/api/shifts/',
+        '/api/assets/',
       ]);
       setHandovers(handoversData);
       setShifts(shiftsData);
@@ -71,7 +71,6 @@ const PatientsPage: React.FC = () => {
       chronic_conditions: '',
       medications: '',
       attending_physician: '',
-      last_visit: '',
       notes: '',
     });
     setIsModalOpen(true);
@@ -93,7 +92,6 @@ const PatientsPage: React.FC = () => {
       chronic_conditions: patient.chronic_conditions || '',
       medications: patient.medications || '',
       attending_physician: patient.attending_physician || '',
-      last_visit: patient.last_visit ? patient.last_visit.substring(0, 10) : '',
       notes: patient.notes || '',
     });
     setIsModalOpen(true);
@@ -105,7 +103,20 @@ const PatientsPage: React.FC = () => {
         await patientsApi.update(selectedPatient.id, data);
         toast.success('Карточка обновлена');
       } else {
-        await patientsApi.create(data);
+        try {
+          await patientsApi.create(data);
+        } catch (error: any) {
+          // Сервер нашёл похожую карточку — создаём только после подтверждения
+          const candidates = error?.response?.status === 409 ? error.response.data?.detail?.candidates : null;
+          if (!candidates) {
+            throw error;
+          }
+          const names = candidates.map((c: any) => `${c.full_name}${c.birth_date ? ` (${c.birth_date})` : ''}`).join(', ');
+          if (!window.confirm(`Похожие пациенты уже есть: ${names}. Всё равно создать карточку?`)) {
+            return;
+          }
+          await patientsApi.create(data, true);
+        }
         toast.success('Карточка пациента создана');
       }
       setIsModalOpen(false);
@@ -365,10 +376,6 @@ const PatientsPage: React.FC = () => {
                   <label className="form-label">Группа крови</label>
                   <input className="form-input" {...register('blood_type')} placeholder="A (II) Rh+" />
                 </div>
-                <div>
-                  <label className="form-label">Дата последнего визита</label>
-                  <input type="date" className="form-input" {...register('last_visit')} />
-                </div>
                 <div className="sm:col-span-2">
                   <label className="form-label">Адрес</label>
                   <input className="form-input" {...register('address')} />
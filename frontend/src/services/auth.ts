@@ -2,6 +2,11 @@ import { LoginUser, AuthToken, User, CreateUser } from '../types';
 
 const API_BASE_URL = 'http://localhost:8000';
 const TOKEN_KEY = 'access_token';
+const REFRESH_TOKEN_KEY = 'refresh_token';
+
+// Refresh in progress: parallel 401s share it instead of each spending the same
+// (single-use) refresh token, which the server would treat as token reuse
+let refreshInFlight: Promise<AuthToken | null> | null = null;
 
 export const authService = {
   async login(credentials: LoginUser): Promise<AuthToken> {
@@ -18,7 +23,49 @@ export const authService = {
     }
 
     const data = await response.json();
+    this.storeTokens(data);
+    return data;
+  },
+
+  storeTokens(data: AuthToken): void {
     localStorage.setItem(TOKEN_KEY, data.access_token);
+    if (data.refresh_token) {
+      localStorage.setItem(REFRESH_TOKEN_KEY, data.refresh_token);
+    }
+  },
+
+  // Renew the access token with the stored refresh token (no password needed).
+  // Concurrent callers get the same in-flight request
+  refresh(): Promise<AuthToken | null> {
+    if (!refreshInFlight) {
+      refreshInFlight = this.requestRefresh().finally(() => {
+        refreshInFlight = null;
+      });
+    }
+    return refreshInFlight;
+  },
+
+  async requestRefresh(): Promise<AuthToken | null> {
+    const refreshToken = localStorage.getItem(REFRESH_TOKEN_KEY);
+    if (!refreshToken) {
+      return null;
+    }
+
+    const response = await fetch(`${API_BASE_URL}/api/token/refresh`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ refresh_token: refreshToken }),
+    });
+
+    if (!response.ok) {
+      localStorage.removeItem(REFRESH_TOKEN_KEY);
+      return null;
+    }
+
+    const data = await response.json();
+    this.storeTokens(data);
     return data;
   },
 
@@ -40,7 +87,18 @@ export const authService = {
   },
 
   logout(): void {
+    const refreshToken = localStorage.getItem(REFRESH_TOKEN_KEY);
+    if (refreshToken) {
+      fetch(`${API_BASE_URL}/api/logout`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ refresh_token: refreshToken }),
+      }).catch(() => {});
+    }
     localStorage.removeItem(TOKEN_KEY);
+    localStorage.removeItem(REFRESH_TOKEN_KEY);
   },
 
   getToken(): string | null {
@@ -9,6 +9,7 @@ export interface User {
   is_active: boolean;
   is_admin: boolean;
   created_at: string;
+  version: number;
 }
 
 export interface Shift {
@@ -17,7 +18,7 @@ export interface Shift {
   start_time: string;
   end_time: string;
   shift_type: string;
-  user_id: number;
+  user_id: number | null; // null — учётная запись врача удалена окончательно
   user_name: string;
   position: string;
   patient_id?: number;
@@ -26,6 +27,53 @@ export interface Shift {
   notes?: string;
   created_at: string;
   updated_at: string;
+  version: number;
+}
+
+export type ShiftPatch = Partial<Omit<CreateShift, 'patient_id'>> & {
+  patient_id?: number | null;
+  status?: 'scheduled' | 'completed' | 'cancelled';
+};
+
+export interface BatchItem {
+  id?: string;
+  method?: 'GET' | 'POST' | 'PUT' | 'PATCH' | 'DELETE';
+  path: string;
+  body?: unknown;
+  headers?: Record<string, string>;
+}
+
+export interface BatchResult {
+  id?: string;
+  status: number;
+  headers: Record<string, string>;
+  body: any;
+}
+
+export interface ShiftFilters {
+  date?: string;
+  from?: string;
+  to?: string;
+  user_id?: number;
+  patient_id?: number;
+  status?: string;
+  shift_type?: string;
+  order_by?: 'created' | 'start';
+}
+
+export interface ShiftCalendarBucket {
+  key: string;
+  label?: string | null;
+  count: number;
+  cancelled: number;
+  hours: number;
+}
+
+export interface ShiftCalendar {
+  group_by: 'day' | 'user' | 'shift_type';
+  buckets: ShiftCalendarBucket[];
+  total_count: number;
+  total_hours: number;
 }
 
 export interface Asset {
@@ -35,7 +83,17 @@ export interface Asset {
   asset_type: 'CASE' | 'CHANGE_MANAGEMENT' | 'ORANGE_CASE' | 'CLIENT_REQUESTS';
   status: 'Active' | 'Completed' | 'On Hold';
   created_at: string;
-  updated_at: string;
+  updated_at: string | null;
+}
+
+export interface AssetPage {
+  items: Asset[];
+  total: number;
+  facets: {
+    asset_type: Record<string, number>;
+    status: Record<string, number>;
+  };
+  next_cursor?: string | null;
 }
 
 export interface CreateAsset {
@@ -59,6 +117,7 @@ export interface Handover {
   handover_notes: string;
   assets: Asset[];
   created_at: string;
+  version: number;
 }
 
 export interface CreateUser {
@@ -88,6 +147,7 @@ export interface LoginUser {
 export interface AuthToken {
   access_token: string;
   token_type: string;
+  refresh_token?: string;
 }
 
 export interface CreateShift {
@@ -125,6 +185,7 @@ export interface Patient {
   notes?: string;
   created_at: string;
   updated_at: string;
+  version: number;
 }
 
 export interface CreatePatient {
@@ -144,7 +205,10 @@ export interface CreatePatient {
   notes?: string;
 }
 
-export interface UpdatePatient extends Partial<CreatePatient> {}
+// last_visit ведёт сервер по завершённым приёмам — PUT и PATCH его не принимают
+export type UpdatePatient = Partial<Omit<CreatePatient, 'last_visit'>>;
+
+export type PatientPatch = UpdatePatient;
 
 export interface DashboardSummary {
   total_patients: number;
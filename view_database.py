@@ -1,131 +1,276 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Скрипт для просмотра содержимого базы данных clinic.db
-Используйте: python view_database.py
+Инспекция базы данных clinic.db для администратора.
+
+База открывается строго только для чтения (URI mode=ro), тяжёлых COUNT(*) нет:
+количество строк берётся из статистики sqlite_stat1 (её собирает ANALYZE),
+а выгрузка таблиц идёт короткими пачками по rowid, поэтому скрипт можно
+запускать на живой базе, не мешая серверу.
+
+Используйте:
+    python view_database.py                          # сводка по таблицам
+    python view_database.py sizes                    # размер таблиц и индексов (dbstat) и фрагментация
+    python view_database.py recent shifts -n 5       # последние записи таблицы
+    python view_database.py dump patients --format jsonl -o patients.jsonl
 """
 
-import sqlite3
+import argparse
+import csv
+import json
 import os
+import sqlite3
+import sys
 from datetime import datetime
 
-def connect_to_db():
-    """Подключение к базе данных"""
-    db_path = "backend/data/clinic.db"
+DEFAULT_DB_PATH = "backend/data/clinic.db"
+
+
+def connect_to_db(db_path):
+    """Подключение к базе данных только для чтения"""
     if not os.path.exists(db_path):
-        print(f"❌ Файл базы данных не найден: {db_path}")
+        print(f"❌ Файл базы данных не найден: {db_path}", file=sys.stderr)
         return None
-    
+
     try:
-        conn = sqlite3.connect(db_path)
-        print(f"✅ Подключение к базе данных: {db_path}")
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        # Даже случайная запись из этого соединения будет отклонена
+        conn.execute("PRAGMA query_only = 1")
         return conn
     except Exception as e:
-        print(f"❌ Ошибка подключения к базе: {e}")
+        print(f"❌ Ошибка подключения к базе: {e}", file=sys.stderr)
         return None
 
-def show_tables(conn):
-    """Показать список всех таблиц"""
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
+
+def format_size(size):
+    """Человекочитаемый размер"""
+    if size < 1024:
+        return f"{size} байт"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    return f"{size / (1024 * 1024):.1f} МБ"
+
+
+def quote_identifier(name):
+    """Экранирование имени таблицы для подстановки в SQL"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_tables(conn):
+    """Список пользовательских таблиц"""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )
+    return [row[0] for row in rows]
+
+
+def get_columns(conn, table_name):
+    """Колонки таблицы"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(table_name)})")]
+
+
+def get_row_estimates(conn):
+    """
+    Оценка количества строк по sqlite_stat1 (первое число в stat — строк в таблице/индексе).
+    Если ANALYZE ещё не запускался, статистики нет и оценка неизвестна.
+    """
+    estimates = {}
+    try:
+        rows = conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1")
+    except sqlite3.OperationalError:
+        return estimates
+    for table_name, index_name, stat in rows:
+        if not stat:
+            continue
+        count = int(stat.split()[0])
+        estimates[table_name] = max(estimates.get(table_name, 0), count)
+        if index_name:
+            estimates[index_name] = count
+    return estimates
+
+
+def get_page_stats(conn):
+    """Размер страницы, число страниц и свободных (неиспользуемых) страниц файла"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size, page_count, freelist_count
+
+
+def show_summary(conn, db_path):
+    """Сводка: файл, страницы, таблицы с оценкой числа строк"""
+    page_size, page_count, freelist_count = get_page_stats(conn)
+    print("🗄️  ПРОСМОТР БАЗЫ ДАННЫХ РЕГИСТРАТУРЫ КЛИНИКИ")
+    print("=" * 50)
+    print(f"📁 Файл: {db_path} ({format_size(os.path.getsize(db_path))})")
+    print(f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"📄 Страниц: {page_count} по {page_size} байт, свободных: {freelist_count}"
+          f" ({freelist_count * 100 / max(page_count, 1):.1f}%)")
+
+    estimates = get_row_estimates(conn)
     print("\n📋 Таблицы в базе данных:")
-    for table in tables:
-        print(f"  - {table[0]}")
-    
-    return [table[0] for table in tables]
-
-def show_table_info(conn, table_name):
-    """Показать информацию о таблице"""
-    cursor = conn.cursor()
-    
-    # Получаем количество записей
-    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-    count = cursor.fetchone()[0]
-    
-    # Получаем структуру таблицы
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = cursor.fetchall()
-    
-    print(f"\n📊 Таблица '{table_name}' ({count} записей):")
-    print("   Колонки:")
-    for col in columns:
-        print(f"     - {col[1]} ({col[2]})")
-    
+    for table_name in get_tables(conn):
+        estimate = estimates.get(table_name)
+        rows = f"~{estimate} записей" if estimate is not None else "нет статистики"
+        columns = ", ".join(get_columns(conn, table_name))
+        print(f"  - {table_name} ({rows})")
+        print(f"      колонки: {columns}")
+
+    if not estimates:
+        print("\n💡 Оценки числа строк появятся после выполнения ANALYZE на рабочей базе")
+
+
+def show_sizes(conn):
+    """
+    Размер каждой таблицы и индекса по виртуальной таблице dbstat
+    и фрагментация: доля страниц, идущих в файле не подряд, и незанятое место внутри страниц.
+    """
+    try:
+        objects = conn.execute(
+            "SELECT name, COUNT(*), SUM(pgsize), SUM(unused) FROM dbstat GROUP BY name ORDER BY SUM(pgsize) DESC"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        print("❌ SQLite собран без dbstat (SQLITE_ENABLE_DBSTAT_VTAB) — размеры объектов недоступны")
+        return
+
+    kinds = dict(conn.execute("SELECT name, type FROM sqlite_master"))
+    estimates = get_row_estimates(conn)
+    print(f"{'объект':<40} {'тип':<6} {'строк':>10} {'страниц':>8} {'размер':>12} {'пусто':>6} {'фрагм.':>6}")
+    for name, pages, size, unused in objects:
+        print(
+            f"{name:<40} {kinds.get(name, 'table'):<6} {estimates.get(name, '?'):>10} {pages:>8}"
+            f" {format_size(size):>12} {unused * 100 / max(size, 1):>5.1f}% {fragmentation(conn, name):>5.1f}%"
+        )
+
+    page_size, page_count, freelist_count = get_page_stats(conn)
+    print(f"\n🧹 Свободных страниц в файле: {freelist_count} из {page_count}"
+          f" ({format_size(freelist_count * page_size)}); вернуть место можно через VACUUM")
+
+
+def fragmentation(conn, name):
+    """
+    Процент страниц объекта, которые лежат в файле не сразу за предыдущей
+    (в порядке обхода дерева). Страницы читаются потоково, память не растёт.
+    """
+    previous = None
+    jumps = 0
+    total = 0
+    for (pageno,) in conn.execute("SELECT pageno FROM dbstat WHERE name = ?", (name,)):
+        if previous is not None and pageno != previous + 1:
+            jumps += 1
+        previous = pageno
+        total += 1
+    return jumps * 100 / max(total - 1, 1)
+
+
+def iter_rows(conn, table_name, batch_size=1000, limit=None):
+    """
+    Потоковое чтение таблицы пачками по rowid.
+    Каждая пачка — отдельный короткий SELECT, поэтому блокировка чтения не держится
+    на всё время выгрузки, а в памяти одновременно не больше batch_size строк.
+    """
+    table = quote_identifier(table_name)
+    last_rowid = None
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+        if last_rowid is None:
+            batch = conn.execute(f"SELECT rowid, * FROM {table} ORDER BY rowid LIMIT ?", (size,)).fetchall()
+        else:
+            batch = conn.execute(
+                f"SELECT rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, size)
+            ).fetchall()
+        if not batch:
+            return
+        for row in batch:
+            yield row[1:]
+        last_rowid = batch[-1][0]
+        sent += len(batch)
+
+
+def dump_table(conn, table_name, output, fmt="csv", batch_size=1000, limit=None):
+    """Выгрузить таблицу в CSV или JSONL"""
+    columns = get_columns(conn, table_name)
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for row in iter_rows(conn, table_name, batch_size, limit):
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in iter_rows(conn, table_name, batch_size, limit):
+            output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n")
+            count += 1
     return count
 
+
 def show_recent_data(conn, table_name, limit=5):
     """Показать последние записи из таблицы"""
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute(f"SELECT * FROM {table_name} ORDER BY id DESC LIMIT {limit}")
-        rows = cursor.fetchall()
-        
-        # Получаем названия колонок
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if rows:
-            print(f"\n📋 Последние {min(len(rows), limit)} записей из '{table_name}':")
-            for i, row in enumerate(rows, 1):
-                print(f"\n   Запись {i}:")
-                for j, value in enumerate(row):
-                    # Ограничиваем длину текста для читаемости
-                    if isinstance(value, str) and len(value) > 50:
-                        value = value[:50] + "..."
-                    print(f"     {columns[j]}: {value}")
-        else:
-            print(f"\n📋 Таблица '{table_name}' пуста")
-            
-    except Exception as e:
-        print(f"❌ Ошибка чтения таблицы {table_name}: {e}")
-
-def get_database_size():
-    """Получить размер базы данных"""
-    db_path = "backend/data/clinic.db"
-    if os.path.exists(db_path):
-        size = os.path.getsize(db_path)
-        if size < 1024:
-            return f"{size} байт"
-        elif size < 1024*1024:
-            return f"{size/1024:.1f} КБ"
-        else:
-            return f"{size/(1024*1024):.1f} МБ"
-    return "Неизвестно"
+    columns = get_columns(conn, table_name)
+    rows = conn.execute(
+        f"SELECT * FROM {quote_identifier(table_name)} ORDER BY rowid DESC LIMIT ?", (limit,)
+    ).fetchall()
+    if not rows:
+        print(f"\n📋 Таблица '{table_name}' пуста")
+        return
+
+    print(f"\n📋 Последние {len(rows)} записей из '{table_name}':")
+    for i, row in enumerate(rows, 1):
+        print(f"\n   Запись {i}:")
+        for column, value in zip(columns, row):
+            # Ограничиваем длину текста для читаемости
+            if isinstance(value, str) and len(value) > 50:
+                value = value[:50] + "..."
+            print(f"     {column}: {value}")
+
 
 def main():
-    print("🗄️  ПРОСМОТР БАЗЫ ДАННЫХ РЕГИСТРАТУРЫ КЛИНИКИ")
-    print("=" * 50)
-    
-    # Информация о файле
-    db_size = get_database_size()
-    print(f"📁 Размер базы данных: {db_size}")
-    print(f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    
-    # Подключение
-    conn = connect_to_db()
+    parser = argparse.ArgumentParser(description="Просмотр базы данных регистратуры (только чтение)")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help=f"Путь к базе (по умолчанию {DEFAULT_DB_PATH})")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("summary", help="Сводка по таблицам (по умолчанию)")
+    commands.add_parser("sizes", help="Размер таблиц и индексов, фрагментация")
+
+    recent = commands.add_parser("recent", help="Последние записи таблицы")
+    recent.add_argument("table")
+    recent.add_argument("-n", "--limit", type=int, default=5)
+
+    dump = commands.add_parser("dump", help="Выгрузка таблицы в CSV/JSONL")
+    dump.add_argument("table")
+    dump.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    dump.add_argument("-o", "--output", help="Файл для выгрузки (по умолчанию stdout)")
+    dump.add_argument("--batch-size", type=int, default=1000)
+    dump.add_argument("--limit", type=int, default=None)
+
+    args = parser.parse_args()
+
+    conn = connect_to_db(args.db)
     if not conn:
-        return
-    
+        raise SystemExit(1)
+
     try:
-        # Показать все таблицы
-        tables = show_tables(conn)
-        
-        # Показать информацию о каждой таблице
-        for table in tables:
-            count = show_table_info(conn, table)
-            if count > 0:
-                show_recent_data(conn, table)
-        
-        print("\n" + "=" * 50)
-        print("✅ Просмотр завершен!")
-        print("\n💡 Для экспорта данных используйте кнопку 'Экспорт' в веб-интерфейсе")
-        print("💡 Для полной очистки используйте кнопку 'Очистить' в веб-интерфейсе")
-        
+        if args.command in (None, "summary"):
+            show_summary(conn, args.db)
+        elif args.command == "sizes":
+            show_sizes(conn)
+        else:
+            if args.table not in get_tables(conn):
+                print(f"❌ Таблица не найдена: {args.table}", file=sys.stderr)
+                raise SystemExit(1)
+            if args.command == "recent":
+                show_recent_data(conn, args.table, args.limit)
+            else:
+                if args.output:
+                    with open(args.output, "w", encoding="utf-8", newline="") as output:
+                        count = dump_table(conn, args.table, output, args.format, args.batch_size, args.limit)
+                    print(f"✅ Выгружено {count} записей в {args.output}", file=sys.stderr)
+                else:
+                    dump_table(conn, args.table, sys.stdout, args.format, args.batch_size, args.limit)
     finally:
         conn.close()
 
+
 if __name__ == "__main__":
     main()